@@ -10,6 +10,8 @@ from sipyco.sync_struct import Subscriber, process_mod
 from sipyco import pyon
 from sipyco.pipe_ipc import AsyncioChildComm
 
+from artiq.master.publisher import subscription_name
+
 
 logger = logging.getLogger(__name__)
 
@@ -113,6 +115,8 @@ class SimpleApplet:
         self.embed = os.getenv("ARTIQ_APPLET_EMBED")
         self.datasets = {getattr(self.args, arg.replace("-", "_"))
                          for arg in self.dataset_args}
+        # optional datasets that were not given
+        self.datasets.discard(None)
 
     def quamash_init(self):
         app = QtWidgets.QApplication([])
@@ -199,8 +203,10 @@ class SimpleApplet:
 
     def subscribe(self):
         if self.embed is None:
-            self.subscriber = Subscriber("datasets",
-                                         self.sub_init, self.sub_mod)
+            # The master only sends the datasets used by the applet.
+            self.subscriber = Subscriber(
+                subscription_name("datasets", self.datasets),
+                self.sub_init, self.sub_mod)
             self.loop.run_until_complete(self.subscriber.connect(
                 self.args.server, self.args.port))
         else:
@@ -0,0 +1,150 @@
+"""
+Catalog of the metadata and thumbnails of result files.
+
+Reading the thumbnail and metadata of a result file requires opening it
+with HDF5, which is too slow to do for every file that the browser
+displays. :class:`Catalog` keeps them in an SQLite database, keyed by
+the path, modification time and size of each file, so that a file is
+only read again after it has changed.
+
+This module does not depend on Qt. The catalog is used by the browser
+from a background thread.
+"""
+
+import logging
+import os
+import sqlite3
+
+import numpy
+import h5py
+
+from sipyco import pyon
+
+
+logger = logging.getLogger(__name__)
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    metadata TEXT NOT NULL,
+    thumbnail BLOB
+)
+"""
+
+
+def _str(value):
+    # h5py returns the strings it reads as bytes from version 3.
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
+
+
+def open_result(filename):
+    """Opens the result file ``filename`` for reading.
+
+    The file is opened in single-writer multiple-reader mode, so that the
+    files that runs are still writing in that mode can be read, and
+    opened normally if that fails, e.g. with the format of older files.
+    """
+    try:
+        return h5py.File(filename, "r", libver="latest", swmr=True)
+    except OSError:
+        return h5py.File(filename, "r")
+
+
+def read_metadata(filename):
+    """Reads the metadata of the result file ``filename``, and the
+    thumbnail image in its ``thumbnail`` dataset.
+
+    Returns the metadata as a dictionary with the items among
+    ``artiq_version``, ``rid``, ``start_time`` and ``expid`` that the file
+    contains, and the thumbnail as ``bytes``, or ``None`` if the file has
+    no thumbnail.
+    """
+    with open_result(filename) as f:
+        metadata = dict()
+        if "artiq_version" in f:
+            metadata["artiq_version"] = _str(f["artiq_version"][()])
+        if "rid" in f:
+            metadata["rid"] = int(f["rid"][()])
+        if "start_time" in f:
+            metadata["start_time"] = float(f["start_time"][()])
+        if "expid" in f:
+            metadata["expid"] = pyon.decode(_str(f["expid"][()]))
+
+        thumbnail = None
+        if "datasets/thumbnail" in f:
+            thumbnail = f["datasets/thumbnail"][()]
+            if isinstance(thumbnail, (numpy.void, numpy.ndarray)):
+                thumbnail = thumbnail.tobytes()
+            else:
+                thumbnail = bytes(thumbnail)
+    return metadata, thumbnail
+
+
+class Catalog:
+    """Caches the metadata and thumbnails of result files in the SQLite
+    database ``filename``.
+
+    The database is opened on first use, and may then only be used from
+    the thread that opened it. It is created again if it is unreadable.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)),
+                    exist_ok=True)
+        db = sqlite3.connect(self.filename)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(_schema)
+        except sqlite3.DatabaseError:
+            db.close()
+            raise
+        return db
+
+    def _connect(self):
+        if self._db is None:
+            try:
+                self._db = self._open()
+            except sqlite3.DatabaseError:
+                logger.warning("catalog %s is unreadable, recreating it",
+                               self.filename, exc_info=True)
+                os.remove(self.filename)
+                self._db = self._open()
+        return self._db
+
+    def lookup(self, path):
+        """Returns the metadata and thumbnail of the result file ``path``
+        (see :func:`read_metadata`).
+
+        They are read from the file, and added to the catalog, if the file
+        has changed since it was cataloged. Raises ``OSError`` if it cannot
+        be read, e.g. while it is being written.
+        """
+        db = self._connect()
+        st = os.stat(path)
+        row = db.execute(
+            "SELECT metadata, thumbnail FROM files "
+            "WHERE path = ? AND mtime = ? AND size = ?",
+            (path, st.st_mtime, st.st_size)).fetchone()
+        if row is not None:
+            return pyon.decode(row[0]), row[1]
+
+        metadata, thumbnail = read_metadata(path)
+        with db:
+            db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                       (path, st.st_mtime, st.st_size,
+                        pyon.encode(metadata), thumbnail))
+        return metadata, thumbnail
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
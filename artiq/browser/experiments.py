@@ -391,6 +391,10 @@ class LocalDatasetDB:
     def update(self, mod):
         self.datasets_sub.update(mod)
 
+    def update_many(self, mods):
+        for mod in mods:
+            self.datasets_sub.update(mod)
+
 
 class ExperimentsArea(QtWidgets.QMdiArea):
     def __init__(self, root, datasets_sub):
@@ -409,6 +413,7 @@ class ExperimentsArea(QtWidgets.QMdiArea):
             "get_device": lambda k: {"type": "dummy"},
             "get_dataset": self._ddb.get,
             "update_dataset": self._ddb.update,
+            "update_datasets": self._ddb.update_many,
         }
 
     def dataset_changed(self, path):
@@ -1,12 +1,18 @@
+import asyncio
 import logging
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import h5py
 from PyQt5 import QtCore, QtWidgets, QtGui
 
 from sipyco import pyon
 
+from artiq import __version__ as artiq_version
+from artiq.appdirs import user_cache_dir
+from artiq.browser.catalog import Catalog, open_result
+
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +22,7 @@ def open_h5(info):
             info.suffix() == "h5"):
         return
     try:
-        return h5py.File(info.filePath(), "r")
+        return open_result(info.filePath())
     except OSError:  # e.g. file being written (see #470)
         logger.debug("OSError when opening HDF5 file %s", info.filePath(),
                      exc_info=True)
@@ -25,30 +31,59 @@ def open_h5(info):
                        exc_info=True)
 
 
-class ThumbnailIconProvider(QtWidgets.QFileIconProvider):
-    def icon(self, info):
-        icon = self.hdf5_thumbnail(info)
-        if icon is None:
-            icon = QtWidgets.QFileIconProvider.icon(self, info)
-        return icon
-
-    def hdf5_thumbnail(self, info):
-        f = open_h5(info)
-        if not f:
-            return
-        with f:
+class Indexer:
+    """Looks up the thumbnails and metadata of result files in a
+    :class:`artiq.browser.catalog.Catalog`, in a background thread.
+
+    The most recent requests are processed first, so that the files
+    being displayed are indexed before those that were scrolled past.
+    ``callback(path, mtime, result)`` is called from the event loop with
+    the ``(metadata, thumbnail)`` pair of each file, or ``None`` if it
+    could not be read.
+    """
+    def __init__(self, catalog, callback):
+        self.catalog = catalog
+        self.callback = callback
+        self._requests = OrderedDict()
+        self._requested = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = asyncio.ensure_future(self._do())
+
+    def request(self, path, mtime):
+        self._requests.pop(path, None)
+        self._requests[path] = mtime
+        self._requested.set()
+
+    async def _do(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self._requests:
+                self._requested.clear()
+                await self._requested.wait()
+                continue
+            path, mtime = self._requests.popitem()
             try:
-                t = f["datasets/thumbnail"]
-            except KeyError:
-                return
-            try:
-                img = QtGui.QImage.fromData(t.value)
+                result = await loop.run_in_executor(
+                    self._executor, self.catalog.lookup, path)
+            except OSError:  # e.g. file being written (see #470)
+                logger.debug("OSError when opening HDF5 file %s", path,
+                             exc_info=True)
+                result = None
             except:
-                logger.warning("unable to read thumbnail from %s",
-                               info.filePath(), exc_info=True)
-                return
-            pix = QtGui.QPixmap.fromImage(img)
-            return QtGui.QIcon(pix)
+                logger.warning("unable to read HDF5 file %s", path,
+                               exc_info=True)
+                result = None
+            self.callback(path, mtime, result)
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.get_event_loop().run_in_executor(
+            self._executor, self.catalog.close)
+        self._executor.shutdown()
 
 
 class DirsOnlyProxy(QtCore.QSortFilterProxyModel):
@@ -89,30 +124,83 @@ class ZoomIconView(QtWidgets.QListView):
 
 
 class Hdf5FileSystemModel(QtWidgets.QFileSystemModel):
-    def __init__(self):
+    """Displays the thumbnails of the result files as their icons, and
+    their metadata as tooltips.
+
+    These are obtained from the :class:`Indexer`; files that have not been
+    indexed yet are displayed as any other file until they are. Only the
+    ``index_size`` most recently used entries are kept in memory, and the
+    others are looked up in the catalog again when they are displayed."""
+    def __init__(self, catalog, index_size=4096):
         QtWidgets.QFileSystemModel.__init__(self)
         self.setFilter(QtCore.QDir.Drives | QtCore.QDir.NoDotAndDotDot |
                        QtCore.QDir.AllDirs | QtCore.QDir.Files)
         self.setNameFilterDisables(False)
-        self.setIconProvider(ThumbnailIconProvider())
+
+        self.indexer = Indexer(catalog, self._indexed)
+        self.index_size = index_size
+        # path -> (mtime, icon, tooltip) of the indexed files, least
+        # recently used first
+        self._index = OrderedDict()
+        # path -> mtime of the files waiting to be indexed
+        self._pending = dict()
+
+    def _entry(self, info):
+        if not (info.isFile() and info.suffix() == "h5"):
+            return
+        path = info.filePath()
+        mtime = info.lastModified().toMSecsSinceEpoch()
+        entry = self._index.get(path)
+        if entry is not None and entry[0] == mtime:
+            self._index.move_to_end(path)
+            return entry
+        if self._pending.get(path) != mtime:
+            self._pending[path] = mtime
+            self.indexer.request(path, mtime)
+
+    def _indexed(self, path, mtime, result):
+        if self._pending.get(path) == mtime:
+            del self._pending[path]
+        icon = tooltip = None
+        if result is not None:
+            metadata, thumbnail = result
+            if thumbnail is not None:
+                img = QtGui.QImage.fromData(thumbnail)
+                if img.isNull():
+                    logger.warning("unable to read thumbnail from %s", path)
+                else:
+                    icon = QtGui.QIcon(QtGui.QPixmap.fromImage(img))
+            try:
+                expid = metadata["expid"]
+                tooltip = ("artiq_version: {}\nrepo_rev: {}\nfile: {}\n"
+                           "class_name: {}\nrid: {}\nstart_time: {}").format(
+                               metadata["artiq_version"], expid["repo_rev"],
+                               expid["file"], expid["class_name"],
+                               metadata["rid"],
+                               datetime.fromtimestamp(metadata["start_time"]))
+            except KeyError:
+                logger.warning("unable to read metadata from %s", path,
+                               exc_info=True)
+        self._index.pop(path, None)
+        self._index[path] = mtime, icon, tooltip
+        while len(self._index) > self.index_size:
+            self._index.popitem(last=False)
+
+        idx = self.index(path)
+        if idx.isValid():
+            self.dataChanged.emit(idx, idx, [QtCore.Qt.DecorationRole,
+                                             QtCore.Qt.ToolTipRole])
 
     def data(self, idx, role):
-        if role == QtCore.Qt.ToolTipRole:
-            info = self.fileInfo(idx)
-            h5 = open_h5(info)
-            if h5 is not None:
-                try:
-                    expid = pyon.decode(h5["expid"].value)
-                    start_time = datetime.fromtimestamp(h5["start_time"].value)
-                    v = ("artiq_version: {}\nrepo_rev: {}\nfile: {}\n"
-                         "class_name: {}\nrid: {}\nstart_time: {}").format(
-                             h5["artiq_version"].value, expid["repo_rev"],
-                             expid["file"], expid["class_name"],
-                             h5["rid"].value, start_time)
-                    return v
-                except:
-                    logger.warning("unable to read metadata from %s",
-                                   info.filePath(), exc_info=True)
+        if role == QtCore.Qt.ToolTipRole or (
+                role == QtCore.Qt.DecorationRole and idx.column() == 0):
+            entry = self._entry(self.fileInfo(idx))
+            if entry is not None:
+                _, icon, tooltip = entry
+                if role == QtCore.Qt.DecorationRole and icon is not None:
+                    return icon
+                if role == QtCore.Qt.ToolTipRole and tooltip is not None:
+                    return tooltip
         return QtWidgets.QFileSystemModel.data(self, idx, role)
 
 
@@ -121,7 +209,7 @@ class FilesDock(QtWidgets.QDockWidget):
     dataset_changed = QtCore.pyqtSignal(str)
     metadata_changed = QtCore.pyqtSignal(dict)
 
-    def __init__(self, datasets, browse_root=""):
+    def __init__(self, datasets, browse_root="", catalog_file=None):
         QtWidgets.QDockWidget.__init__(self, "Files")
         self.setObjectName("Files")
         self.setFeatures(self.DockWidgetMovable | self.DockWidgetFloatable)
@@ -131,7 +219,12 @@ class FilesDock(QtWidgets.QDockWidget):
 
         self.datasets = datasets
 
-        self.model = Hdf5FileSystemModel()
+        if catalog_file is None:
+            catalog_file = os.path.join(
+                user_cache_dir("artiq", "m-labs",
+                               artiq_version.split(".")[0]),
+                "browser_catalog.db")
+        self.model = Hdf5FileSystemModel(Catalog(catalog_file))
 
         self.rt = QtWidgets.QTreeView()
         rt_model = DirsOnlyProxy()
@@ -162,6 +255,9 @@ class FilesDock(QtWidgets.QDockWidget):
         self.rl.activated.connect(self.list_activated)
         self.splitter.addWidget(self.rl)
 
+    async def stop(self):
+        await self.model.indexer.stop()
+
     def tree_current_changed(self, current, previous):
         idx = self.rt.model().mapToSource(current)
         self.rl.setRootIndex(idx)
@@ -0,0 +1,537 @@
+"""
+Symbolization of addresses in the shared libraries produced by the linker,
+from their DWARF debug information.
+
+:class:`DebugInfo` reads the line tables and the subprograms and inlined
+subroutines of a library, so that the backtrace of an exception raised
+by a kernel is obtained without writing the library to disk and running
+``addr2line``. DWARF versions 2 to 4 are supported, which covers what
+LLVM emits for kernels; other versions raise :class:`UnsupportedDebugInfo`.
+"""
+
+import struct
+import posixpath
+from bisect import bisect_right
+
+from artiq.compiler import elf
+
+
+class UnsupportedDebugInfo(Exception):
+    """Raised for debug information that :class:`DebugInfo` cannot read."""
+
+
+DW_TAG_lexical_block       = 0x0b
+DW_TAG_inlined_subroutine  = 0x1d
+DW_TAG_subprogram          = 0x2e
+
+DW_AT_name                 = 0x03
+DW_AT_stmt_list            = 0x10
+DW_AT_low_pc               = 0x11
+DW_AT_high_pc              = 0x12
+DW_AT_comp_dir             = 0x1b
+DW_AT_abstract_origin      = 0x31
+DW_AT_specification        = 0x47
+DW_AT_ranges               = 0x55
+DW_AT_call_file            = 0x58
+DW_AT_call_line            = 0x59
+DW_AT_linkage_name         = 0x6e
+DW_AT_MIPS_linkage_name    = 0x2007
+
+DW_FORM_addr         = 0x01
+DW_FORM_block2       = 0x03
+DW_FORM_block4       = 0x04
+DW_FORM_data2        = 0x05
+DW_FORM_data4        = 0x06
+DW_FORM_data8        = 0x07
+DW_FORM_string       = 0x08
+DW_FORM_block        = 0x09
+DW_FORM_block1       = 0x0a
+DW_FORM_data1        = 0x0b
+DW_FORM_flag         = 0x0c
+DW_FORM_sdata        = 0x0d
+DW_FORM_strp         = 0x0e
+DW_FORM_udata        = 0x0f
+DW_FORM_ref_addr     = 0x10
+DW_FORM_ref1         = 0x11
+DW_FORM_ref2         = 0x12
+DW_FORM_ref4         = 0x13
+DW_FORM_ref8         = 0x14
+DW_FORM_ref_udata    = 0x15
+DW_FORM_indirect     = 0x16
+DW_FORM_sec_offset   = 0x17
+DW_FORM_exprloc      = 0x18
+DW_FORM_flag_present = 0x19
+DW_FORM_ref_sig8     = 0x20
+
+_CONSTANT_FORMS = (DW_FORM_data1, DW_FORM_data2, DW_FORM_data4, DW_FORM_data8,
+                   DW_FORM_sdata, DW_FORM_udata)
+_LOCAL_REFERENCE_FORMS = (DW_FORM_ref1, DW_FORM_ref2, DW_FORM_ref4, DW_FORM_ref8,
+                          DW_FORM_ref_udata)
+
+DW_LNS_copy               = 1
+DW_LNS_advance_pc         = 2
+DW_LNS_advance_line       = 3
+DW_LNS_set_file           = 4
+DW_LNS_const_add_pc       = 8
+DW_LNS_fixed_advance_pc   = 9
+
+DW_LNE_end_sequence       = 1
+DW_LNE_set_address        = 2
+DW_LNE_define_file        = 3
+
+
+class _Reader:
+    def __init__(self, data, little_endian, offset=0):
+        self.data = data
+        self.offset = offset
+        self.prefix = "<" if little_endian else ">"
+        self.offset_size = 4
+
+    def _unpack(self, fmt, size):
+        if self.offset + size > len(self.data):
+            raise UnsupportedDebugInfo("truncated debug information")
+        value, = struct.unpack_from(self.prefix + fmt, self.data, self.offset)
+        self.offset += size
+        return value
+
+    def u8(self):
+        return self._unpack("B", 1)
+
+    def s8(self):
+        return self._unpack("b", 1)
+
+    def u16(self):
+        return self._unpack("H", 2)
+
+    def u32(self):
+        return self._unpack("I", 4)
+
+    def u64(self):
+        return self._unpack("Q", 8)
+
+    def unsigned(self, size):
+        if size == 1:
+            return self.u8()
+        elif size == 2:
+            return self.u16()
+        elif size == 4:
+            return self.u32()
+        elif size == 8:
+            return self.u64()
+        raise UnsupportedDebugInfo("unsupported field size {}".format(size))
+
+    def section_offset(self):
+        return self.unsigned(self.offset_size)
+
+    def uleb(self):
+        value = shift = 0
+        while True:
+            byte = self.u8()
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    def sleb(self):
+        value = shift = 0
+        while True:
+            byte = self.u8()
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                if byte & 0x40:
+                    value -= 1 << shift
+                return value
+
+    def cstring(self):
+        end = self.data.find(b"\x00", self.offset)
+        if end < 0:
+            raise UnsupportedDebugInfo("unterminated string")
+        value = self.data[self.offset:end].decode("utf-8", "replace")
+        self.offset = end + 1
+        return value
+
+    def unit_length(self):
+        # Returns the offset of the end of the unit, and selects the size
+        # of section offsets for the 32-bit or 64-bit DWARF format.
+        length = self.u32()
+        if length == 0xffffffff:
+            self.offset_size = 8
+            length = self.u64()
+        elif length >= 0xfffffff0:
+            raise UnsupportedDebugInfo("reserved unit length")
+        else:
+            self.offset_size = 4
+        return self.offset + length
+
+
+class _DIE:
+    __slots__ = ("tag", "attributes", "children", "unit")
+
+    def __init__(self, tag, attributes, unit):
+        self.tag = tag
+        self.attributes = attributes
+        self.children = []
+        self.unit = unit
+
+
+class _Unit:
+    def __init__(self):
+        self.comp_dir = None
+        self.files = []
+        self.reader_args = None
+        self.lines = []
+        self.line_starts = []
+
+
+def _ranges(die, debug_ranges, reader_args):
+    attributes = die.attributes
+    if DW_AT_low_pc in attributes and DW_AT_high_pc in attributes:
+        low, (high, high_form) = attributes[DW_AT_low_pc][0], attributes[DW_AT_high_pc]
+        if high_form in _CONSTANT_FORMS:
+            high += low
+        return [(low, high)]
+    if DW_AT_ranges in attributes and debug_ranges is not None:
+        address_size, little_endian, base = reader_args
+        reader = _Reader(debug_ranges, little_endian, attributes[DW_AT_ranges][0])
+        ranges = []
+        max_address = (1 << (8 * address_size)) - 1
+        while True:
+            begin = reader.unsigned(address_size)
+            end = reader.unsigned(address_size)
+            if begin == 0 and end == 0:
+                return ranges
+            if begin == max_address:
+                base = end
+            elif begin != end:
+                ranges.append((base + begin, base + end))
+    return []
+
+
+class DebugInfo:
+    """Reads the DWARF debug information of the ELF file ``library``.
+
+    Raises :class:`UnsupportedDebugInfo` if the library has no debug
+    information, or debug information in a format that is not supported.
+    """
+    def __init__(self, library):
+        try:
+            self._elf = elf.ElfFile(library)
+        except (ValueError, struct.error) as error:
+            raise UnsupportedDebugInfo(str(error)) from error
+        self._little_endian = self._elf.little_endian
+
+        def section(name):
+            index = self._elf.section(name)
+            if index is None:
+                return None
+            if self._elf.sections[index].flags & 0x800:  # SHF_COMPRESSED
+                raise UnsupportedDebugInfo("compressed section {}".format(name))
+            return self._elf.contents(index)
+
+        debug_info = section(".debug_info")
+        debug_abbrev = section(".debug_abbrev")
+        if debug_info is None or debug_abbrev is None:
+            raise UnsupportedDebugInfo("no debug information")
+        self._debug_str = section(".debug_str")
+        self._debug_line = section(".debug_line")
+        self._debug_ranges = section(".debug_ranges")
+
+        self._dies = dict()
+        self._units = []
+        # (low, high, subprogram DIE) for all the subprograms, sorted
+        self._subprograms = []
+        self._abbrev_tables = dict()
+        self._read_units(debug_info, debug_abbrev)
+        self._subprograms.sort(key=lambda entry: entry[:2])
+
+    def _abbrevs(self, debug_abbrev, offset):
+        if offset in self._abbrev_tables:
+            return self._abbrev_tables[offset]
+        reader = _Reader(debug_abbrev, self._little_endian, offset)
+        abbrevs = dict()
+        while True:
+            code = reader.uleb()
+            if code == 0:
+                break
+            tag = reader.uleb()
+            has_children = reader.u8()
+            specs = []
+            while True:
+                attribute, form = reader.uleb(), reader.uleb()
+                if attribute == 0 and form == 0:
+                    break
+                specs.append((attribute, form))
+            abbrevs[code] = tag, has_children, specs
+        self._abbrev_tables[offset] = abbrevs
+        return abbrevs
+
+    def _read_value(self, reader, form, unit_offset, version, address_size):
+        if form == DW_FORM_indirect:
+            form = reader.uleb()
+        if form == DW_FORM_addr:
+            return reader.unsigned(address_size), form
+        elif form in (DW_FORM_data1, DW_FORM_ref1, DW_FORM_flag):
+            value = reader.u8()
+        elif form in (DW_FORM_data2, DW_FORM_ref2):
+            value = reader.u16()
+        elif form in (DW_FORM_data4, DW_FORM_ref4):
+            value = reader.u32()
+        elif form in (DW_FORM_data8, DW_FORM_ref8, DW_FORM_ref_sig8):
+            value = reader.u64()
+        elif form == DW_FORM_sdata:
+            value = reader.sleb()
+        elif form in (DW_FORM_udata, DW_FORM_ref_udata):
+            value = reader.uleb()
+        elif form == DW_FORM_string:
+            return reader.cstring(), form
+        elif form == DW_FORM_strp:
+            offset = reader.section_offset()
+            if self._debug_str is None:
+                raise UnsupportedDebugInfo("no string section")
+            return _Reader(self._debug_str, self._little_endian, offset).cstring(), form
+        elif form == DW_FORM_ref_addr:
+            if version == 2:
+                return reader.unsigned(address_size), form
+            return reader.section_offset(), form
+        elif form == DW_FORM_sec_offset:
+            value = reader.section_offset()
+        elif form in (DW_FORM_block, DW_FORM_exprloc):
+            length = reader.uleb()
+            reader.offset += length
+            return None, form
+        elif form == DW_FORM_block1:
+            length = reader.u8()
+            reader.offset += length
+            return None, form
+        elif form == DW_FORM_block2:
+            length = reader.u16()
+            reader.offset += length
+            return None, form
+        elif form == DW_FORM_block4:
+            length = reader.u32()
+            reader.offset += length
+            return None, form
+        elif form == DW_FORM_flag_present:
+            return 1, form
+        else:
+            raise UnsupportedDebugInfo("unsupported attribute form {:#x}".format(form))
+        if form in _LOCAL_REFERENCE_FORMS:
+            value += unit_offset
+        return value, form
+
+    def _read_units(self, debug_info, debug_abbrev):
+        reader = _Reader(debug_info, self._little_endian)
+        while reader.offset < len(debug_info):
+            unit_offset = reader.offset
+            unit_end = reader.unit_length()
+            version = reader.u16()
+            if not 2 <= version <= 4:
+                raise UnsupportedDebugInfo("unsupported DWARF version {}".format(version))
+            abbrevs = self._abbrevs(debug_abbrev, reader.section_offset())
+            address_size = reader.u8()
+
+            unit = _Unit()
+            parents = []
+            unit_die = None
+            while reader.offset < unit_end:
+                die_offset = reader.offset
+                code = reader.uleb()
+                if code == 0:
+                    if parents:
+                        parents.pop()
+                    continue
+                if code not in abbrevs:
+                    raise UnsupportedDebugInfo("unknown abbreviation {}".format(code))
+                tag, has_children, specs = abbrevs[code]
+                attributes = dict()
+                for attribute, form in specs:
+                    attributes[attribute] = self._read_value(
+                        reader, form, unit_offset, version, address_size)
+                die = _DIE(tag, attributes, unit)
+                self._dies[die_offset] = die
+                if parents:
+                    parents[-1].children.append(die)
+                elif unit_die is None:
+                    unit_die = die
+                if has_children:
+                    parents.append(die)
+            reader.offset = unit_end
+            if unit_die is None:
+                continue
+
+            base = unit_die.attributes.get(DW_AT_low_pc, (0,))[0]
+            reader_args = address_size, self._little_endian, base
+            unit.reader_args = reader_args
+            self._units.append(unit)
+            if DW_AT_comp_dir in unit_die.attributes:
+                unit.comp_dir = unit_die.attributes[DW_AT_comp_dir][0]
+            if DW_AT_stmt_list in unit_die.attributes and self._debug_line is not None:
+                self._read_lines(unit, unit_die.attributes[DW_AT_stmt_list][0],
+                                 address_size)
+            self._index_subprograms(unit_die, reader_args)
+
+    def _index_subprograms(self, die, reader_args):
+        for child in die.children:
+            if child.tag == DW_TAG_subprogram:
+                for low, high in _ranges(child, self._debug_ranges, reader_args):
+                    self._subprograms.append((low, high, child))
+            else:
+                self._index_subprograms(child, reader_args)
+
+    def _read_lines(self, unit, offset, address_size):
+        reader = _Reader(self._debug_line, self._little_endian, offset)
+        unit_end = reader.unit_length()
+        version = reader.u16()
+        if not 2 <= version <= 4:
+            raise UnsupportedDebugInfo("unsupported line table version {}".format(version))
+        program_start = reader.section_offset()
+        program_start += reader.offset
+        min_instruction_length = reader.u8()
+        if version >= 4:
+            reader.u8()  # maximum_operations_per_instruction
+        default_is_stmt = reader.u8()
+        line_base = reader.s8()
+        line_range = reader.u8()
+        opcode_base = reader.u8()
+        opcode_lengths = [reader.u8() for _ in range(opcode_base - 1)]
+
+        directories = []
+        while True:
+            directory = reader.cstring()
+            if not directory:
+                break
+            directories.append(directory)
+
+        def file_entry(name):
+            directory_index = reader.uleb()
+            reader.uleb()  # modification time
+            reader.uleb()  # length
+            if directory_index == 0 or directory_index > len(directories):
+                directory = unit.comp_dir or ""
+            else:
+                directory = posixpath.join(unit.comp_dir or "",
+                                           directories[directory_index - 1])
+            unit.files.append(posixpath.join(directory, name))
+
+        while True:
+            name = reader.cstring()
+            if not name:
+                break
+            file_entry(name)
+
+        reader.offset = program_start
+        rows = []
+        address, file, line = 0, 1, 1
+        while reader.offset < unit_end:
+            opcode = reader.u8()
+            if opcode >= opcode_base:
+                adjusted = opcode - opcode_base
+                address += (adjusted // line_range) * min_instruction_length
+                line += line_base + adjusted % line_range
+                rows.append((address, file, line, False))
+            elif opcode == 0:
+                length = reader.uleb()
+                end = reader.offset + length
+                sub_opcode = reader.u8()
+                if sub_opcode == DW_LNE_end_sequence:
+                    rows.append((address, file, line, True))
+                    address, file, line = 0, 1, 1
+                elif sub_opcode == DW_LNE_set_address:
+                    address = reader.unsigned(length - 1)
+                elif sub_opcode == DW_LNE_define_file:
+                    file_entry(reader.cstring())
+                reader.offset = end
+            elif opcode == DW_LNS_copy:
+                rows.append((address, file, line, False))
+            elif opcode == DW_LNS_advance_pc:
+                address += reader.uleb() * min_instruction_length
+            elif opcode == DW_LNS_advance_line:
+                line += reader.sleb()
+            elif opcode == DW_LNS_set_file:
+                file = reader.uleb()
+            elif opcode == DW_LNS_const_add_pc:
+                address += ((255 - opcode_base) // line_range) * min_instruction_length
+            elif opcode == DW_LNS_fixed_advance_pc:
+                address += reader.u16()
+            else:
+                for _ in range(opcode_lengths[opcode - 1]):
+                    reader.uleb()
+
+        # Each row covers the addresses up to the next one in its sequence;
+        # of the rows at the same address, the last one applies.
+        lines = []
+        for row, next_row in zip(rows, rows[1:]):
+            if not row[3] and row[0] < next_row[0]:
+                lines.append((row[0], next_row[0], row[1], row[2]))
+        lines.sort()
+        unit.lines = lines
+        unit.line_starts = [entry[0] for entry in lines]
+
+    def _file(self, unit, index):
+        if 1 <= index <= len(unit.files):
+            return unit.files[index - 1]
+        return None
+
+    def _location(self, address):
+        for unit in self._units:
+            index = bisect_right(unit.line_starts, address) - 1
+            if index >= 0:
+                start, end, file, line = unit.lines[index]
+                if start <= address < end:
+                    return self._file(unit, file), line
+        return None, 0
+
+    def _name(self, die, depth=0):
+        attributes = die.attributes
+        for attribute in (DW_AT_linkage_name, DW_AT_MIPS_linkage_name, DW_AT_name):
+            if attribute in attributes:
+                return attributes[attribute][0]
+        if depth < 8:
+            for attribute in (DW_AT_abstract_origin, DW_AT_specification):
+                if attribute in attributes and attributes[attribute][0] in self._dies:
+                    return self._name(self._dies[attributes[attribute][0]], depth + 1)
+        return None
+
+    def _inlined_chain(self, die, address):
+        # Returns the inlined subroutines of ``die`` that contain
+        # ``address``, outermost first.
+        for child in die.children:
+            if child.tag in (DW_TAG_inlined_subroutine, DW_TAG_lexical_block):
+                ranges = _ranges(child, self._debug_ranges, child.unit.reader_args)
+                if ranges and not any(low <= address < high for low, high in ranges):
+                    continue
+                chain = self._inlined_chain(child, address)
+                # Without address ranges, a subroutine contains the address
+                # only through one of its own inlined subroutines.
+                if not ranges and not chain:
+                    continue
+                if child.tag == DW_TAG_inlined_subroutine:
+                    return [child] + chain
+                if chain:
+                    return chain
+        return []
+
+    def symbolize(self, address):
+        """Returns the frames at ``address``, innermost first, as
+        ``(function, filename, line)`` tuples. The function and file are
+        ``None``, and the line is 0, where they are not known."""
+        subprogram = None
+        for low, high, die in self._subprograms:
+            if low > address:
+                break
+            if address < high:
+                subprogram = die
+        filename, line = self._location(address)
+        if subprogram is None:
+            return [(None, filename, line)]
+
+        chain = [subprogram] + self._inlined_chain(subprogram, address)
+        frames = []
+        for die in reversed(chain):
+            frames.append((self._name(die), filename, line))
+            if die.tag == DW_TAG_inlined_subroutine:
+                filename = self._file(die.unit,
+                                      die.attributes.get(DW_AT_call_file, (0,))[0])
+                line = die.attributes.get(DW_AT_call_line, (0,))[0]
+        return frames
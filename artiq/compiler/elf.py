@@ -0,0 +1,277 @@
+"""
+Manipulation of the ELF objects and shared libraries produced by the
+compiler and the linker.
+
+:class:`ElfFile` reads the sections, symbols and relocations of a file,
+for :mod:`artiq.compiler.linker` and :mod:`artiq.compiler.dwarf`.
+
+:func:`strip_debug` removes the debug information from a library
+in-process, producing the same loadable image as ``strip --strip-debug``
+without writing the library to disk and running an external tool.
+The loadable segments are left in place byte-for-byte, except for
+section indices in the symbol tables; the remaining non-allocated
+sections are packed after them, followed by the section header table.
+"""
+
+import struct
+from collections import namedtuple
+
+
+ET_REL       = 1
+ET_DYN       = 3
+
+SHF_WRITE     = 0x1
+SHF_ALLOC     = 0x2
+SHF_EXECINSTR = 0x4
+
+SHT_NULL     = 0
+SHT_PROGBITS = 1
+SHT_SYMTAB   = 2
+SHT_STRTAB   = 3
+SHT_RELA     = 4
+SHT_HASH     = 5
+SHT_DYNAMIC  = 6
+SHT_NOBITS   = 8
+SHT_REL      = 9
+SHT_DYNSYM   = 11
+SHT_GROUP    = 17
+
+SHN_UNDEF     = 0
+SHN_LORESERVE = 0xff00
+SHN_ABS       = 0xfff1
+SHN_COMMON    = 0xfff2
+
+STB_LOCAL  = 0
+STB_GLOBAL = 1
+STB_WEAK   = 2
+
+STT_NOTYPE  = 0
+STT_OBJECT  = 1
+STT_FUNC    = 2
+STT_SECTION = 3
+STT_FILE    = 4
+
+STV_DEFAULT   = 0
+STV_PROTECTED = 3
+
+_DEBUG_PREFIXES = (".debug", ".zdebug", ".gnu.debuglto_")
+
+
+class _Layout:
+    def __init__(self, elf_class, byte_order):
+        if elf_class == 1:
+            self.ehdr = struct.Struct(byte_order + "16sHHIIIIIHHHHHH")
+            self.shdr = struct.Struct(byte_order + "IIIIIIIIII")
+            self.sym = struct.Struct(byte_order + "IIIBBH")
+            self.sym_shndx_offset = 14
+            self.rel = struct.Struct(byte_order + "II")
+            self.rela = struct.Struct(byte_order + "IIi")
+            self.r_sym_shift = 8
+        elif elf_class == 2:
+            self.ehdr = struct.Struct(byte_order + "16sHHIQQQIHHHHHH")
+            self.shdr = struct.Struct(byte_order + "IIQQQQIIQQ")
+            self.sym = struct.Struct(byte_order + "IBBHQQ")
+            self.sym_shndx_offset = 6
+            self.rel = struct.Struct(byte_order + "QQ")
+            self.rela = struct.Struct(byte_order + "QQq")
+            self.r_sym_shift = 32
+        else:
+            raise ValueError("unknown ELF class {}".format(elf_class))
+        self.elf_class = elf_class
+        self.byte_order = byte_order
+        self.shndx = struct.Struct(byte_order + "H")
+
+    def unpack_symbol(self, data, offset):
+        if self.elf_class == 1:
+            name, value, size, info, other, shndx = self.sym.unpack_from(data, offset)
+        else:
+            name, info, other, shndx, value, size = self.sym.unpack_from(data, offset)
+        return name, value, size, info, other, shndx
+
+
+class _Section:
+    _fields = ("name", "type", "flags", "addr", "offset",
+               "size", "link", "info", "addralign", "entsize")
+
+    def __init__(self, values):
+        for field, value in zip(self._fields, values):
+            setattr(self, field, value)
+
+    def values(self):
+        return tuple(getattr(self, field) for field in self._fields)
+
+
+def _section_name(data, strtab, offset):
+    start = strtab.offset + offset
+    return data[start:data.index(b"\x00", start)].decode("ascii", "replace")
+
+
+def _layout_of(data):
+    if data[:4] != b"\x7fELF":
+        raise ValueError("not an ELF file")
+    if data[5] == 1:
+        byte_order = "<"
+    elif data[5] == 2:
+        byte_order = ">"
+    else:
+        raise ValueError("unknown ELF data encoding {}".format(data[5]))
+    return _Layout(data[4], byte_order)
+
+
+Symbol = namedtuple("Symbol", "name value size bind type visibility shndx")
+Symbol.__doc__ = "A symbol of an :class:`ElfFile`, with its name decoded."
+
+Relocation = namedtuple("Relocation", "offset symbol type addend")
+Relocation.__doc__ = """A relocation of an :class:`ElfFile`. ``addend`` is
+``None`` for relocations with an implicit addend."""
+
+
+class ElfFile:
+    """Reads the headers, sections, symbols and relocations of the ELF file
+    ``data``.
+
+    :ivar sections: the section headers, with their name decoded in the
+        ``label`` attribute.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.layout = _layout_of(data)
+        (self.ident, self.type, self.machine, _version, _entry, _phoff,
+         shoff, self.flags, _ehsize, _phentsize, _phnum, shentsize, shnum,
+         shstrndx) = self.layout.ehdr.unpack_from(data)
+        self.little_endian = self.layout.byte_order == "<"
+
+        self.sections = []
+        for index in range(shnum if shoff else 0):
+            self.sections.append(_Section(
+                self.layout.shdr.unpack_from(data, shoff + index * shentsize)))
+        for section in self.sections:
+            section.label = _section_name(data, self.sections[shstrndx],
+                                          section.name)
+
+    def section(self, name):
+        """Returns the index of the section called ``name``, or ``None``."""
+        for index, section in enumerate(self.sections):
+            if index != 0 and section.label == name:
+                return index
+
+    def contents(self, index):
+        section = self.sections[index]
+        if section.type == SHT_NOBITS:
+            return bytes(section.size)
+        return self.data[section.offset:section.offset + section.size]
+
+    def _string(self, strtab_index, offset):
+        start = self.sections[strtab_index].offset + offset
+        return self.data[start:self.data.index(b"\x00", start)].decode("utf-8", "replace")
+
+    def symbols(self, index):
+        """Returns the symbols of the symbol table in section ``index``."""
+        section = self.sections[index]
+        symbols = []
+        for offset in range(section.offset, section.offset + section.size,
+                            self.layout.sym.size):
+            name, value, size, info, other, shndx = \
+                self.layout.unpack_symbol(self.data, offset)
+            symbols.append(Symbol(self._string(section.link, name), value, size,
+                                  info >> 4, info & 0xf, other & 0x3, shndx))
+        return symbols
+
+    def relocations(self, index):
+        """Returns the relocations in the ``SHT_REL`` or ``SHT_RELA``
+        section ``index``."""
+        section = self.sections[index]
+        mask = (1 << self.layout.r_sym_shift) - 1
+        if section.type == SHT_RELA:
+            entry = self.layout.rela
+        else:
+            entry = self.layout.rel
+        relocations = []
+        for offset in range(section.offset, section.offset + section.size,
+                            entry.size):
+            fields = entry.unpack_from(self.data, offset)
+            addend = fields[2] if section.type == SHT_RELA else None
+            relocations.append(Relocation(fields[0], fields[1] >> self.layout.r_sym_shift,
+                                          fields[1] & mask, addend))
+        return relocations
+
+
+def strip_debug(library):
+    """Return ``library`` without its debug sections."""
+    layout = _layout_of(library)
+
+    ehdr = list(layout.ehdr.unpack_from(library))
+    (_ident, _type, _machine, _version, _entry, e_phoff, e_shoff, _flags,
+     e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum, e_shstrndx) = ehdr
+    if e_shoff == 0:
+        return library
+
+    sections = [_Section(layout.shdr.unpack_from(library, e_shoff + index * e_shentsize))
+                for index in range(e_shnum)]
+    shstrtab = sections[e_shstrndx]
+
+    dropped = set()
+    for index, section in enumerate(sections):
+        if index == 0 or section.flags & SHF_ALLOC:
+            continue
+        if _section_name(library, shstrtab, section.name).startswith(_DEBUG_PREFIXES):
+            dropped.add(index)
+    if not dropped:
+        return library
+    # Relocations that apply to the debug sections go away with them.
+    for index, section in enumerate(sections):
+        if section.type in (SHT_REL, SHT_RELA) and section.info in dropped:
+            dropped.add(index)
+
+    index_map = {}
+    for index in range(len(sections)):
+        if index not in dropped:
+            index_map[index] = len(index_map)
+
+    # Everything that is loaded stays where it is.
+    image_end = max(e_ehsize, e_phoff + e_phnum * e_phentsize)
+    for index, section in enumerate(sections):
+        if section.flags & SHF_ALLOC and section.type != SHT_NOBITS:
+            image_end = max(image_end, section.offset + section.size)
+    output = bytearray(library[:image_end])
+
+    kept = []
+    for index, section in enumerate(sections):
+        if index in dropped:
+            continue
+        if index != 0 and not section.flags & SHF_ALLOC and section.type != SHT_NOBITS:
+            contents = library[section.offset:section.offset + section.size]
+            if section.addralign > 1:
+                output += bytes(-len(output) % section.addralign)
+            section.offset = len(output)
+            output += contents
+        if section.type in (SHT_SYMTAB, SHT_DYNSYM):
+            _remap_symbols(output, layout, section, index_map)
+        if section.link in index_map:
+            section.link = index_map[section.link]
+        else:
+            section.link = 0
+        if section.type in (SHT_REL, SHT_RELA) and section.info in index_map:
+            section.info = index_map[section.info]
+        kept.append(section)
+
+    output += bytes(-len(output) % 8)
+    ehdr[6] = len(output)
+    ehdr[12] = len(kept)
+    ehdr[13] = index_map[e_shstrndx]
+    layout.ehdr.pack_into(output, 0, *ehdr)
+    for section in kept:
+        output += layout.shdr.pack(*section.values())
+    return bytes(output)
+
+
+def _remap_symbols(output, layout, section, index_map):
+    for offset in range(section.offset, section.offset + section.size, layout.sym.size):
+        shndx_offset = offset + layout.sym_shndx_offset
+        shndx, = layout.shndx.unpack_from(output, shndx_offset)
+        if shndx == SHN_UNDEF or shndx >= SHN_LORESERVE:
+            continue
+        # Symbols defined in a removed section no longer have one.
+        new_shndx = index_map.get(shndx, SHN_ABS)
+        if new_shndx != shndx:
+            layout.shndx.pack_into(output, shndx_offset, new_shndx)
@@ -5,7 +5,7 @@ the references to the host objects and translates the functions
 annotated as ``@kernel`` when they are referenced.
 """
 
-import sys, os, re, linecache, inspect, textwrap, types as pytypes, numpy
+import sys, os, re, time, logging, linecache, inspect, textwrap, reprlib, types as pytypes, numpy
 from collections import OrderedDict, defaultdict
 
 from pythonparser import ast, algorithm, source, diagnostic, parse_buffer
@@ -19,6 +19,8 @@ from .transforms import ASTTypedRewriter, Inferencer, IntMonomorphizer, Typedtre
 from .transforms.asttyped_rewriter import LocalExtractor
 
 
+logger = logging.getLogger(__name__)
+
 class SpecializedFunction:
     def __init__(self, instance_type, host_function):
         self.instance_type = instance_type
@@ -47,6 +49,7 @@ class EmbeddingMap:
         self.module_map = {}
         self.type_map = {}
         self.function_map = {}
+        self.rpc_encoder_map = {}
 
     # Modules
     def store_module(self, module, module_type):
@@ -85,14 +88,6 @@ class EmbeddingMap:
                 n += 1
                 new_instance_type.name = "{}.{}".format(new_instance_type.name, n)
 
-    def attribute_count(self):
-        count = 0
-        for host_type in self.type_map:
-            instance_type, constructor_type = self.type_map[host_type]
-            count += len(instance_type.attributes)
-            count += len(constructor_type.attributes)
-        return count
-
     # Functions
     def store_function(self, function, ir_function_name):
         self.function_map[function] = ir_function_name
@@ -103,6 +98,16 @@ class EmbeddingMap:
     def specialize_function(self, instance_type, host_function):
         return SpecializedFunction(instance_type, host_function)
 
+    # RPC return value encoders
+    def store_rpc_encoder(self, service_id, tags, encoder):
+        self.rpc_encoder_map[(service_id, tags)] = encoder
+
+    def retrieve_rpc_encoder(self, service_id, tags):
+        return self.rpc_encoder_map[(service_id, tags)]
+
+    def has_rpc_encoder(self, service_id, tags):
+        return (service_id, tags) in self.rpc_encoder_map
+
     # Objects
     def store_object(self, obj_ref):
         obj_id = id(obj_ref)
@@ -135,6 +140,45 @@ class EmbeddingMap:
                           self.object_forward_map.values()))
 
 
+def _scalar_list_elt_type(value):
+    """Return the type of the elements of the host list ``value`` if they
+    are all numeric scalars of the same type, or ``None``."""
+    if not value:
+        return None
+    cls = value[0].__class__
+    if cls not in (bool, int, float, numpy.int32, numpy.int64):
+        return None
+    for elt in value:
+        if elt.__class__ is not cls:
+            return None
+    if cls is bool:
+        return builtins.TBool()
+    elif cls is int:
+        # The width is determined by IntMonomorphizer, as for literals.
+        return builtins.TInt()
+    elif cls is float:
+        return builtins.TFloat()
+    elif cls is numpy.int32:
+        return builtins.TInt32()
+    elif cls is numpy.int64:
+        return builtins.TInt64()
+
+
+def _scalar_array_elt_type(value):
+    """Return the type of the elements of the host array ``value`` if they
+    are numeric scalars, or ``None``."""
+    if value.ndim == 0:
+        return None
+    elif value.dtype == numpy.bool_:
+        return builtins.TBool()
+    elif value.dtype == numpy.int32:
+        return builtins.TInt32()
+    elif value.dtype == numpy.int64:
+        return builtins.TInt64()
+    elif value.dtype == numpy.float64:
+        return builtins.TFloat()
+
+
 class ASTSynthesizer:
     def __init__(self, embedding_map, value_map, quote_function=None, expanded_from=None):
         self.source = ""
@@ -214,6 +258,12 @@ class ASTSynthesizer:
             loc         = quote_loc.join(unquote_loc)
 
             return asttyped.QuoteT(value=value, type=builtins.TByteArray(), loc=loc)
+        elif isinstance(value, list) and _scalar_list_elt_type(value) is not None:
+            # Embed lists of numbers as a whole rather than element by element,
+            # so that large ones do not slow down compilation.
+            typ = builtins.TList(_scalar_list_elt_type(value))
+            return asttyped.QuoteT(value=value, type=typ,
+                                   loc=self._add(reprlib.repr(value)))
         elif isinstance(value, list):
             begin_loc = self._add("[")
             elts = []
@@ -236,6 +286,10 @@ class ASTSynthesizer:
                                    type=types.TTuple([e.type for e in elts]),
                                    begin_loc=begin_loc, end_loc=end_loc,
                                    loc=begin_loc.join(end_loc))
+        elif isinstance(value, numpy.ndarray) and _scalar_array_elt_type(value) is not None:
+            typ = builtins.TArray(_scalar_array_elt_type(value), value.ndim)
+            return asttyped.QuoteT(value=value, type=typ,
+                                   loc=self._add(reprlib.repr(value)))
         elif isinstance(value, numpy.ndarray):
             return self.call(numpy.array, [list(value)], {})
         elif inspect.isfunction(value) or inspect.ismethod(value) or \
@@ -495,6 +549,7 @@ class StitchingInferencer(Inferencer):
         self.value_map = value_map
         self.quote = quote
         self.attr_type_cache = {}
+        self.accessed_types = set()
 
     def _compute_attr_type(self, object_value, object_type, object_loc, attr_name, loc):
         if not hasattr(object_value, attr_name):
@@ -600,6 +655,7 @@ class StitchingInferencer(Inferencer):
         # that we can successfully serialize the value of the attribute we
         # are now adding at the code generation stage.
         object_type = value_node.type.find()
+        self.accessed_types.add(object_type)
         for object_value, object_loc in self.value_map[object_type]:
             attr_type_key = (id(object_value), attr_name)
             try:
@@ -639,23 +695,82 @@ class StitchingInferencer(Inferencer):
                                     loc=node.loc,
                                     self_loc=node.self_loc)
 
-class TypedtreeHasher(algorithm.Visitor):
-    def generic_visit(self, node):
-        def freeze(obj):
-            if isinstance(obj, ast.AST):
-                return self.visit(obj)
-            elif isinstance(obj, list):
-                return hash(tuple(freeze(elem) for elem in obj))
-            elif isinstance(obj, types.Type):
-                return hash(obj.find())
-            else:
-                # We don't care; only types change during inference.
-                pass
+class TypeVariableCollector(algorithm.Visitor):
+    """Collects the type variables that are still free in a typed tree."""
 
+    def __init__(self):
+        self.type_vars = []
+        self.node_count = 0
+
+    def _collect(self, type_vars, typ):
+        if isinstance(typ, types.TVar):
+            type_vars.append(typ)
+        return type_vars
+
+    def generic_visit(self, node):
+        self.node_count += 1
         fields = node._fields
         if hasattr(node, '_types'):
             fields = fields + node._types
-        return hash(tuple(freeze(getattr(node, field_name)) for field_name in fields))
+        for field_name in fields:
+            obj = getattr(node, field_name)
+            if isinstance(obj, types.Type):
+                obj.fold(self.type_vars, self._collect)
+            else:
+                self.visit(obj)
+
+    def visit_QuoteT(self, node):
+        # Only the type of a quoted value can change, and the value may be
+        # a large list.
+        self.node_count += 1
+        node.type.fold(self.type_vars, self._collect)
+
+def _clone_ast(node):
+    # Locations are never mutated, so they are shared with the original.
+    if isinstance(node, ast.AST):
+        return node.__class__(**{name: _clone_ast(value)
+                                 for name, value in node.__dict__.items()})
+    elif isinstance(node, list):
+        return [_clone_ast(elt) for elt in node]
+    else:
+        return node
+
+class FunctionParseCache:
+    """
+    Memoizes the untyped ASTs of embedded functions, so that the functions
+    shared by many kernels (e.g. device drivers) are only located and parsed
+    once per process.
+
+    Functions defined in files are identified by their code object, file name
+    and the modification time of the file; functions given as source code,
+    by that source code.
+
+    :param max_entries: maximum number of ASTs kept; the least recently
+        used ones are evicted first.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return a copy of the AST stored under ``key``, or ``None``."""
+        node = self.entries.get(key)
+        if node is None:
+            return None
+        self.entries.move_to_end(key)
+        return _clone_ast(node)
+
+    def put(self, key, node):
+        """Store a copy of ``node`` under ``key``."""
+        self.entries[key] = _clone_ast(node)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+# Shared by every Stitcher in the process.
+function_parse_cache = FunctionParseCache()
 
 class Stitcher:
     def __init__(self, core, dmgr, engine=None, print_as_rpc=True):
@@ -695,20 +810,43 @@ class Stitcher:
         inferencer = StitchingInferencer(engine=self.engine,
                                          value_map=self.value_map,
                                          quote=self._quote)
-        typedtree_hasher = TypedtreeHasher()
 
-        # Iterate inference to fixed point.
-        old_typedtree_hash = None
-        old_attr_count = None
+        # Iterate inference to fixed point. Inferring a function only depends on
+        # the types it shares with the rest of the program and on the host objects
+        # whose attributes it accesses, so after the first pass, only the functions
+        # for which one of those has changed since they were last visited (and
+        # the functions quoted in the meantime) are inferred again.
+        dependencies = {}
+        pass_number = 0
         while True:
-            inferencer.visit(self.typedtree)
-            typedtree_hash = typedtree_hasher.visit(self.typedtree)
-            attr_count = self.embedding_map.attribute_count()
-
-            if old_typedtree_hash == typedtree_hash and old_attr_count == attr_count:
+            worklist = [node for node in self.typedtree
+                        if id(node) not in dependencies or
+                            self._is_inference_stale(*dependencies[id(node)])]
+            if not worklist:
                 break
-            old_typedtree_hash = typedtree_hash
-            old_attr_count = attr_count
+
+            pass_number += 1
+            pass_start = time.monotonic()
+            node_count = 0
+            for node in worklist:
+                # The variables that are resolved while the function is being inferred
+                # are dependencies too, since parts of it may have been visited earlier.
+                collector = TypeVariableCollector()
+                collector.visit(node)
+                type_vars = collector.type_vars
+
+                inferencer.accessed_types = set()
+                inferencer.visit(node)
+
+                collector = TypeVariableCollector()
+                collector.visit(node)
+                node_count += collector.node_count
+                dependencies[id(node)] = (
+                    type_vars + collector.type_vars,
+                    {typ: self._host_type_state(typ) for typ in inferencer.accessed_types})
+            logger.debug("inference pass %d: %d of %d functions, %d nodes, %.3f s",
+                         pass_number, len(worklist), len(self.typedtree), node_count,
+                         time.monotonic() - pass_start)
 
         # After we've discovered every referenced attribute, check if any kernel_invariant
         # specifications refers to ones we didn't encounter.
@@ -744,6 +882,20 @@ class Stitcher:
             typing_env=self.globals, globals_in_scope=set(),
             body=self.typedtree, loc=source.Range(source_buffer, 0, 0))
 
+    def _host_type_state(self, typ):
+        return len(self.value_map[typ]), len(getattr(typ, "attributes", ()))
+
+    def _is_inference_stale(self, type_vars, host_type_states):
+        # Unifying two type variables does not give the inferencer anything new
+        # to work with, and happens on every visit, so only resolved ones count.
+        for type_var in type_vars:
+            if not types.is_var(type_var):
+                return True
+        for typ, state in host_type_states.items():
+            if self._host_type_state(typ) != state:
+                return True
+        return False
+
     def _inject(self, node):
         self.typedtree.insert(self.inject_at, node)
         self.inject_at += 1
@@ -856,7 +1008,8 @@ class Stitcher:
             module_name = "__eval_{}".format(id(host_function))
             first_line = 1
         else:
-            source_code = inspect.getsource(embedded_function)
+            # Only retrieved if the function has not been parsed yet.
+            source_code = None
             filename = embedded_function.__code__.co_filename
             module_name = embedded_function.__globals__['__name__']
             first_line = embedded_function.__code__.co_firstlineno
@@ -896,20 +1049,9 @@ class Stitcher:
         cell_names = embedded_function.__code__.co_freevars
         host_environment.update({var: cells[index] for index, var in enumerate(cell_names)})
 
-        # Find out how indented we are.
-        initial_whitespace = re.search(r"^\s*", source_code).group(0)
-        initial_indent = len(initial_whitespace.expandtabs())
-
         # Parse.
-        source_buffer = source.Buffer(source_code, filename, first_line)
-        lexer = source_lexer.Lexer(source_buffer, version=sys.version_info[0:2],
-                                   diagnostic_engine=self.engine)
-        lexer.indent = [(initial_indent,
-                         source.Range(source_buffer, 0, len(initial_whitespace)),
-                         initial_whitespace)]
-        parser = source_parser.Parser(lexer, version=sys.version_info[0:2],
-                                      diagnostic_engine=self.engine)
-        function_node = parser.file_input().body[0]
+        function_node = self._parse_embedded_function(embedded_function, source_code,
+                                                      filename, first_line)
 
         # Mangle the name, since we put everything into a single module.
         full_function_name = "{}.{}".format(module_name, host_function.__qualname__)
@@ -944,6 +1086,41 @@ class Stitcher:
 
         return function_node
 
+    def _parse_embedded_function(self, function, source_code, filename, first_line):
+        if source_code is None:
+            try:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
+                mtime = None
+            cache_key = (function.__code__, filename, mtime)
+        else:
+            cache_key = source_code
+
+        function_node = function_parse_cache.get(cache_key)
+        if function_node is not None:
+            return function_node
+
+        if source_code is None:
+            linecache.checkcache(filename)
+            source_code = inspect.getsource(function)
+
+        # Find out how indented we are.
+        initial_whitespace = re.search(r"^\s*", source_code).group(0)
+        initial_indent = len(initial_whitespace.expandtabs())
+
+        source_buffer = source.Buffer(source_code, filename, first_line)
+        lexer = source_lexer.Lexer(source_buffer, version=sys.version_info[0:2],
+                                   diagnostic_engine=self.engine)
+        lexer.indent = [(initial_indent,
+                         source.Range(source_buffer, 0, len(initial_whitespace)),
+                         initial_whitespace)]
+        parser = source_parser.Parser(lexer, version=sys.version_info[0:2],
+                                      diagnostic_engine=self.engine)
+        function_node = parser.file_input().body[0]
+
+        function_parse_cache.put(cache_key, function_node)
+        return function_node
+
     def _extract_annot(self, function, annot, kind, call_loc, fn_kind):
         if annot is None:
             annot = builtins.TNone()
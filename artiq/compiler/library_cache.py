@@ -0,0 +1,148 @@
+"""
+The :class:`LibraryCache` class memoizes the shared libraries produced
+by a :class:`artiq.compiler.targets.Target` for a given module.
+
+Libraries are identified by a digest of the unoptimized LLVM IR of
+the module, the target description and the compiler version. The LLVM IR
+(unlike the typed tree) also captures the values of every host object
+embedded into the kernel, so two modules with the same digest always
+produce the same library. On a hit, LLVM optimization, code generation,
+linking and stripping are skipped entirely.
+
+Entries are kept in memory and, optionally, in a directory on disk
+so that they survive across worker processes. Both levels are bounded
+and evict the least recently used entries first.
+"""
+
+import os, tempfile, hashlib, logging
+from collections import OrderedDict
+
+from artiq import __version__ as artiq_version
+
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryCache:
+    """
+    :param directory: directory where libraries are persisted, or ``None``
+        to keep them only in memory.
+    :param max_entries: maximum number of libraries kept in memory.
+    :param max_disk_entries: maximum number of libraries kept in ``directory``.
+    """
+    def __init__(self, directory=None, max_entries=32, max_disk_entries=1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, target, llvm_ir):
+        """Return the cache key of ``llvm_ir`` compiled for ``target``."""
+        hasher = hashlib.sha256()
+        for part in (artiq_version, type(target).__name__, target.triple,
+                     target.data_layout, ",".join(target.features)):
+            hasher.update(part.encode("utf-8"))
+            hasher.update(b"\x00")
+        hasher.update(llvm_ir.encode("utf-8"))
+        return hasher.hexdigest()
+
+    def _paths(self, key):
+        return (os.path.join(self.directory, key + ".elf"),
+                os.path.join(self.directory, key + ".stripped.elf"))
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        paths = self._paths(key)
+        try:
+            entry = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    entry.append(f.read())
+        except OSError:
+            return None
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return tuple(entry)
+
+    def _store(self, key, entry):
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for path, data in zip(self._paths(key), entry):
+                fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            self._evict_disk(keep=key)
+        except OSError:
+            logger.warning("cannot write kernel library cache entry in %s",
+                           self.directory, exc_info=True)
+
+    def _evict_disk(self, keep):
+        keys = dict()
+        for de in os.scandir(self.directory):
+            if de.name.endswith(".stripped.elf") and de.name != keep + ".stripped.elf":
+                keys[de.name[:-len(".stripped.elf")]] = de.stat().st_mtime
+        excess = len(keys) + 1 - self.max_disk_entries
+        if excess <= 0:
+            return
+        for key in sorted(keys, key=keys.get)[:excess]:
+            for path in self._paths(key):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def get(self, key):
+        """Return the ``(library, stripped_library)`` pair stored under ``key``,
+        or ``None``."""
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+        else:
+            self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, key, entry):
+        """Store the ``(library, stripped_library)`` pair under ``key``."""
+        self._remember(key, entry)
+        self._store(key, entry)
+
+    def compile_and_link(self, target, module):
+        """Return the linked and the stripped library for ``module``, compiling
+        and linking it for ``target`` only if it is not cached yet."""
+        llvm_ir = target.emit_llvm_ir(module)
+        key = self.digest(target, llvm_ir)
+        entry = self.get(key)
+        if entry is None:
+            library = target.link([target.assemble(target.compile_llvm_ir(llvm_ir))])
+            entry = library, target.strip(library)
+            self.put(key, entry)
+            logger.debug("kernel library cache miss: %s", key)
+        else:
+            logger.debug("kernel library cache hit: %s", key)
+        return entry
+
+    def clear(self):
+        """Forget every in-memory entry and reset the hit/miss counters."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
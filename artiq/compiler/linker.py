@@ -0,0 +1,867 @@
+"""
+In-process linking of the relocatable objects produced by the compiler
+into shared libraries for the OpenRISC kernel loader.
+
+:func:`link` produces the kind of library that ``ld -shared --eh-frame-hdr -x``
+produces from a single position-independent object, without writing it to
+disk and starting the linker. The library has a single loadable segment
+at address 0 that begins with the ELF and program headers, followed by
+the dynamic symbol and relocation tables, the code, the read-only data,
+the unwind tables, the dynamic section, the global offset table and the
+writable data. Calls to undefined functions go through the procedure
+linkage table, so that the kernel support code can rebind them.
+
+Inputs that :func:`link` does not handle, such as several objects, other
+machines, or relocations that would need text relocations, raise
+:class:`UnsupportedInput`; the caller then runs the external linker.
+"""
+
+import struct
+from collections import OrderedDict
+
+from artiq.compiler import elf
+
+
+class UnsupportedInput(Exception):
+    """Raised for relocatable objects that :func:`link` cannot link."""
+
+
+EM_OPENRISC = 92
+
+R_OR1K_NONE          = 0
+R_OR1K_32            = 1
+R_OR1K_16            = 2
+R_OR1K_8             = 3
+R_OR1K_INSN_REL_26   = 6
+R_OR1K_32_PCREL      = 9
+R_OR1K_16_PCREL      = 10
+R_OR1K_8_PCREL       = 11
+R_OR1K_GOTPC_HI16    = 12
+R_OR1K_GOTPC_LO16    = 13
+R_OR1K_GOT16         = 14
+R_OR1K_PLT26         = 15
+R_OR1K_GOTOFF_HI16   = 16
+R_OR1K_GOTOFF_LO16   = 17
+R_OR1K_GLOB_DAT      = 19
+R_OR1K_JMP_SLOT      = 20
+R_OR1K_RELATIVE      = 21
+
+SHF_TLS = 0x400
+
+PT_LOAD         = 1
+PT_DYNAMIC      = 2
+PT_GNU_EH_FRAME = 0x6474e550
+
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+DT_NULL     = 0
+DT_PLTRELSZ = 2
+DT_PLTGOT   = 3
+DT_HASH     = 4
+DT_STRTAB   = 5
+DT_SYMTAB   = 6
+DT_RELA     = 7
+DT_RELASZ   = 8
+DT_RELAENT  = 9
+DT_STRSZ    = 10
+DT_SYMENT   = 11
+DT_PLTREL   = 20
+DT_JMPREL   = 23
+
+DW_EH_PE_absptr  = 0x00
+DW_EH_PE_udata4  = 0x03
+DW_EH_PE_sdata4  = 0x0b
+DW_EH_PE_pcrel   = 0x10
+DW_EH_PE_datarel = 0x30
+
+_EHDR = struct.Struct(">16sHHIIIIIHHHHHH")
+_PHDR = struct.Struct(">IIIIIIII")
+_SHDR = struct.Struct(">IIIIIIIIII")
+_SYM  = struct.Struct(">IIIBBH")
+_RELA = struct.Struct(">IIi")
+_DYN  = struct.Struct(">Ii")
+_WORD = struct.Struct(">I")
+
+# The PLT of binutils for position-independent OpenRISC code, which expects
+# the address of the GOT in r16.
+_PLT0 = (0x85900004,   # l.lwz r12, 4(r16)
+         0x85f00008,   # l.lwz r15, 8(r16)
+         0x44007800,   # l.jr  r15
+         0x15000000,   # l.nop
+         0x15000000)   # l.nop
+_PLT_ENTRY_SIZE = 20
+_GOT_RESERVED = 3
+
+# Input sections are merged into the output section named by their prefix.
+_OUTPUT_SECTIONS = (".text", ".rodata", ".gcc_except_table", ".eh_frame",
+                    ".data.rel.ro", ".data", ".sdata", ".bss", ".sbss")
+
+# The hash table sizes of binutils.
+_HASH_BUCKETS = (1, 3, 17, 37, 67, 97, 131, 197, 263, 521, 1031, 2053, 4099,
+                 8209, 16411, 32771)
+
+_LINKER_SYMBOLS = ("__bss_start", "_edata", "_end")
+
+_DISCARDED = object()
+
+
+def _align(value, alignment):
+    alignment = max(alignment, 1)
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _elf_hash(name):
+    value = 0
+    for char in name:
+        value = ((value << 4) + char) & 0xffffffff
+        high = value & 0xf0000000
+        if high:
+            value ^= high >> 24
+        value &= ~high
+    return value
+
+
+def _hash_buckets(count):
+    buckets = _HASH_BUCKETS[0]
+    for size in _HASH_BUCKETS[1:]:
+        if count < size:
+            break
+        buckets = size
+    return buckets
+
+
+def _uleb(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def _fits(value, bits):
+    # Fields that are not branch offsets hold signed or unsigned values.
+    return -(1 << (bits - 1)) <= value < (1 << bits)
+
+
+class _OutputSection:
+    def __init__(self, name, type, flags):
+        self.name = name
+        self.type = type
+        self.flags = flags
+        self.align = 1
+        self.size = 0
+        self.addr = 0
+        self.offset = 0
+        self.link = 0
+        self.info = 0
+        self.entsize = 0
+        self.index = 0
+        self.data = None
+
+    def append(self, size, align):
+        self.align = max(self.align, align)
+        offset = _align(self.size, align)
+        self.size = offset + size
+        return offset
+
+    def put_word(self, offset, value):
+        _WORD.pack_into(self.data, offset, value & 0xffffffff)
+
+    def get_word(self, offset):
+        return _WORD.unpack_from(self.data, offset)[0]
+
+
+class _Linker:
+    def __init__(self, data):
+        try:
+            self.input = elf.ElfFile(data)
+        except (ValueError, IndexError, struct.error) as error:
+            raise UnsupportedInput(str(error)) from error
+        if (self.input.layout.elf_class != 1 or self.input.little_endian or
+                self.input.type != elf.ET_REL or self.input.machine != EM_OPENRISC):
+            raise UnsupportedInput("not an OpenRISC relocatable object")
+
+        # input section index -> (output section, offset in it)
+        self.placement = {}
+        self.outputs = OrderedDict()
+        self.debug_outputs = OrderedDict()
+        self.relocation_sections = []
+        self.symtab = None
+        # symbol index -> (output section or None if absolute, value),
+        # None if undefined, or _DISCARDED
+        self.locations = []
+        # undefined symbol name -> PLT entry index
+        self.plt = OrderedDict()
+        # symbol index -> GOT entry index, after the reserved and PLT entries
+        self.got = OrderedDict()
+        self.dynamic_relocation_count = 0
+        self.dynamic_symbols = []
+        self.dynamic_symbol_indices = {}
+
+    def link(self):
+        self._place_sections()
+        self._locate_symbols()
+        for index in self.relocation_sections:
+            self._scan_relocations(index)
+        self._select_dynamic_symbols()
+        self._synthesize_sections()
+        self._lay_out()
+
+        self.rela_dyn = []
+        self.rela_plt = []
+        for index in self.relocation_sections:
+            self._relocate(index)
+        self._fill_got_and_plt()
+        self._fill_dynamic_symbols()
+        self._fill_dynamic()
+        if self.eh_frame_hdr is not None:
+            self._fill_eh_frame_hdr()
+        return self._write()
+
+    # Input
+
+    def _output_name(self, section):
+        if section.type == elf.SHT_NOBITS:
+            return ".bss"
+        for prefix in _OUTPUT_SECTIONS:
+            if section.label == prefix or section.label.startswith(prefix + "."):
+                return prefix
+        return section.label
+
+    def _place_sections(self):
+        for index, section in enumerate(self.input.sections):
+            if index == 0:
+                continue
+            if section.type == elf.SHT_SYMTAB:
+                if self.symtab is not None:
+                    raise UnsupportedInput("several symbol tables")
+                self.symtab = index
+            elif section.type == elf.SHT_REL:
+                raise UnsupportedInput("relocations with implicit addend")
+            elif section.type == elf.SHT_RELA:
+                self.relocation_sections.append(index)
+            elif section.flags & elf.SHF_ALLOC:
+                if section.flags & SHF_TLS:
+                    raise UnsupportedInput("thread-local section {}".format(section.label))
+                if section.type not in (elf.SHT_PROGBITS, elf.SHT_NOBITS):
+                    raise UnsupportedInput("section {} of type {:#x}".format(
+                                           section.label, section.type))
+                name = self._output_name(section)
+                if name not in self.outputs:
+                    self.outputs[name] = _OutputSection(name, section.type, 0)
+                output = self.outputs[name]
+                if output.type != section.type:
+                    raise UnsupportedInput("section {} mixes data and zero-initialized data"
+                                           .format(name))
+                output.flags |= section.flags & (elf.SHF_WRITE | elf.SHF_ALLOC |
+                                                 elf.SHF_EXECINSTR)
+                self.placement[index] = output, output.append(section.size,
+                                                              section.addralign)
+            elif section.label.startswith(".debug"):
+                name = section.label
+                if name not in self.debug_outputs:
+                    self.debug_outputs[name] = _OutputSection(name, elf.SHT_PROGBITS, 0)
+                output = self.debug_outputs[name]
+                self.placement[index] = output, output.append(section.size,
+                                                              section.addralign)
+        for index in self.relocation_sections:
+            if self.input.sections[index].link != self.symtab:
+                raise UnsupportedInput("relocations against another symbol table")
+
+        # Tail the unwind tables with a terminator, which unwinders that do not
+        # use .eh_frame_hdr rely on.
+        if ".eh_frame" in self.outputs:
+            self.eh_frame_terminator = self.outputs[".eh_frame"].append(4, 4)
+
+    def _locate_symbols(self):
+        self.symbols = self.input.symbols(self.symtab) if self.symtab is not None else []
+        for symbol in self.symbols:
+            if symbol.shndx == elf.SHN_UNDEF:
+                location = None
+            elif symbol.shndx == elf.SHN_ABS:
+                location = None, symbol.value
+            elif symbol.shndx == elf.SHN_COMMON:
+                if ".bss" not in self.outputs:
+                    self.outputs[".bss"] = _OutputSection(
+                        ".bss", elf.SHT_NOBITS, elf.SHF_ALLOC | elf.SHF_WRITE)
+                bss = self.outputs[".bss"]
+                location = bss, bss.append(symbol.size, symbol.value)
+            elif symbol.shndx >= elf.SHN_LORESERVE:
+                raise UnsupportedInput("symbol {} in reserved section {:#x}".format(
+                                       symbol.name, symbol.shndx))
+            elif symbol.shndx in self.placement:
+                output, offset = self.placement[symbol.shndx]
+                location = output, offset + symbol.value
+            else:
+                location = _DISCARDED
+            self.locations.append(location)
+
+    def _is_global_offset_table(self, index):
+        return self.symbols[index].name == "_GLOBAL_OFFSET_TABLE_" and \
+            self.locations[index] is None
+
+    def _in_section(self, index):
+        # Whether the symbol is defined relative to the image, rather than
+        # absolute, undefined or discarded.
+        location = self.locations[index]
+        if location is None:
+            return self._is_global_offset_table(index)
+        return location is not _DISCARDED and location[0] is not None
+
+    def _scan_relocations(self, rela_index):
+        target = self.input.sections[rela_index].info
+        if target not in self.placement:
+            return
+        output, _ = self.placement[target]
+        for relocation in self.input.relocations(rela_index):
+            kind = relocation.type
+            if relocation.symbol >= len(self.locations):
+                raise UnsupportedInput("relocation against a missing symbol")
+            location = self.locations[relocation.symbol]
+            name = self.symbols[relocation.symbol].name
+            in_section = self._in_section(relocation.symbol)
+            undefined = location is None and not in_section
+
+            if kind == R_OR1K_NONE:
+                continue
+            if not output.flags & elf.SHF_ALLOC:
+                if kind not in (R_OR1K_32, R_OR1K_16, R_OR1K_8):
+                    raise UnsupportedInput("relocation type {} in a debug section"
+                                           .format(kind))
+                continue
+
+            if location is _DISCARDED:
+                raise UnsupportedInput("relocation against {} in a discarded section"
+                                       .format(name))
+            if kind == R_OR1K_32:
+                if undefined:
+                    if relocation.addend != 0:
+                        raise UnsupportedInput("relocation against {} with an addend"
+                                               .format(name))
+                    self.dynamic_relocation_count += 1
+                elif in_section:
+                    self.dynamic_relocation_count += 1
+            elif kind in (R_OR1K_INSN_REL_26, R_OR1K_PLT26):
+                if undefined:
+                    self.plt.setdefault(name, len(self.plt))
+                elif not in_section:
+                    raise UnsupportedInput("branch to absolute symbol {}".format(name))
+            elif kind == R_OR1K_GOT16:
+                if location is None and in_section:
+                    raise UnsupportedInput("GOT entry for the GOT")
+                if relocation.symbol not in self.got:
+                    self.got[relocation.symbol] = len(self.got)
+                    if undefined or in_section:
+                        self.dynamic_relocation_count += 1
+            elif kind in (R_OR1K_32_PCREL, R_OR1K_16_PCREL, R_OR1K_8_PCREL,
+                          R_OR1K_GOTPC_HI16, R_OR1K_GOTPC_LO16,
+                          R_OR1K_GOTOFF_HI16, R_OR1K_GOTOFF_LO16):
+                if not in_section:
+                    raise UnsupportedInput("relocation type {} against {}"
+                                           .format(kind, name))
+            else:
+                raise UnsupportedInput("relocation type {} in section {}"
+                                       .format(kind, output.name))
+
+    def _select_dynamic_symbols(self):
+        # Undefined symbols come first, then the symbols this library exports.
+        self.dynamic_symbols.append(None)
+        defined = set()
+        for index, symbol in enumerate(self.symbols):
+            if index == 0 or symbol.bind == elf.STB_LOCAL:
+                continue
+            if self.locations[index] is None:
+                if not self._is_global_offset_table(index):
+                    self.dynamic_symbols.append(index)
+            elif self.locations[index] is not _DISCARDED:
+                defined.add(symbol.name)
+        for index, symbol in enumerate(self.symbols):
+            if index == 0 or symbol.bind == elf.STB_LOCAL:
+                continue
+            if self.locations[index] is None or self.locations[index] is _DISCARDED:
+                continue
+            if symbol.visibility in (elf.STV_DEFAULT, elf.STV_PROTECTED) and \
+                    symbol.type not in (elf.STT_SECTION, elf.STT_FILE):
+                self.dynamic_symbols.append(index)
+        for name in _LINKER_SYMBOLS:
+            if name not in defined:
+                self.dynamic_symbols.append(name)
+
+        for dynamic_index, symbol in enumerate(self.dynamic_symbols):
+            if isinstance(symbol, int) and self.locations[symbol] is None:
+                self.dynamic_symbol_indices[self.symbols[symbol].name] = dynamic_index
+
+        self.dynstr = bytearray(b"\x00")
+        self.dynstr_offsets = []
+        for symbol in self.dynamic_symbols:
+            if symbol is None:
+                self.dynstr_offsets.append(0)
+                continue
+            name = symbol if isinstance(symbol, str) else self.symbols[symbol].name
+            self.dynstr_offsets.append(len(self.dynstr))
+            self.dynstr += name.encode("utf-8") + b"\x00"
+
+    # Layout
+
+    def _synthesize_sections(self):
+        def synthesize(name, type, flags, size, align=4, entsize=0):
+            section = _OutputSection(name, type, elf.SHF_ALLOC | flags)
+            section.append(size, align)
+            section.entsize = entsize
+            return section
+
+        symbol_count = len(self.dynamic_symbols)
+        self.nbucket = _hash_buckets(symbol_count)
+        self.hash = synthesize(".hash", elf.SHT_HASH, 0,
+                               4 * (2 + self.nbucket + symbol_count), entsize=4)
+        self.dynsym = synthesize(".dynsym", elf.SHT_DYNSYM, 0,
+                                 _SYM.size * symbol_count, entsize=_SYM.size)
+        self.dynstr_section = synthesize(".dynstr", elf.SHT_STRTAB, 0,
+                                         len(self.dynstr), align=1)
+        self.rela_dyn_section = synthesize(".rela.dyn", elf.SHT_RELA, 0,
+                                           _RELA.size * self.dynamic_relocation_count,
+                                           entsize=_RELA.size)
+        self.rela_plt_section = synthesize(".rela.plt", elf.SHT_RELA, 0,
+                                           _RELA.size * len(self.plt), entsize=_RELA.size)
+        self.plt_section = synthesize(".plt", elf.SHT_PROGBITS, elf.SHF_EXECINSTR,
+                                      _PLT_ENTRY_SIZE * (1 + len(self.plt)))
+        self.got_section = synthesize(".got", elf.SHT_PROGBITS, elf.SHF_WRITE,
+                                      4 * (_GOT_RESERVED + len(self.plt) + len(self.got)),
+                                      entsize=4)
+
+        self.eh_frame_hdr = None
+        if ".eh_frame" in self.outputs:
+            fde_count = 0
+            for index, (output, _) in self.placement.items():
+                if output.name == ".eh_frame":
+                    contents = self.input.contents(index)
+                    fde_count += sum(1 for _, cie_id in self._eh_frame_entries(contents)
+                                     if cie_id != 0)
+            self.eh_frame_hdr = synthesize(".eh_frame_hdr", elf.SHT_PROGBITS, 0,
+                                           12 + 8 * fde_count)
+
+        self.dynamic_tags = [DT_HASH, DT_STRTAB, DT_SYMTAB, DT_STRSZ, DT_SYMENT]
+        if self.plt:
+            self.dynamic_tags += [DT_PLTGOT, DT_PLTRELSZ, DT_PLTREL, DT_JMPREL]
+        if self.dynamic_relocation_count:
+            self.dynamic_tags += [DT_RELA, DT_RELASZ, DT_RELAENT]
+        self.dynamic_tags.append(DT_NULL)
+        self.dynamic = synthesize(".dynamic", elf.SHT_DYNAMIC, elf.SHF_WRITE,
+                                  _DYN.size * len(self.dynamic_tags), entsize=_DYN.size)
+
+    def _lay_out(self):
+        def group(section):
+            if section.type == elf.SHT_NOBITS:
+                return 3
+            elif section.flags & elf.SHF_EXECINSTR:
+                return 0
+            elif not section.flags & elf.SHF_WRITE:
+                return 1
+            else:
+                return 2
+
+        inputs = sorted(self.outputs.values(), key=group)
+        self.loaded = [self.hash, self.dynsym, self.dynstr_section]
+        if self.dynamic_relocation_count:
+            self.loaded.append(self.rela_dyn_section)
+        if self.plt:
+            self.loaded.append(self.rela_plt_section)
+        self.loaded += [section for section in inputs if group(section) == 0]
+        if self.plt:
+            self.loaded.append(self.plt_section)
+        self.loaded += [section for section in inputs if group(section) == 1]
+        if self.eh_frame_hdr is not None:
+            self.loaded.append(self.eh_frame_hdr)
+        self.loaded += [self.dynamic, self.got_section]
+        self.loaded += [section for section in inputs if group(section) >= 2]
+
+        self.phnum = 3 if self.eh_frame_hdr is not None else 2
+        address = _EHDR.size + _PHDR.size * self.phnum
+        self.file_size = address
+        for section in self.loaded:
+            address = _align(address, section.align)
+            section.addr = section.offset = address
+            address += section.size
+            if section.type != elf.SHT_NOBITS:
+                self.file_size = address
+        self.memory_size = address
+
+        for section in self.loaded + list(self.debug_outputs.values()):
+            if section.type != elf.SHT_NOBITS:
+                section.data = bytearray(section.size)
+        for index, (output, offset) in self.placement.items():
+            if output.data is not None:
+                contents = self.input.contents(index)
+                output.data[offset:offset + len(contents)] = contents
+
+        for index, section in enumerate(self.loaded):
+            section.index = 1 + index
+        for index, section in enumerate(self.debug_outputs.values()):
+            section.index = 1 + len(self.loaded) + index
+
+    # Relocation
+
+    def _address(self, index):
+        if self._is_global_offset_table(index):
+            return self.got_section.addr
+        location = self.locations[index]
+        if location is None or location is _DISCARDED:
+            return 0
+        output, value = location
+        if output is None:
+            return value
+        return output.addr + value
+
+    def _got_offset(self, index):
+        return 4 * (_GOT_RESERVED + len(self.plt) + self.got[index])
+
+    def _put_field(self, output, offset, kind, value):
+        if kind in (R_OR1K_32, R_OR1K_32_PCREL):
+            output.put_word(offset, value)
+        elif kind in (R_OR1K_16, R_OR1K_16_PCREL):
+            if not _fits(value, 16):
+                raise UnsupportedInput("relocation out of range")
+            struct.pack_into(">H", output.data, offset, value & 0xffff)
+        elif kind in (R_OR1K_8, R_OR1K_8_PCREL):
+            if not _fits(value, 8):
+                raise UnsupportedInput("relocation out of range")
+            output.data[offset] = value & 0xff
+        elif kind in (R_OR1K_INSN_REL_26, R_OR1K_PLT26):
+            if value & 3 or not -(1 << 25) <= value >> 2 < (1 << 25):
+                raise UnsupportedInput("branch out of range")
+            output.put_word(offset, (output.get_word(offset) & 0xfc000000) |
+                                    ((value >> 2) & 0x03ffffff))
+        elif kind in (R_OR1K_GOTPC_HI16, R_OR1K_GOTOFF_HI16):
+            output.put_word(offset, (output.get_word(offset) & 0xffff0000) |
+                                    ((value >> 16) & 0xffff))
+        elif kind in (R_OR1K_GOTPC_LO16, R_OR1K_GOTOFF_LO16):
+            output.put_word(offset, (output.get_word(offset) & 0xffff0000) |
+                                    (value & 0xffff))
+        elif kind == R_OR1K_GOT16:
+            if not -0x8000 <= value < 0x8000:
+                raise UnsupportedInput("GOT too large")
+            output.put_word(offset, (output.get_word(offset) & 0xffff0000) |
+                                    (value & 0xffff))
+
+    def _relocate(self, rela_index):
+        target = self.input.sections[rela_index].info
+        if target not in self.placement:
+            return
+        output, base = self.placement[target]
+        for relocation in self.input.relocations(rela_index):
+            kind = relocation.type
+            if kind == R_OR1K_NONE:
+                continue
+            offset = base + relocation.offset
+            place = output.addr + offset
+            addend = relocation.addend
+            symbol = self._address(relocation.symbol)
+            in_section = self._in_section(relocation.symbol)
+            undefined = self.locations[relocation.symbol] is None and not in_section
+
+            if kind == R_OR1K_32 and output.flags & elf.SHF_ALLOC:
+                name = self.symbols[relocation.symbol].name
+                if undefined:
+                    self.rela_dyn.append((place, self.dynamic_symbol_indices[name],
+                                          R_OR1K_32, 0))
+                    value = 0
+                else:
+                    value = symbol + addend
+                    if in_section:
+                        self.rela_dyn.append((place, 0, R_OR1K_RELATIVE, value))
+            elif kind in (R_OR1K_32, R_OR1K_16, R_OR1K_8):
+                value = symbol + addend
+            elif kind in (R_OR1K_INSN_REL_26, R_OR1K_PLT26):
+                if undefined:
+                    name = self.symbols[relocation.symbol].name
+                    symbol = self.plt_section.addr + \
+                        _PLT_ENTRY_SIZE * (1 + self.plt[name])
+                value = symbol + addend - place
+            elif kind == R_OR1K_GOT16:
+                value = self._got_offset(relocation.symbol) + addend
+            elif kind in (R_OR1K_GOTOFF_HI16, R_OR1K_GOTOFF_LO16):
+                value = symbol + addend - self.got_section.addr
+            else:
+                value = symbol + addend - place
+            self._put_field(output, offset, kind, value)
+
+    # Dynamic linking tables
+
+    def _fill_got_and_plt(self):
+        got, plt = self.got_section, self.plt_section
+        got.put_word(0, self.dynamic.addr)
+
+        if self.plt:
+            for offset, word in enumerate(_PLT0):
+                plt.put_word(4 * offset, word)
+        for name, index in self.plt.items():
+            got_offset = 4 * (_GOT_RESERVED + index)
+            entry = _PLT_ENTRY_SIZE * (1 + index)
+            for offset, word in enumerate((
+                    0x85900000 | got_offset,              # l.lwz r12, got_offset(r16)
+                    0xa9600000 | (_RELA.size * index),    # l.ori r11, r0, reloc_offset
+                    0x44006000,                           # l.jr  r12
+                    0x15000000,                           # l.nop
+                    0x15000000)):                         # l.nop
+                plt.put_word(entry + 4 * offset, word)
+            got.put_word(got_offset, plt.addr)
+            self.rela_plt.append((got.addr + got_offset, self.dynamic_symbol_indices[name],
+                                  R_OR1K_JMP_SLOT, 0))
+
+        for index in self.got:
+            got_offset = self._got_offset(index)
+            location = self.locations[index]
+            if location is None:
+                name = self.symbols[index].name
+                self.rela_dyn.append((got.addr + got_offset,
+                                      self.dynamic_symbol_indices[name], R_OR1K_GLOB_DAT, 0))
+            else:
+                value = self._address(index)
+                got.put_word(got_offset, value)
+                if location[0] is not None:
+                    self.rela_dyn.append((got.addr + got_offset, 0, R_OR1K_RELATIVE, value))
+
+        for section, relocations in ((self.rela_dyn_section, self.rela_dyn),
+                                     (self.rela_plt_section, self.rela_plt)):
+            assert len(relocations) * _RELA.size == section.size
+            for index, (offset, symbol, kind, addend) in enumerate(relocations):
+                _RELA.pack_into(section.data, index * _RELA.size,
+                                offset, (symbol << 8) | kind, addend)
+
+    def _section_at(self, address):
+        index = self.loaded[0].index
+        for section in self.loaded:
+            if section.addr <= address:
+                index = section.index
+        return index
+
+    def _fill_dynamic_symbols(self):
+        bss_start = self.file_size
+        for section in self.loaded:
+            if section.type == elf.SHT_NOBITS:
+                bss_start = section.addr
+                break
+        linker_symbols = {
+            "__bss_start": bss_start,
+            "_edata":      self.file_size,
+            "_end":        self.memory_size,
+        }
+
+        self.dynamic_symbol_entries = []
+        for symbol, name_offset in zip(self.dynamic_symbols, self.dynstr_offsets):
+            if symbol is None:
+                entry = (0, 0, 0, 0, 0, 0)
+            elif isinstance(symbol, str):
+                value = linker_symbols[symbol]
+                entry = (name_offset, value, 0, (elf.STB_GLOBAL << 4) | elf.STT_NOTYPE,
+                         elf.STV_DEFAULT, self._section_at(value))
+            else:
+                input_symbol = self.symbols[symbol]
+                location = self.locations[symbol]
+                info = (input_symbol.bind << 4) | input_symbol.type
+                if location is None:
+                    entry = (name_offset, 0, 0, info, input_symbol.visibility, elf.SHN_UNDEF)
+                elif location[0] is None:
+                    entry = (name_offset, location[1], input_symbol.size, info,
+                             input_symbol.visibility, elf.SHN_ABS)
+                else:
+                    entry = (name_offset, self._address(symbol), input_symbol.size, info,
+                             input_symbol.visibility, location[0].index)
+            self.dynamic_symbol_entries.append(entry)
+
+        for index, entry in enumerate(self.dynamic_symbol_entries):
+            _SYM.pack_into(self.dynsym.data, index * _SYM.size, *entry)
+        self.dynstr_section.data[:] = self.dynstr
+
+        symbol_count = len(self.dynamic_symbols)
+        buckets = [0] * self.nbucket
+        chains = [0] * symbol_count
+        for index in range(1, symbol_count):
+            name_offset = self.dynstr_offsets[index]
+            name = self.dynstr[name_offset:self.dynstr.index(b"\x00", name_offset)]
+            bucket = _elf_hash(name) % self.nbucket
+            chains[index] = buckets[bucket]
+            buckets[bucket] = index
+        struct.pack_into(">{}I".format(2 + self.nbucket + symbol_count), self.hash.data, 0,
+                         self.nbucket, symbol_count, *(buckets + chains))
+
+    def _fill_dynamic(self):
+        values = {
+            DT_HASH:     self.hash.addr,
+            DT_STRTAB:   self.dynstr_section.addr,
+            DT_SYMTAB:   self.dynsym.addr,
+            DT_STRSZ:    self.dynstr_section.size,
+            DT_SYMENT:   _SYM.size,
+            DT_PLTGOT:   self.got_section.addr,
+            DT_PLTRELSZ: self.rela_plt_section.size,
+            DT_PLTREL:   DT_RELA,
+            DT_JMPREL:   self.rela_plt_section.addr,
+            DT_RELA:     self.rela_dyn_section.addr,
+            DT_RELASZ:   self.rela_dyn_section.size,
+            DT_RELAENT:  _RELA.size,
+            DT_NULL:     0,
+        }
+        for index, tag in enumerate(self.dynamic_tags):
+            _DYN.pack_into(self.dynamic.data, index * _DYN.size, tag, values[tag])
+
+    # Unwind tables
+
+    def _eh_frame_entries(self, data, end=None):
+        offset = 0
+        end = len(data) if end is None else end
+        while offset + 8 <= end:
+            length, cie_id = struct.unpack_from(">II", data, offset)
+            if length == 0:
+                break
+            if length == 0xffffffff:
+                raise UnsupportedInput("64-bit unwind tables")
+            yield offset, cie_id
+            offset += 4 + length
+
+    def _fde_encoding(self, data, offset):
+        position = offset + 8
+        version = data[position]
+        end = data.index(b"\x00", position + 1)
+        augmentation = bytes(data[position + 1:end])
+        _, position = _uleb(data, end + 1)  # code alignment factor
+        _, position = _uleb(data, position)  # data alignment factor
+        if version == 1:
+            position += 1
+        else:
+            _, position = _uleb(data, position)  # return address register
+        encoding = DW_EH_PE_absptr
+        if augmentation[:1] != b"z":
+            if augmentation:
+                raise UnsupportedInput("unwind augmentation {}".format(augmentation))
+            return encoding
+        _, position = _uleb(data, position)
+        for char in augmentation[1:].decode("ascii", "replace"):
+            if char == "R":
+                encoding = data[position]
+                position += 1
+            elif char == "P":
+                personality_encoding = data[position]
+                if personality_encoding & 0x0f not in (DW_EH_PE_absptr, DW_EH_PE_udata4,
+                                                       DW_EH_PE_sdata4) or \
+                        personality_encoding & 0x70 not in (0, DW_EH_PE_pcrel):
+                    raise UnsupportedInput("personality encoding {:#x}"
+                                           .format(personality_encoding))
+                position += 5
+            elif char == "L":
+                position += 1
+            elif char not in "SB":
+                raise UnsupportedInput("unwind augmentation {}".format(augmentation))
+        return encoding
+
+    def _fill_eh_frame_hdr(self):
+        eh_frame = self.outputs[".eh_frame"]
+        table = []
+        encodings = {}
+        for offset, cie_id in self._eh_frame_entries(eh_frame.data, self.eh_frame_terminator):
+            if cie_id == 0:
+                encodings[offset] = self._fde_encoding(eh_frame.data, offset)
+                continue
+            cie = offset + 4 - cie_id
+            if cie not in encodings:
+                raise UnsupportedInput("FDE without a CIE")
+            encoding = encodings[cie]
+            if encoding & 0x0f not in (DW_EH_PE_absptr, DW_EH_PE_udata4, DW_EH_PE_sdata4) \
+                    or encoding & 0xf0 not in (0, DW_EH_PE_pcrel):
+                raise UnsupportedInput("FDE encoding {:#x}".format(encoding))
+            pc_begin = eh_frame.get_word(offset + 8)
+            if encoding & 0xf0 == DW_EH_PE_pcrel:
+                pc_begin = (pc_begin + eh_frame.addr + offset + 8) & 0xffffffff
+            table.append((pc_begin, eh_frame.addr + offset))
+        table.sort()
+
+        hdr = self.eh_frame_hdr
+        assert 12 + 8 * len(table) == hdr.size
+        struct.pack_into(">BBBBiI", hdr.data, 0,
+                         1, DW_EH_PE_pcrel | DW_EH_PE_sdata4, DW_EH_PE_udata4,
+                         DW_EH_PE_datarel | DW_EH_PE_sdata4,
+                         eh_frame.addr - (hdr.addr + 4), len(table))
+        for index, (pc_begin, fde) in enumerate(table):
+            struct.pack_into(">ii", hdr.data, 12 + 8 * index,
+                             pc_begin - hdr.addr, fde - hdr.addr)
+
+    # Output
+
+    def _write(self):
+        symtab = _OutputSection(".symtab", elf.SHT_SYMTAB, 0)
+        symtab.data = bytes(self.dynsym.data)
+        symtab.entsize = _SYM.size
+        symtab.info = 1
+        symtab.align = 4
+        strtab = _OutputSection(".strtab", elf.SHT_STRTAB, 0)
+        strtab.data = bytes(self.dynstr)
+        shstrtab = _OutputSection(".shstrtab", elf.SHT_STRTAB, 0)
+
+        unloaded = list(self.debug_outputs.values()) + [symtab, strtab, shstrtab]
+        sections = self.loaded + unloaded
+        for index, section in enumerate(unloaded):
+            section.index = 1 + len(self.loaded) + index
+        self.hash.link = self.dynsym.index
+        self.dynsym.link = self.dynstr_section.index
+        self.dynsym.info = 1
+        self.rela_dyn_section.link = self.dynsym.index
+        self.rela_plt_section.link = self.dynsym.index
+        self.rela_plt_section.info = self.got_section.index
+        self.dynamic.link = self.dynstr_section.index
+        symtab.link = strtab.index
+
+        names = bytearray(b"\x00")
+        name_offsets = {}
+        for section in sections:
+            name_offsets[section.name] = len(names)
+            names += section.name.encode("ascii") + b"\x00"
+        shstrtab.data = bytes(names)
+
+        output = bytearray(self.file_size)
+        for section in self.loaded:
+            if section.data is not None:
+                output[section.offset:section.offset + section.size] = section.data
+        for section in unloaded:
+            section.size = len(section.data)
+            section.offset = _align(len(output), section.align)
+            output += bytes(section.offset - len(output)) + section.data
+
+        shoff = _align(len(output), 4)
+        output += bytes(shoff - len(output))
+        output += bytes(_SHDR.size)
+        for section in sections:
+            output += _SHDR.pack(name_offsets[section.name], section.type, section.flags,
+                                 section.addr, section.offset, section.size,
+                                 section.link, section.info, section.align, section.entsize)
+
+        ident = b"\x7fELF" + bytes([1, 2, 1, 0, 0]) + bytes(7)
+        _EHDR.pack_into(output, 0, ident, elf.ET_DYN, EM_OPENRISC, 1, 0, _EHDR.size,
+                        shoff, self.input.flags, _EHDR.size, _PHDR.size, self.phnum,
+                        _SHDR.size, 1 + len(sections), shstrtab.index)
+        program_headers = [
+            (PT_LOAD, 0, 0, 0, self.file_size, self.memory_size, PF_R | PF_W | PF_X, 0x1000),
+            (PT_DYNAMIC, self.dynamic.offset, self.dynamic.addr, self.dynamic.addr,
+             self.dynamic.size, self.dynamic.size, PF_R | PF_W, 4),
+        ]
+        if self.eh_frame_hdr is not None:
+            program_headers.append(
+                (PT_GNU_EH_FRAME, self.eh_frame_hdr.offset, self.eh_frame_hdr.addr,
+                 self.eh_frame_hdr.addr, self.eh_frame_hdr.size, self.eh_frame_hdr.size,
+                 PF_R, 4))
+        for index, header in enumerate(program_headers):
+            _PHDR.pack_into(output, _EHDR.size + index * _PHDR.size, *header)
+        return bytes(output)
+
+
+def link(objects):
+    """Link the relocatable OpenRISC objects ``objects`` into a shared library.
+
+    :raise UnsupportedInput: if the objects cannot be linked in-process.
+    """
+    if len(objects) != 1:
+        raise UnsupportedInput("only a single object can be linked")
+    return _Linker(objects[0]).link()
@@ -11,6 +11,7 @@ string and infers types for it using a trivial :module:`prelude`.
 import os
 from pythonparser import source, diagnostic, parse_buffer
 from . import prelude, types, transforms, analyses, validators
+from .profiling import null_profiler, typedtree_size, artiq_ir_size
 
 class Source:
     def __init__(self, source_buffer, engine=None):
@@ -40,8 +41,10 @@ class Source:
             return cls(source.Buffer(f.read(), filename, 1), engine=engine)
 
 class Module:
-    def __init__(self, src, ref_period=1e-6, attribute_writeback=True, remarks=False):
+    def __init__(self, src, ref_period=1e-6, attribute_writeback=True, remarks=False,
+                 profiler=null_profiler):
         self.attribute_writeback = attribute_writeback
+        self.profiler = profiler
         self.engine = src.engine
         self.embedding_map = src.embedding_map
         self.name = src.name
@@ -66,23 +69,44 @@ class Module:
         interleaver = transforms.Interleaver(engine=self.engine)
         invariant_detection = analyses.InvariantDetection(engine=self.engine)
 
-        int_monomorphizer.visit(src.typedtree)
-        cast_monomorphizer.visit(src.typedtree)
-        inferencer.visit(src.typedtree)
-        monomorphism_validator.visit(src.typedtree)
-        escape_validator.visit(src.typedtree)
-        iodelay_estimator.visit_fixpoint(src.typedtree)
-        constness_validator.visit(src.typedtree)
-        devirtualization.visit(src.typedtree)
-        self.artiq_ir = artiq_ir_generator.visit(src.typedtree)
-        artiq_ir_generator.annotate_calls(devirtualization)
-        dead_code_eliminator.process(self.artiq_ir)
-        interleaver.process(self.artiq_ir)
-        local_access_validator.process(self.artiq_ir)
-        local_demoter.process(self.artiq_ir)
-        constant_hoister.process(self.artiq_ir)
+        def on_typedtree(name):
+            return profiler.measure(name, lambda: typedtree_size(src.typedtree), "nodes")
+
+        def on_artiq_ir(name):
+            return profiler.measure(name, lambda: artiq_ir_size(self.artiq_ir), "insns")
+
+        with on_typedtree("int_monomorphizer"):
+            int_monomorphizer.visit(src.typedtree)
+        with on_typedtree("cast_monomorphizer"):
+            cast_monomorphizer.visit(src.typedtree)
+        with on_typedtree("inferencer"):
+            inferencer.visit(src.typedtree)
+        with on_typedtree("monomorphism_validator"):
+            monomorphism_validator.visit(src.typedtree)
+        with on_typedtree("escape_validator"):
+            escape_validator.visit(src.typedtree)
+        with on_typedtree("iodelay_estimator"):
+            iodelay_estimator.visit_fixpoint(src.typedtree)
+        with on_typedtree("constness_validator"):
+            constness_validator.visit(src.typedtree)
+        with on_typedtree("devirtualization"):
+            devirtualization.visit(src.typedtree)
+        with on_artiq_ir("artiq_ir_generator"):
+            self.artiq_ir = artiq_ir_generator.visit(src.typedtree)
+            artiq_ir_generator.annotate_calls(devirtualization)
+        with on_artiq_ir("dead_code_eliminator"):
+            dead_code_eliminator.process(self.artiq_ir)
+        with on_artiq_ir("interleaver"):
+            interleaver.process(self.artiq_ir)
+        with on_artiq_ir("local_access_validator"):
+            local_access_validator.process(self.artiq_ir)
+        with on_artiq_ir("local_demoter"):
+            local_demoter.process(self.artiq_ir)
+        with on_artiq_ir("constant_hoister"):
+            constant_hoister.process(self.artiq_ir)
         if remarks:
-            invariant_detection.process(self.artiq_ir)
+            with on_artiq_ir("invariant_detection"):
+                invariant_detection.process(self.artiq_ir)
 
     def build_llvm_ir(self, target):
         """Compile the module to LLVM IR for the specified target."""
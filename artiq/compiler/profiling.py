@@ -0,0 +1,154 @@
+"""
+The :class:`Profiler` class records, for every pass of the compiler,
+the wall time it took, the peak amount of memory it allocated and
+the size of the intermediate representation it produced.
+
+Passes that work on the typed AST report its size in nodes, passes
+that work on ARTIQ IR in instructions, and LLVM and binutils passes
+in bytes of their textual or binary output. Peak allocation is only
+measured when requested, since tracing allocations slows the compiler
+down considerably; it only covers allocations made by the Python
+interpreter, and not those made inside LLVM or by external tools.
+"""
+
+import sys, time, tracemalloc
+from collections import namedtuple
+
+from pythonparser import algorithm
+
+
+PassProfile = namedtuple("PassProfile", "name time peak_memory ir_size ir_unit")
+
+
+class _NodeCounter(algorithm.Visitor):
+    def __init__(self):
+        self.count = 0
+
+    def generic_visit(self, node):
+        self.count += 1
+        super().generic_visit(node)
+
+    def visit_QuoteT(self, node):
+        self.count += 1
+
+
+def typedtree_size(typedtree):
+    """Return the number of nodes in ``typedtree``."""
+    counter = _NodeCounter()
+    counter.visit(typedtree)
+    return counter.count
+
+def artiq_ir_size(functions):
+    """Return the number of instructions in the ARTIQ IR ``functions``."""
+    return sum(len(block.instructions)
+               for function in functions
+               for block in function.basic_blocks)
+
+
+def _reset_peak_memory():
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.clear_traces()
+
+
+class _Measurement:
+    def __init__(self, profiler, name, ir_size, ir_unit):
+        self.profiler = profiler
+        self.name = name
+        self.ir_size = ir_size
+        self.ir_unit = ir_unit
+
+    def __enter__(self):
+        if self.profiler.trace_memory:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            else:
+                _reset_peak_memory()
+            self.base_memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        peak_memory = None
+        if self.profiler.trace_memory:
+            peak_memory = max(0, tracemalloc.get_traced_memory()[1] - self.base_memory)
+            if self.started_tracing:
+                tracemalloc.stop()
+        if exc_type is not None:
+            return
+
+        ir_size = None
+        if self.ir_size is not None:
+            ir_size = self.ir_size()
+        self.profiler.passes.append(
+            PassProfile(self.name, elapsed, peak_memory, ir_size, self.ir_unit))
+
+
+class _NullMeasurement:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class Profiler:
+    """
+    :param trace_memory: whether to measure the peak memory allocated
+        by every pass, using :mod:`tracemalloc`.
+
+    :var passes: (list of :class:`PassProfile`)
+        the passes measured so far, in the order they finished
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.passes = []
+
+    def measure(self, name, ir_size=None, ir_unit=None):
+        """
+        Return a context manager that records the pass ``name``
+        executed within it.
+
+        :param ir_size: a function returning the size of the IR
+            after the pass, in ``ir_unit``; only called when profiling.
+        """
+        return _Measurement(self, name, ir_size, ir_unit)
+
+    def total_time(self):
+        return sum(pass_profile.time for pass_profile in self.passes)
+
+    def format(self):
+        """Return a human-readable table of the measured passes."""
+        lines = ["{:<28} {:>10} {:>12} {:>16}".format(
+                    "pass", "time (ms)", "peak (KiB)", "IR size")]
+        for pass_profile in self.passes:
+            if pass_profile.peak_memory is None:
+                peak_memory = "-"
+            else:
+                peak_memory = "{:.1f}".format(pass_profile.peak_memory / 1024)
+            if pass_profile.ir_size is None:
+                ir_size = "-"
+            else:
+                ir_size = "{} {}".format(pass_profile.ir_size, pass_profile.ir_unit)
+            lines.append("{:<28} {:>10.2f} {:>12} {:>16}".format(
+                pass_profile.name, pass_profile.time * 1000, peak_memory, ir_size))
+        lines.append("{:<28} {:>10.2f}".format("total", self.total_time() * 1000))
+        return "\n".join(lines)
+
+    def dump(self, file=None):
+        if file is None:
+            file = sys.stderr
+        print("====== COMPILER PROFILE ======", file=file)
+        print(self.format(), file=file)
+
+
+class NullProfiler:
+    """A profiler that does not record anything."""
+
+    def measure(self, name, ir_size=None, ir_unit=None):
+        return _NullMeasurement()
+
+
+null_profiler = NullProfiler()
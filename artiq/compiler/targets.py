@@ -1,5 +1,6 @@
 import os, sys, tempfile, subprocess, io
-from artiq.compiler import types, ir
+from artiq.compiler import types, ir, elf, linker, dwarf
+from artiq.compiler.profiling import null_profiler
 from llvmlite_artiq import ir as ll, binding as llvm
 
 llvm.initialize()
@@ -80,6 +81,8 @@ class Target:
         determined from data_layout due to JIT.
     :var now_pinning: (boolean)
         Whether the target implements the now-pinning RTIO optimization.
+    :var profiler: (:class:`artiq.compiler.profiling.Profiler`)
+        Records the LLVM, linking and stripping passes.
     """
     triple = "unknown"
     data_layout = ""
@@ -89,22 +92,42 @@ class Target:
     now_pinning = True
 
     tool_ld = "ld.lld"
-    tool_strip = "llvm-strip"
     tool_addr2line = "llvm-addr2line"
     tool_cxxfilt = "llvm-cxxfilt"
 
-    def __init__(self):
+    # Creating LLVM target machines and pass managers is expensive, and they do
+    # not depend on the module being compiled, so they are shared by all targets
+    # with the same description for the lifetime of the process.
+    _target_machines = {}
+    _pass_managers = {}
+
+    def __init__(self, profiler=null_profiler):
         self.llcontext = ll.Context()
+        self.profiler = profiler
 
     def target_machine(self):
-        lltarget = llvm.Target.from_triple(self.triple)
-        llmachine = lltarget.create_target_machine(
-                        features=",".join(["+{}".format(f) for f in self.features]),
-                        reloc="pic", codemodel="default")
-        llmachine.set_asm_verbosity(True)
+        key = (self.triple, tuple(self.features))
+        llmachine = Target._target_machines.get(key)
+        if llmachine is None:
+            lltarget = llvm.Target.from_triple(self.triple)
+            llmachine = lltarget.create_target_machine(
+                            features=",".join(["+{}".format(f) for f in self.features]),
+                            reloc="pic", codemodel="default")
+            llmachine.set_asm_verbosity(True)
+            Target._target_machines[key] = llmachine
         return llmachine
 
+    def pass_manager(self):
+        llpassmgr = Target._pass_managers.get(type(self))
+        if llpassmgr is None:
+            llpassmgr = self.create_pass_manager()
+            Target._pass_managers[type(self)] = llpassmgr
+        return llpassmgr
+
     def optimize(self, llmodule):
+        self.pass_manager().run(llmodule)
+
+    def create_pass_manager(self):
         llpassmgr = llvm.create_module_pass_manager()
 
         # Register our alias analysis passes.
@@ -133,10 +156,10 @@ class Target:
         llpassmgr.add_dead_arg_elimination_pass()
         llpassmgr.add_global_dce_pass()
 
-        llpassmgr.run(llmodule)
+        return llpassmgr
 
-    def compile(self, module):
-        """Compile the module to a relocatable object for this target."""
+    def emit_llvm_ir(self, module):
+        """Generate the textual, unoptimized LLVM IR of the module for this target."""
 
         if os.getenv("ARTIQ_DUMP_SIG"):
             print("====== MODULE_SIGNATURE DUMP ======", file=sys.stderr)
@@ -149,19 +172,29 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_IR"), "ARTIQ IR", ".txt",
               lambda: "\n".join(fn.as_entity(type_printer) for fn in module.artiq_ir))
 
-        llmod = module.build_llvm_ir(self)
+        with self.profiler.measure("llvm_ir_generator", lambda: len(llvm_ir), "bytes"):
+            llvm_ir = str(module.build_llvm_ir(self))
+        return llvm_ir
 
+    def compile(self, module):
+        """Compile the module to a relocatable object for this target."""
+        return self.compile_llvm_ir(self.emit_llvm_ir(module))
+
+    def compile_llvm_ir(self, llvm_ir):
+        """Parse, verify and optimize textual LLVM IR for this target."""
         try:
-            llparsedmod = llvm.parse_assembly(str(llmod))
-            llparsedmod.verify()
+            with self.profiler.measure("llvm_parse"):
+                llparsedmod = llvm.parse_assembly(llvm_ir)
+                llparsedmod.verify()
         except RuntimeError:
-            _dump("", "LLVM IR (broken)", ".ll", lambda: str(llmod))
+            _dump("", "LLVM IR (broken)", ".ll", lambda: llvm_ir)
             raise
 
         _dump(os.getenv("ARTIQ_DUMP_UNOPT_LLVM"), "LLVM IR (generated)", "_unopt.ll",
               lambda: str(llparsedmod))
 
-        self.optimize(llparsedmod)
+        with self.profiler.measure("llvm_optimize", lambda: len(str(llparsedmod)), "bytes"):
+            self.optimize(llparsedmod)
 
         _dump(os.getenv("ARTIQ_DUMP_LLVM"), "LLVM IR (optimized)", ".ll",
               lambda: str(llparsedmod))
@@ -174,37 +207,62 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_ASM"), "Assembly", ".s",
               lambda: llmachine.emit_assembly(llmodule))
 
+        with self.profiler.measure("llvm_codegen", lambda: len(llobject), "bytes"):
+            llobject = llmachine.emit_object(llmodule)
+
         _dump(os.getenv("ARTIQ_DUMP_OBJ"), "Object file", ".o",
-              lambda: llmachine.emit_object(llmodule))
+              lambda: llobject)
 
-        return llmachine.emit_object(llmodule)
+        return llobject
 
     def link(self, objects):
-        """Link the relocatable objects into a shared library for this target."""
-        with RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
-                     ["{{obj{}}}".format(index) for index in range(len(objects))] +
-                     ["-x"] +
-                     ["-o", "{output}"],
-                     output=None,
-                     **{"obj{}".format(index): obj for index, obj in enumerate(objects)}) \
+        """Link the relocatable objects into a shared library for this target.
+
+        A single OpenRISC object is linked in-process by :mod:`artiq.compiler.linker`;
+        anything it does not support is linked by the target's linker."""
+        try:
+            with self.profiler.measure("link", lambda: len(library), "bytes"):
+                library = linker.link(objects)
+        except linker.UnsupportedInput:
+            library = self._link_with_tool(objects)
+
+        _dump(os.getenv("ARTIQ_DUMP_ELF"), "Shared library", ".elf",
+              lambda: library)
+
+        return library
+
+    def _link_with_tool(self, objects):
+        with self.profiler.measure(self.tool_ld, lambda: len(library), "bytes"), \
+                RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
+                        ["{{obj{}}}".format(index) for index in range(len(objects))] +
+                        ["-x"] +
+                        ["-o", "{output}"],
+                        output=None,
+                        **{"obj{}".format(index): obj for index, obj in enumerate(objects)}) \
                 as results:
             library = results["output"].read()
-
-            _dump(os.getenv("ARTIQ_DUMP_ELF"), "Shared library", ".elf",
-                  lambda: library)
-
             return library
 
     def compile_and_link(self, modules):
         return self.link([self.assemble(self.compile(module)) for module in modules])
 
+    def build_library(self, llvm_ir):
+        """Compile, link and strip textual LLVM IR for this target.
+
+        :return: a ``(library, stripped_library)`` pair.
+        """
+        library = self.link([self.assemble(self.compile_llvm_ir(llvm_ir))])
+        return library, self.strip(library)
+
     def strip(self, library):
-        with RunTool([self.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
-                     library=library, output=None) \
-                as results:
-            return results["output"].read()
+        """Remove the debug information from the shared library."""
+        with self.profiler.measure("strip", lambda: len(stripped_library), "bytes"):
+            stripped_library = elf.strip_debug(library)
+        return stripped_library
 
     def symbolize(self, library, addresses):
+        """Return the backtrace entries for the return ``addresses`` in ``library``,
+        from its DWARF debug information, with inlined frames innermost first."""
         if addresses == []:
             return []
 
@@ -212,6 +270,31 @@ class Target:
         # just after the call. Offset them back to get an address somewhere
         # inside the call instruction (or its delay slot), since that's what
         # the backtrace entry should point at.
+        try:
+            with self.profiler.measure("symbolize"):
+                debug_info = dwarf.DebugInfo(library)
+                frames = [(address, debug_info.symbolize(address - 1))
+                          for address in addresses]
+        except dwarf.UnsupportedDebugInfo:
+            return self._symbolize_with_tool(library, addresses)
+
+        backtrace = []
+        for address, inlined_frames in frames:
+            for function, filename, line in inlined_frames:
+                if filename is None or filename == "<synthesized>":
+                    continue
+                if line == 0:
+                    line = -1
+                backtrace.append((filename, line, -1, function or "??", address))
+
+        mangled = sorted({entry[3] for entry in backtrace if entry[3].startswith("_Z")})
+        if mangled:
+            demangled = dict(zip(mangled, self.demangle(mangled)))
+            backtrace = [(filename, line, column, demangled.get(function, function), address)
+                         for filename, line, column, function, address in backtrace]
+        return backtrace
+
+    def _symbolize_with_tool(self, library, addresses):
         offset_addresses = [hex(addr - 1) for addr in addresses]
         with RunTool([self.tool_addr2line, "--addresses",  "--functions", "--inlines",
                       "--demangle", "--exe={library}"] + offset_addresses,
@@ -248,8 +331,8 @@ class Target:
             return results["__stdout__"].read().rstrip().split("\n")
 
 class NativeTarget(Target):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, profiler=null_profiler):
+        super().__init__(profiler)
         self.triple = llvm.get_default_triple()
         host_data_layout = str(llvm.targets.Target.from_default_triple().create_target_machine().target_data)
         assert host_data_layout[0] in "eE"
@@ -265,7 +348,6 @@ class OR1KTarget(Target):
     now_pinning = True
 
     tool_ld = "or1k-linux-ld"
-    tool_strip = "or1k-linux-strip"
     tool_addr2line = "or1k-linux-addr2line"
     tool_cxxfilt = "or1k-linux-c++filt"
 
@@ -278,6 +360,5 @@ class CortexA9Target(Target):
     now_pinning = False
 
     tool_ld = "armv7-unknown-linux-gnueabihf-ld"
-    tool_strip = "armv7-unknown-linux-gnueabihf-strip"
     tool_addr2line = "armv7-unknown-linux-gnueabihf-addr2line"
     tool_cxxfilt = "armv7-unknown-linux-gnueabihf-c++filt"
@@ -26,3 +26,21 @@ class IntMonomorphizer(algorithm.Visitor):
                     return
 
                 node.type["width"].unify(types.TValue(width))
+
+    def visit_QuoteT(self, node):
+        # Lists of integers quoted from the host.
+        if builtins.is_list(node.type):
+            elt_type = builtins.get_iterable_elt(node.type)
+            if builtins.is_int(elt_type) and types.is_var(elt_type["width"]):
+                if all(-2**31 < elt < 2**31-1 for elt in node.value):
+                    width = 32
+                elif all(-2**63 < elt < 2**63-1 for elt in node.value):
+                    width = 64
+                else:
+                    diag = diagnostic.Diagnostic("error",
+                        "integer literal out of range for a signed 64-bit value", {},
+                        node.loc)
+                    self.engine.process(diag)
+                    return
+
+                elt_type["width"].unify(types.TValue(width))
@@ -1579,21 +1579,17 @@ class LLVMIRGenerator:
             llstr     = self.llstr_of_str(as_bytes)
             llconst   = ll.Constant(llty, [llstr, ll.Constant(lli32, len(as_bytes))])
             return llconst
+        elif builtins.is_array(typ):
+            assert isinstance(value, numpy.ndarray), fail_msg
+            assert value.ndim == typ.find()["num_dims"].value, fail_msg
+            lleltsptr = self._quote_elements(value.ravel(), typ, path)
+            llshape   = ll.Constant(llty.elements[1],
+                                    [ll.Constant(lli32, dim) for dim in value.shape])
+            return ll.Constant(llty, [lleltsptr, llshape])
         elif builtins.is_listish(typ):
             assert isinstance(value, (list, numpy.ndarray)), fail_msg
-            elt_type  = builtins.get_iterable_elt(typ)
-            llelts    = [self._quote(value[i], elt_type, lambda: path() + [str(i)])
-                         for i in range(len(value))]
-            lleltsary = ll.Constant(ll.ArrayType(self.llty_of_type(elt_type), len(llelts)),
-                                    list(llelts))
-
-            name      = self.llmodule.scope.deduplicate("quoted.{}".format(typ.name))
-            llglobal  = ll.GlobalVariable(self.llmodule, lleltsary.type, name)
-            llglobal.initializer = lleltsary
-            llglobal.linkage = "private"
-
-            lleltsptr = llglobal.bitcast(lleltsary.type.element.as_pointer())
-            llconst   = ll.Constant(llty, [lleltsptr, ll.Constant(lli32, len(llelts))])
+            lleltsptr = self._quote_elements(value, typ, path)
+            llconst   = ll.Constant(llty, [lleltsptr, ll.Constant(lli32, len(value))])
             return llconst
         elif types.is_tuple(typ):
             assert isinstance(value, tuple), fail_msg
@@ -1624,6 +1620,57 @@ class LLVMIRGenerator:
             print(typ)
             assert False, fail_msg
 
+    def _pack_elements(self, value, elt_type):
+        # Returns the memory representation of a list or array of numbers
+        # on the target, or None if value is not one.
+        if builtins.is_bool(elt_type):
+            kind, dtype = "b", "u1"
+        elif builtins.is_int(elt_type):
+            kind, dtype = "i", "i{}".format(builtins.get_int_width(elt_type) // 8)
+        elif builtins.is_float(elt_type):
+            kind, dtype = "f", "f8"
+        else:
+            return None
+        dtype = numpy.dtype(dtype).newbyteorder("<" if self.target.little_endian else ">")
+
+        if len(value) == 0:
+            return b""
+        try:
+            array = numpy.asarray(value)
+        except ValueError:
+            return None
+        if array.ndim != 1 or array.dtype.kind != kind:
+            return None
+        if kind == "i":
+            info = numpy.iinfo(dtype)
+            if not (info.min < array.min() and array.max() < info.max):
+                return None
+        return array.astype(dtype).tobytes()
+
+    def _quote_elements(self, value, typ, path):
+        # Returns a pointer to a global holding the elements of value.
+        elt_type = builtins.get_iterable_elt(typ)
+        llelty   = self.llty_of_type(elt_type)
+        data     = self._pack_elements(value, elt_type)
+        if data is not None:
+            # Emit the elements as raw bytes. The leading empty array gives
+            # the global the alignment of the elements.
+            llalignty = ll.ArrayType(llelty, 0)
+            lldataty  = ll.ArrayType(lli8, len(data))
+            lleltsary = ll.Constant(ll.LiteralStructType([llalignty, lldataty]),
+                                    [ll.Constant(llalignty, None),
+                                     ll.Constant(lldataty, bytearray(data))])
+        else:
+            llelts    = [self._quote(value[i], elt_type, lambda: path() + [str(i)])
+                         for i in range(len(value))]
+            lleltsary = ll.Constant(ll.ArrayType(llelty, len(llelts)), llelts)
+
+        name      = self.llmodule.scope.deduplicate("quoted.{}".format(typ.name))
+        llglobal  = ll.GlobalVariable(self.llmodule, lleltsary.type, name)
+        llglobal.initializer = lleltsary
+        llglobal.linkage = "private"
+        return llglobal.bitcast(llelty.as_pointer())
+
     def process_Quote(self, insn):
         assert self.embedding_map is not None
         return self._quote(insn.value, insn.type, lambda: [repr(insn.value)])
@@ -0,0 +1,100 @@
+"""Buffered socket transport for the core device protocols.
+
+Incoming data is received with ``recv_into`` into a fixed receive buffer
+and handed out as :class:`memoryview` slices of it, so that fixed-size
+fields are decoded in place and a message made of many small values only
+costs a few system calls. Outgoing data is accumulated and sent with a
+single ``sendall`` when the protocol reaches a message boundary.
+"""
+
+
+class BufferedSocket:
+    def __init__(self, socket, buffer_size=65536):
+        self.socket = socket
+        self._read_buffer = bytearray(buffer_size)
+        self._read_view = memoryview(self._read_buffer)
+        self._read_start = 0
+        self._read_end = 0
+        self._write_buffer = bytearray()
+        self._write_threshold = buffer_size
+
+    def close(self):
+        self._write_buffer.clear()
+        self.socket.close()
+
+    #
+    # Reader interface
+    #
+
+    def _recv_into(self, view):
+        length = self.socket.recv_into(view)
+        if not length:
+            raise ConnectionResetError("Connection closed")
+        return length
+
+    def _fill(self, length):
+        if self._read_start + length > len(self._read_buffer):
+            pending = self._read_end - self._read_start
+            self._read_view[:pending] = \
+                self._read_view[self._read_start:self._read_end]
+            self._read_start, self._read_end = 0, pending
+        while self._read_end - self._read_start < length:
+            self._read_end += self._recv_into(self._read_view[self._read_end:])
+
+    def read_view(self, length):
+        """Read exactly ``length`` bytes.
+
+        The returned :class:`memoryview` may refer to the receive buffer and
+        is only valid until the next read."""
+        if length <= len(self._read_buffer):
+            self._fill(length)
+            start = self._read_start
+            self._read_start += length
+            return self._read_view[start:start + length]
+
+        # Too large to be buffered; receive directly into the result.
+        view = memoryview(bytearray(length))
+        offset = self._read_end - self._read_start
+        view[:offset] = self._read_view[self._read_start:self._read_end]
+        self._read_start = self._read_end = 0
+        while offset < length:
+            offset += self._recv_into(view[offset:])
+        return view
+
+    def peek(self, length):
+        """Return the next ``length`` bytes without consuming them.
+
+        ``length`` must not exceed the buffer size."""
+        self._fill(length)
+        return self._read_view[self._read_start:self._read_start + length]
+
+    def read(self, length):
+        """Read exactly ``length`` bytes and return them as :class:`bytes`."""
+        return bytes(self.read_view(length))
+
+    def unpack(self, fmt):
+        """Read and decode a value of the :class:`struct.Struct` ``fmt``
+        directly from the receive buffer."""
+        self._fill(fmt.size)
+        start = self._read_start
+        self._read_start += fmt.size
+        return fmt.unpack_from(self._read_buffer, start)
+
+    #
+    # Writer interface
+    #
+
+    def write(self, data):
+        if len(data) >= self._write_threshold:
+            self.flush()
+            self.socket.sendall(data)
+        else:
+            self._write_buffer += data
+
+    def pack(self, fmt, *values):
+        self._write_buffer += fmt.pack(*values)
+
+    def flush(self):
+        if self._write_buffer:
+            self.socket.sendall(self._write_buffer)
+            self._write_buffer.clear()
@@ -1,19 +1,39 @@
 import struct
+import hashlib
 import logging
 import traceback
 import numpy
 import socket
+import queue
+import threading
 from enum import Enum
 from fractions import Fraction
 from collections import namedtuple
 
 from artiq.coredevice import exceptions
+from artiq.coredevice.comm_buffer import BufferedSocket
 from artiq import __version__ as software_version
 
 
 logger = logging.getLogger(__name__)
 
 
+_uint8   = struct.Struct("B")
+_int32   = struct.Struct(">l")
+_int64   = struct.Struct(">q")
+_float64 = struct.Struct(">d")
+_header  = struct.Struct(">lB")
+
+# Wire format of the scalar RPC values that lists and arrays are transferred
+# in bulk for, and the NumPy type they are represented with on the host.
+_rpc_bulk_dtypes = {
+    "b": (numpy.dtype("u1"),  numpy.dtype(numpy.bool_)),
+    "i": (numpy.dtype(">i4"), numpy.dtype(numpy.int32)),
+    "I": (numpy.dtype(">i8"), numpy.dtype(numpy.int64)),
+    "f": (numpy.dtype(">f8"), numpy.dtype(numpy.float64)),
+}
+
+
 class Request(Enum):
     SystemInfo = 3
 
@@ -23,12 +43,16 @@ class Request(Enum):
     RPCReply = 7
     RPCException = 8
 
+    LoadKernelByDigest = 9
+    LoadKernelWithDigest = 10
+
 
 class Reply(Enum):
     SystemInfo = 2
 
     LoadCompleted = 5
     LoadFailed = 6
+    KernelNotResident = 16
 
     KernelFinished = 7
     KernelStartupFailed = 8
@@ -53,6 +77,195 @@ class RPCReturnValueError(ValueError):
 RPCKeyword = namedtuple('RPCKeyword', ['name', 'value'])
 
 
+def _rpc_type_mismatch(value, expected, root, function):
+    raise RPCReturnValueError(
+        "type mismatch: cannot serialize {value} as {type}"
+        " ({function} has returned {root})".format(
+            value=repr(value), type=expected,
+            function=function, root=root))
+
+
+# Check, description and wire format of the fixed-size scalar RPC values.
+_rpc_scalars = {
+    "b": (lambda value: isinstance(value, bool),
+          "bool", "B"),
+    "i": (lambda value: isinstance(value, (int, numpy.int32)) and
+                        (-2**31 < value < 2**31-1),
+          "32-bit int", "l"),
+    "I": (lambda value: isinstance(value, (int, numpy.int32, numpy.int64)) and
+                        (-2**63 < value < 2**63-1),
+          "64-bit int", "q"),
+    "f": (lambda value: isinstance(value, float),
+          "float", "d"),
+}
+
+
+def _compile_rpc_encoder(tags):
+    """Compile the RPC type tags ``tags`` (see rpc_proto.rs and
+    compiler/ir.py:rpc_tag) into a function ``encode(comm, value, root,
+    function)`` that checks ``value`` against them and writes it to ``comm``.
+
+    The tags are interpreted only once, so that the encoder can be reused for
+    every reply of the same RPC service."""
+    encode, _ = _compile_rpc_encoder_at(bytes(tags), 0)
+    return encode
+
+
+def _compile_rpc_encoder_at(tags, pos):
+    tag = chr(tags[pos])
+    pos += 1
+    if tag in _rpc_scalars:
+        check, expected, fmt = _rpc_scalars[tag]
+        fmt = struct.Struct(">" + fmt)
+        def encode(comm, value, root, function):
+            if not check(value):
+                _rpc_type_mismatch(value, expected, root, function)
+            comm._stream.pack(fmt, value)
+    elif tag == "t":
+        length = tags[pos]
+        pos += 1
+        expected = "tuple of {}".format(length)
+        elt_tags = [chr(elt_tag) for elt_tag in tags[pos:pos + length]]
+        if all(elt_tag in _rpc_scalars for elt_tag in elt_tags):
+            # Pack tuples of scalars with a single struct.
+            pos += length
+            checks = [_rpc_scalars[elt_tag] for elt_tag in elt_tags]
+            fmt = struct.Struct(">" + "".join(fmt for _, _, fmt in checks))
+            def encode(comm, value, root, function):
+                if not (isinstance(value, tuple) and length == len(value)):
+                    _rpc_type_mismatch(value, expected, root, function)
+                for (check, elt_expected, _), elt in zip(checks, value):
+                    if not check(elt):
+                        _rpc_type_mismatch(elt, elt_expected, root, function)
+                comm._stream.pack(fmt, *value)
+        else:
+            elt_encoders = []
+            for _ in range(length):
+                elt_encode, pos = _compile_rpc_encoder_at(tags, pos)
+                elt_encoders.append(elt_encode)
+            def encode(comm, value, root, function):
+                if not (isinstance(value, tuple) and length == len(value)):
+                    _rpc_type_mismatch(value, expected, root, function)
+                for elt_encode, elt in zip(elt_encoders, value):
+                    elt_encode(comm, elt, root, function)
+    elif tag == "n":
+        def encode(comm, value, root, function):
+            if value is not None:
+                _rpc_type_mismatch(value, "None", root, function)
+    elif tag == "F":
+        def encode(comm, value, root, function):
+            if not (isinstance(value, Fraction) and
+                    (-2**63 < value.numerator < 2**63-1) and
+                    (-2**63 < value.denominator < 2**63-1)):
+                _rpc_type_mismatch(value, "64-bit Fraction", root, function)
+            comm._write_int64(value.numerator)
+            comm._write_int64(value.denominator)
+    elif tag == "s":
+        def encode(comm, value, root, function):
+            if not (isinstance(value, str) and "\x00" not in value):
+                _rpc_type_mismatch(value, "str", root, function)
+            comm._write_string(value)
+    elif tag == "B":
+        def encode(comm, value, root, function):
+            if not isinstance(value, bytes):
+                _rpc_type_mismatch(value, "bytes", root, function)
+            comm._write_bytes(value)
+    elif tag == "A":
+        def encode(comm, value, root, function):
+            if not isinstance(value, bytearray):
+                _rpc_type_mismatch(value, "bytearray", root, function)
+            comm._write_bytes(value)
+    elif tag == "l":
+        elt_tag = chr(tags[pos])
+        elt_encode, pos = _compile_rpc_encoder_at(tags, pos)
+        def encode(comm, value, root, function):
+            if not isinstance(value, list):
+                _rpc_type_mismatch(value, "list", root, function)
+            comm._write_int32(len(value))
+            data = comm._pack_rpc_bulk(elt_tag, value)
+            if data is not None:
+                comm._write(data)
+            else:
+                for elt in value:
+                    elt_encode(comm, elt, root, function)
+    elif tag == "a":
+        num_dims = tags[pos]
+        elt_tag = chr(tags[pos + 1])
+        elt_encode, pos = _compile_rpc_encoder_at(tags, pos + 1)
+        expected = "{}-dimensional numpy.ndarray".format(num_dims)
+        def encode(comm, value, root, function):
+            if not isinstance(value, numpy.ndarray):
+                _rpc_type_mismatch(value, "numpy.ndarray", root, function)
+            if num_dims != len(value.shape):
+                _rpc_type_mismatch(value, expected, root, function)
+            for s in value.shape:
+                comm._write_int32(s)
+            elts = value.reshape((-1,), order="C")
+            data = comm._pack_rpc_bulk(elt_tag, elts)
+            if data is not None:
+                comm._write(data)
+            else:
+                for elt in elts:
+                    elt_encode(comm, elt, root, function)
+    elif tag == "r":
+        elt_encode, pos = _compile_rpc_encoder_at(tags, pos)
+        def encode(comm, value, root, function):
+            if not isinstance(value, range):
+                _rpc_type_mismatch(value, "range", root, function)
+            elt_encode(comm, value.start, root, function)
+            elt_encode(comm, value.stop, root, function)
+            elt_encode(comm, value.step, root, function)
+    else:
+        raise IOError("Unknown RPC value tag: {}".format(repr(tag)))
+    return encode, pos
+
+
+class _AsyncRPCExecutor:
+    """Executes asynchronous RPCs in order on a separate thread, so that
+    messages from the kernel keep being read while they run.
+
+    At most ``queue_size`` RPCs are pending at once; beyond that,
+    :meth:`submit` blocks, and the kernel in turn blocks on the connection.
+    Once an RPC has raised an exception, the remaining ones are discarded
+    and the exception is re-raised by :meth:`check` and :meth:`wait`."""
+    def __init__(self, queue_size):
+        self.error = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="async-rpc",
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            call = self._queue.get()
+            try:
+                if call is None:
+                    return
+                if self.error is None:
+                    service, args, kwargs = call
+                    service(*args, **kwargs)
+            except Exception as exn:
+                self.error = exn
+            finally:
+                self._queue.task_done()
+
+    def submit(self, service, args, kwargs):
+        self._queue.put((service, args, kwargs))
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def wait(self):
+        """Wait until every submitted RPC has executed."""
+        self._queue.join()
+        self.check()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
 class CommKernelDummy:
     def __init__(self):
         pass
@@ -73,10 +286,16 @@ class CommKernelDummy:
 class CommKernel:
     warned_of_mismatch = False
 
-    def __init__(self, host, port=1381):
+    def __init__(self, host, port=1381, async_rpc_queue_size=0):
         self._read_type = None
         self.host = host
         self.port = port
+        # If nonzero, asynchronous RPCs are executed on a separate thread,
+        # with at most that many of them pending.
+        self.async_rpc_queue_size = async_rpc_queue_size
+        # Whether the runtime keeps the last kernel resident and can load
+        # it again by digest; set by check_system_info().
+        self.resident_kernels = False
 
     def open(self):
         if hasattr(self, "socket"):
@@ -84,12 +303,13 @@ class CommKernel:
         self.socket = socket.create_connection((self.host, self.port))
         logger.debug("connected to %s:%d", self.host, self.port)
         self.socket.sendall(b"ARTIQ coredev\n")
+        self._stream = BufferedSocket(self.socket)
 
     def close(self):
         if not hasattr(self, "socket"):
             return
-        self.socket.close()
-        del self.socket
+        self._stream.close()
+        del self.socket, self._stream
         logger.debug("disconnected")
 
     #
@@ -97,28 +317,24 @@ class CommKernel:
     #
 
     def _read(self, length):
-        r = bytes()
-        while len(r) < length:
-            rn = self.socket.recv(min(8192, length - len(r)))
-            if not rn:
-                raise ConnectionResetError("Connection closed")
-            r += rn
-        return r
+        return self._stream.read(length)
 
     def _read_header(self):
         self.open()
+        # We are about to wait for the device; send everything we have.
+        self._flush()
 
         # Wait for a synchronization sequence, 5a 5a 5a 5a.
         sync_count = 0
         while sync_count < 4:
-            (sync_byte, ) = struct.unpack("B", self._read(1))
+            (sync_byte, ) = self._stream.unpack(_uint8)
             if sync_byte == 0x5a:
                 sync_count += 1
             else:
                 sync_count = 0
 
         # Read message header.
-        (raw_type, ) = struct.unpack("B", self._read(1))
+        (raw_type, ) = self._stream.unpack(_uint8)
         self._read_type = Reply(raw_type)
 
         logger.debug("receiving message: type=%r",
@@ -134,19 +350,19 @@ class CommKernel:
         self._read_expect(ty)
 
     def _read_int8(self):
-        (value, ) = struct.unpack("B",  self._read(1))
+        (value, ) = self._stream.unpack(_uint8)
         return value
 
     def _read_int32(self):
-        (value, ) = struct.unpack(">l", self._read(4))
+        (value, ) = self._stream.unpack(_int32)
         return value
 
     def _read_int64(self):
-        (value, ) = struct.unpack(">q", self._read(8))
+        (value, ) = self._stream.unpack(_int64)
         return value
 
     def _read_float64(self):
-        (value, ) = struct.unpack(">d", self._read(8))
+        (value, ) = self._stream.unpack(_float64)
         return value
 
     def _read_bool(self):
@@ -156,14 +372,17 @@ class CommKernel:
         return self._read(self._read_int32())
 
     def _read_string(self):
-        return self._read_bytes().decode("utf-8")
+        return str(self._stream.read_view(self._read_int32()), "utf-8")
 
     #
     # Writer interface
     #
 
     def _write(self, data):
-        self.socket.sendall(data)
+        self._stream.write(data)
+
+    def _flush(self):
+        self._stream.flush()
 
     def _write_header(self, ty):
         self.open()
@@ -171,7 +390,7 @@ class CommKernel:
         logger.debug("sending message: type=%r", ty)
 
         # Write synchronization sequence and header.
-        self._write(struct.pack(">lB", 0x5a5a5a5a, ty.value))
+        self._stream.pack(_header, 0x5a5a5a5a, ty.value)
 
     def _write_empty(self, ty):
         self._write_header(ty)
@@ -180,19 +399,19 @@ class CommKernel:
         self._write(chunk)
 
     def _write_int8(self, value):
-        self._write(struct.pack("B", value))
+        self._stream.pack(_uint8, value)
 
     def _write_int32(self, value):
-        self._write(struct.pack(">l", value))
+        self._stream.pack(_int32, value)
 
     def _write_int64(self, value):
-        self._write(struct.pack(">q", value))
+        self._stream.pack(_int64, value)
 
     def _write_float64(self, value):
-        self._write(struct.pack(">d", value))
+        self._stream.pack(_float64, value)
 
     def _write_bool(self, value):
-        self._write(struct.pack("B", value))
+        self._stream.pack(_uint8, value)
 
     def _write_bytes(self, value):
         self._write_int32(len(value))
@@ -212,7 +431,8 @@ class CommKernel:
         self._read_expect(Reply.SystemInfo)
         runtime_id = self._read(4)
         if runtime_id == b"AROR":
-            gateware_version = self._read_string().split(";")[0]
+            ident = self._read_string().split(";")
+            gateware_version = ident[0]
             if gateware_version != software_version and not self.warned_of_mismatch:
                 logger.warning("Mismatch between gateware (%s) "
                                "and software (%s) versions",
@@ -222,17 +442,35 @@ class CommKernel:
             finished_cleanly = self._read_bool()
             if not finished_cleanly:
                 logger.warning("Previous kernel did not cleanly finish")
+            # Runtimes built before LoadKernelByDigest was added do not
+            # advertise it, and would drop the connection on receiving it.
+            self.resident_kernels = "resident_kernels" in ident[1:]
         elif runtime_id == b"ARZQ":
-            pass
+            self.resident_kernels = False
         else:
             raise UnsupportedDevice("Unsupported runtime ID: {}"
                                     .format(runtime_id))
 
     def load(self, kernel_library):
-        self._write_header(Request.LoadKernel)
-        self._write_bytes(kernel_library)
+        if self.resident_kernels:
+            digest = hashlib.sha256(kernel_library).digest()
+            self._write_header(Request.LoadKernelByDigest)
+            self._write_bytes(digest)
 
-        self._read_header()
+            self._read_header()
+            if self._read_type == Reply.KernelNotResident:
+                logger.debug("kernel not resident, uploading %d bytes",
+                             len(kernel_library))
+                self._write_header(Request.LoadKernelWithDigest)
+                self._write_bytes(digest)
+                self._write_bytes(kernel_library)
+
+                self._read_header()
+        else:
+            self._write_header(Request.LoadKernel)
+            self._write_bytes(kernel_library)
+
+            self._read_header()
         if self._read_type == Reply.LoadFailed:
             raise LoadError(self._read_string())
         else:
@@ -240,6 +478,7 @@ class CommKernel:
 
     def run(self):
         self._write_empty(Request.RunKernel)
+        self._flush()
         logger.debug("running kernel")
 
     _rpc_sentinel = object()
@@ -274,12 +513,23 @@ class CommKernel:
             return self._read_bytes()
         elif tag == "l":
             length = self._read_int32()
-            return [self._receive_rpc_value(embedding_map) for _ in range(length)]
+            elems = self._receive_rpc_bulk(length)
+            if elems is None:
+                return [self._receive_rpc_value(embedding_map) for _ in range(length)]
+            elif elems.dtype.kind in "bf":
+                return elems.tolist()
+            else:
+                # Keep the NumPy integer types, as for individual values.
+                return list(elems)
         elif tag == "a":
             num_dims = self._read_int8()
             shape = tuple(self._read_int32() for _ in range(num_dims))
-            elems = [self._receive_rpc_value(embedding_map) for _ in range(numpy.prod(shape))]
-            return numpy.array(elems).reshape(shape)
+            length = int(numpy.prod(shape))
+            elems = self._receive_rpc_bulk(length)
+            if elems is None:
+                elems = [self._receive_rpc_value(embedding_map) for _ in range(length)]
+                return numpy.array(elems).reshape(shape)
+            return elems.reshape(shape)
         elif tag == "r":
             start = self._receive_rpc_value(embedding_map)
             stop  = self._receive_rpc_value(embedding_map)
@@ -294,6 +544,28 @@ class CommKernel:
         else:
             raise IOError("Unknown RPC value tag: {}".format(repr(tag)))
 
+    def _receive_rpc_bulk(self, length):
+        """Receive ``length`` list or array elements at once if they are scalars
+        that NumPy can represent, and return them as an array; otherwise,
+        return ``None`` without consuming anything."""
+        if length == 0:
+            return None
+        tag = chr(self._stream.peek(1)[0])
+        if tag not in _rpc_bulk_dtypes:
+            return None
+        wire_dtype, host_dtype = _rpc_bulk_dtypes[tag]
+
+        # Each element is still preceded by its tag.
+        dtype = numpy.dtype([("tag", "u1"), ("value", wire_dtype)])
+        elems = numpy.frombuffer(self._stream.read_view(length*dtype.itemsize), dtype)
+        if not (elems["tag"] == ord(tag)).all():
+            raise IOError("Inconsistent RPC value tags in list or array")
+        if tag == "b":
+            return elems["value"] != 0
+        else:
+            # This also copies the values out of the receive buffer.
+            return elems["value"].astype(host_dtype)
+
     def _receive_rpc_args(self, embedding_map):
         args, kwargs = [], {}
         while True:
@@ -305,107 +577,47 @@ class CommKernel:
             else:
                 args.append(value)
 
-    def _skip_rpc_value(self, tags):
-        tag = chr(tags.pop(0))
-        if tag == "t":
-            length = tags.pop(0)
-            for _ in range(length):
-                self._skip_rpc_value(tags)
-        elif tag == "l":
-            self._skip_rpc_value(tags)
-        elif tag == "r":
-            self._skip_rpc_value(tags)
+    def _pack_rpc_bulk(self, tag, value):
+        """Encode the elements of the list or array ``value`` at once if all
+        of them pass the check of the scalars of type ``tag``, and return the
+        encoded bytes; otherwise, return ``None``."""
+        if tag not in _rpc_bulk_dtypes:
+            return None
+        wire_dtype, host_dtype = _rpc_bulk_dtypes[tag]
+
+        if isinstance(value, numpy.ndarray):
+            # The type of the elements is that of the array. numpy.bool_ is
+            # not accepted as bool.
+            if tag == "i":
+                dtypes = (numpy.dtype(numpy.int32),)
+            elif tag == "I":
+                dtypes = (numpy.dtype(numpy.int32), numpy.dtype(numpy.int64))
+            elif tag == "f":
+                dtypes = (host_dtype,)
+            else:
+                dtypes = ()
+            if value.dtype not in dtypes:
+                return None
+            if tag in "iI" and value.size:
+                # Same bounds as for individual values.
+                info = numpy.iinfo(host_dtype)
+                if not (info.min < value.min() and value.max() < info.max):
+                    return None
+            return value.astype(wire_dtype).tobytes()
         else:
-            pass
+            check, _, _ = _rpc_scalars[tag]
+            if not all(map(check, value)):
+                return None
+            return numpy.array(value, dtype=wire_dtype).tobytes()
 
     def _send_rpc_value(self, tags, value, root, function):
-        def check(cond, expected):
-            if not cond:
-                raise RPCReturnValueError(
-                    "type mismatch: cannot serialize {value} as {type}"
-                    " ({function} has returned {root})".format(
-                        value=repr(value), type=expected(),
-                        function=function, root=root))
-
-        tag = chr(tags.pop(0))
-        if tag == "t":
-            length = tags.pop(0)
-            check(isinstance(value, tuple) and length == len(value),
-                  lambda: "tuple of {}".format(length))
-            for elt in value:
-                self._send_rpc_value(tags, elt, root, function)
-        elif tag == "n":
-            check(value is None,
-                  lambda: "None")
-        elif tag == "b":
-            check(isinstance(value, bool),
-                  lambda: "bool")
-            self._write_int8(value)
-        elif tag == "i":
-            check(isinstance(value, (int, numpy.int32)) and
-                  (-2**31 < value < 2**31-1),
-                  lambda: "32-bit int")
-            self._write_int32(value)
-        elif tag == "I":
-            check(isinstance(value, (int, numpy.int32, numpy.int64)) and
-                  (-2**63 < value < 2**63-1),
-                  lambda: "64-bit int")
-            self._write_int64(value)
-        elif tag == "f":
-            check(isinstance(value, float),
-                  lambda: "float")
-            self._write_float64(value)
-        elif tag == "F":
-            check(isinstance(value, Fraction) and
-                    (-2**63 < value.numerator < 2**63-1) and
-                    (-2**63 < value.denominator < 2**63-1),
-                  lambda: "64-bit Fraction")
-            self._write_int64(value.numerator)
-            self._write_int64(value.denominator)
-        elif tag == "s":
-            check(isinstance(value, str) and "\x00" not in value,
-                  lambda: "str")
-            self._write_string(value)
-        elif tag == "B":
-            check(isinstance(value, bytes),
-                  lambda: "bytes")
-            self._write_bytes(value)
-        elif tag == "A":
-            check(isinstance(value, bytearray),
-                  lambda: "bytearray")
-            self._write_bytes(value)
-        elif tag == "l":
-            check(isinstance(value, list),
-                  lambda: "list")
-            self._write_int32(len(value))
-            for elt in value:
-                tags_copy = bytearray(tags)
-                self._send_rpc_value(tags_copy, elt, root, function)
-            self._skip_rpc_value(tags)
-        elif tag == "a":
-            check(isinstance(value, numpy.ndarray),
-                  lambda: "numpy.ndarray")
-            num_dims = tags.pop(0)
-            check(num_dims == len(value.shape),
-                lambda: "{}-dimensional numpy.ndarray".format(num_dims))
-            for s in value.shape:
-                self._write_int32(s)
-            for elt in value.reshape((-1,), order="C"):
-                tags_copy = bytearray(tags)
-                self._send_rpc_value(tags_copy, elt, root, function)
-            self._skip_rpc_value(tags)
-        elif tag == "r":
-            check(isinstance(value, range),
-                  lambda: "range")
-            tags_copy = bytearray(tags)
-            self._send_rpc_value(tags_copy, value.start, root, function)
-            tags_copy = bytearray(tags)
-            self._send_rpc_value(tags_copy, value.stop, root, function)
-            tags_copy = bytearray(tags)
-            self._send_rpc_value(tags_copy, value.step, root, function)
-            tags = tags_copy
-        else:
-            raise IOError("Unknown RPC value tag: {}".format(repr(tag)))
+        _compile_rpc_encoder(tags)(self, value, root, function)
+
+    def _rpc_encoder(self, embedding_map, service_id, tags):
+        if not embedding_map.has_rpc_encoder(service_id, tags):
+            embedding_map.store_rpc_encoder(service_id, tags,
+                                            _compile_rpc_encoder(tags))
+        return embedding_map.retrieve_rpc_encoder(service_id, tags)
 
     def _truncate_message(self, msg, limit=4096):
         if len(msg) > limit:
@@ -413,7 +625,7 @@ class CommKernel:
         else:
             return msg
 
-    def _serve_rpc(self, embedding_map):
+    def _serve_rpc(self, embedding_map, executor=None):
         is_async     = self._read_bool()
         service_id   = self._read_int32()
         args, kwargs = self._receive_rpc_args(embedding_map)
@@ -427,16 +639,24 @@ class CommKernel:
                      (" (async)" if is_async else ""), args, kwargs, return_tags)
 
         if is_async:
-            service(*args, **kwargs)
+            if executor is None:
+                service(*args, **kwargs)
+            else:
+                executor.submit(service, args, kwargs)
             return
 
+        if executor is not None:
+            # Preserve the order of side effects.
+            executor.wait()
+
         try:
             result = service(*args, **kwargs)
             logger.debug("rpc service: %d %r %r = %r", service_id, args, kwargs, result)
 
+            encoder = self._rpc_encoder(embedding_map, service_id, return_tags)
             self._write_header(Request.RPCReply)
             self._write_bytes(return_tags)
-            self._send_rpc_value(bytearray(return_tags), result, result, service)
+            encoder(self, result, result, service)
         except RPCReturnValueError as exn:
             raise
         except Exception as exn:
@@ -508,10 +728,27 @@ class CommKernel:
         raise python_exn
 
     def serve(self, embedding_map, symbolizer, demangler):
+        if self.async_rpc_queue_size:
+            executor = _AsyncRPCExecutor(self.async_rpc_queue_size)
+        else:
+            executor = None
+        try:
+            self._serve(embedding_map, symbolizer, demangler, executor)
+        finally:
+            if executor is not None:
+                executor.close()
+
+    def _serve(self, embedding_map, symbolizer, demangler, executor):
         while True:
             self._read_header()
+            if executor is not None:
+                if self._read_type == Reply.RPCRequest:
+                    executor.check()
+                else:
+                    # The kernel has stopped; let pending RPCs complete first.
+                    executor.wait()
             if self._read_type == Reply.RPCRequest:
-                self._serve_rpc(embedding_map)
+                self._serve_rpc(embedding_map, executor)
             elif self._read_type == Reply.KernelException:
                 self._serve_exception(embedding_map, symbolizer, demangler)
             elif self._read_type == Reply.WatchdogExpired:
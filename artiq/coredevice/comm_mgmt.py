@@ -3,10 +3,16 @@ import logging
 import socket
 import struct
 
+from artiq.coredevice.comm_buffer import BufferedSocket
+
 
 logger = logging.getLogger(__name__)
 
 
+_uint8 = struct.Struct("B")
+_int32 = struct.Struct(">l")
+
+
 class Request(Enum):
     GetLog = 1
     ClearLog = 2
@@ -63,30 +69,34 @@ class CommMgmt:
         self.socket = socket.create_connection((self.host, self.port))
         logger.debug("connected to %s:%d", self.host, self.port)
         self.socket.sendall(b"ARTIQ management\n")
+        self._stream = BufferedSocket(self.socket)
 
     def close(self):
         if not hasattr(self, "socket"):
             return
-        self.socket.close()
-        del self.socket
+        self._stream.close()
+        del self.socket, self._stream
         logger.debug("disconnected")
 
     # Protocol elements
 
     def _write(self, data):
-        self.socket.sendall(data)
+        self._stream.write(data)
+
+    def _flush(self):
+        self._stream.flush()
 
     def _write_header(self, ty):
         self.open()
 
         logger.debug("sending message: type=%r", ty)
-        self._write(struct.pack("B", ty.value))
+        self._stream.pack(_uint8, ty.value)
 
     def _write_int8(self, value):
-        self._write(struct.pack("B", value))
+        self._stream.pack(_uint8, value)
 
     def _write_int32(self, value):
-        self._write(struct.pack(">l", value))
+        self._stream.pack(_int32, value)
 
     def _write_bytes(self, value):
         self._write_int32(len(value))
@@ -96,16 +106,12 @@ class CommMgmt:
         self._write_bytes(value.encode("utf-8"))
 
     def _read(self, length):
-        r = bytes()
-        while len(r) < length:
-            rn = self.socket.recv(min(8192, length - len(r)))
-            if not rn:
-                raise ConnectionResetError("Connection closed")
-            r += rn
-        return r
+        return self._stream.read(length)
 
     def _read_header(self):
-        ty = Reply(*struct.unpack("B", self._read(1)))
+        # We are about to wait for the device; send everything we have.
+        self._flush()
+        ty = Reply(*self._stream.unpack(_uint8))
         logger.debug("receiving message: type=%r", ty)
 
         return ty
@@ -116,14 +122,14 @@ class CommMgmt:
                           format(self._read_type, ty))
 
     def _read_int32(self):
-        (value, ) = struct.unpack(">l", self._read(4))
+        (value, ) = self._stream.unpack(_int32)
         return value
 
     def _read_bytes(self):
         return self._read(self._read_int32())
 
     def _read_string(self):
-        return self._read_bytes().decode("utf-8")
+        return str(self._stream.read_view(self._read_int32()), "utf-8")
 
     # External API
 
@@ -228,3 +234,4 @@ class CommMgmt:
 
     def debug_allocator(self):
         self._write_header(Request.DebugAllocator)
+        self._flush()
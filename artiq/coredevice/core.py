@@ -1,9 +1,13 @@
 import os, sys
+import multiprocessing
 import numpy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from pythonparser import diagnostic
 
-from artiq import __artiq_dir__ as artiq_dir
+from artiq import __artiq_dir__ as artiq_dir, __version__ as artiq_version
+from artiq.appdirs import user_cache_dir
 
 from artiq.language.core import *
 from artiq.language.types import *
@@ -12,6 +16,8 @@ from artiq.language.units import *
 from artiq.compiler.module import Module
 from artiq.compiler.embedding import Stitcher
 from artiq.compiler.targets import OR1KTarget, CortexA9Target
+from artiq.compiler.library_cache import LibraryCache
+from artiq.compiler.profiling import Profiler, null_profiler, typedtree_size
 
 from artiq.coredevice.comm_kernel import CommKernel, CommKernelDummy
 # Import for side effects (creating the exception classes).
@@ -39,6 +45,44 @@ class CompileError(Exception):
         return "\n" + _render_diagnostic(self.diagnostic, colored=colors_supported)
 
 
+def _library_cache_enabled():
+    if os.getenv("ARTIQ_NO_KERNEL_CACHE") is not None:
+        return False
+    # Dumps of the later compilation stages are only produced on a cache miss.
+    return not any(os.getenv(var) for var in
+                   ("ARTIQ_DUMP_UNOPT_LLVM", "ARTIQ_DUMP_LLVM", "ARTIQ_DUMP_ASM",
+                    "ARTIQ_DUMP_OBJ", "ARTIQ_DUMP_ELF"))
+
+def _profiler_from_env():
+    # "memory" also measures the peak allocation of every pass, which is slow.
+    mode = os.getenv("ARTIQ_PROFILE_COMPILER")
+    if not mode:
+        return None
+    return Profiler(trace_memory=mode == "memory")
+
+def _build_library(target_cls, llvm_ir):
+    # Runs in a compiler pool process; only the target class and the textual
+    # LLVM IR cross the process boundary.
+    return target_cls().build_library(llvm_ir)
+
+def _compile_pool(workers):
+    # The pool processes are spawned rather than forked, since this usually
+    # runs in a worker process that has pipes to the master open and may
+    # have started threads, e.g. for asynchronous RPCs. Returns None where
+    # the start method cannot be chosen (before Python 3.7).
+    try:
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"))
+    except TypeError:
+        return None
+
+# Shared by every Core in the process; persisted in the user cache directory
+# so that kernels compiled by previous workers are reused.
+library_cache = LibraryCache(
+    os.path.join(user_cache_dir("artiq", "m-labs", artiq_version.split(".")[0]),
+                 "kernels"))
+
+
 @syscall
 def rtio_init() -> TNone:
     raise NotImplementedError("syscall not simulated")
@@ -65,13 +109,23 @@ class Core:
     :param ref_multiplier: ratio between the RTIO fine timestamp frequency
         and the RTIO coarse timestamp frequency (e.g. SERDES multiplication
         factor).
+    :param async_rpc_queue_size: if nonzero, asynchronous RPCs are executed
+        in order on a separate thread while the messages that follow them
+        keep being received, and at most that many of them may be pending
+        at once. Synchronous RPCs and the end of the kernel wait for all
+        pending asynchronous RPCs, and an exception raised by one of them
+        is reported at the latest when the kernel terminates.
+    :param compile_workers: number of processes used by
+        :meth:`compile_batch` to build kernels in parallel, or ``None`` to
+        use one per CPU.
     """
 
     kernel_invariants = {
         "core", "ref_period", "coarse_ref_period", "ref_multiplier",
     }
 
-    def __init__(self, dmgr, host, ref_period, ref_multiplier=8, target="or1k"):
+    def __init__(self, dmgr, host, ref_period, ref_multiplier=8, target="or1k",
+                 async_rpc_queue_size=0, compile_workers=None):
         self.ref_period = ref_period
         self.ref_multiplier = ref_multiplier
         if target == "or1k":
@@ -84,7 +138,10 @@ class Core:
         if host is None:
             self.comm = CommKernelDummy()
         else:
-            self.comm = CommKernel(host)
+            self.comm = CommKernel(host,
+                                   async_rpc_queue_size=async_rpc_queue_size)
+
+        self.compile_workers = compile_workers
 
         self.first_run = True
         self.dmgr = dmgr
@@ -94,30 +151,130 @@ class Core:
     def close(self):
         self.comm.close()
 
-    def compile(self, function, args, kwargs, set_result=None,
-                attribute_writeback=True, print_as_rpc=True):
-        try:
-            engine = _DiagnosticEngine(all_errors_are_fatal=True)
+    def _stitch(self, function, args, kwargs, set_result, attribute_writeback,
+                print_as_rpc, profiler):
+        engine = _DiagnosticEngine(all_errors_are_fatal=True)
 
-            stitcher = Stitcher(engine=engine, core=self, dmgr=self.dmgr,
-                                print_as_rpc=print_as_rpc)
+        stitcher = Stitcher(engine=engine, core=self, dmgr=self.dmgr,
+                            print_as_rpc=print_as_rpc)
+        with profiler.measure("stitcher", lambda: typedtree_size(stitcher.typedtree),
+                              "nodes"):
             stitcher.stitch_call(function, args, kwargs, set_result)
             stitcher.finalize()
 
-            module = Module(stitcher,
-                ref_period=self.ref_period,
-                attribute_writeback=attribute_writeback)
-            target = self.target_cls()
+        module = Module(stitcher,
+            ref_period=self.ref_period,
+            attribute_writeback=attribute_writeback,
+            profiler=profiler)
+        return stitcher.embedding_map, module
 
-            library = target.compile_and_link([module])
-            stripped_library = target.strip(library)
+    @staticmethod
+    def _compiled(embedding_map, target, library, stripped_library):
+        return embedding_map, stripped_library, \
+               lambda addresses: target.symbolize(library, addresses), \
+               lambda symbols: target.demangle(symbols)
+
+    def compile(self, function, args, kwargs, set_result=None,
+                attribute_writeback=True, print_as_rpc=True, profiler=None):
+        """Compile a kernel.
+
+        :param profiler: if not ``None``, an
+            :class:`artiq.compiler.profiling.Profiler` that records the time,
+            memory and IR size of every compiler pass. If ``None`` and the
+            ``ARTIQ_PROFILE_COMPILER`` environment variable is set, the passes
+            are recorded and printed to the standard error; set it to
+            ``memory`` to also measure the peak allocation of each pass.
+        """
+        dump_profile = False
+        if profiler is None:
+            profiler = _profiler_from_env()
+            dump_profile = profiler is not None
+        if profiler is None:
+            profiler = null_profiler
+
+        try:
+            embedding_map, module = self._stitch(
+                function, args, kwargs, set_result,
+                attribute_writeback, print_as_rpc, profiler)
+            target = self.target_cls(profiler)
+
+            if _library_cache_enabled():
+                library, stripped_library = \
+                    library_cache.compile_and_link(target, module)
+            else:
+                library = target.compile_and_link([module])
+                stripped_library = target.strip(library)
+
+            if dump_profile:
+                profiler.dump()
+
+            return self._compiled(embedding_map, target, library, stripped_library)
+        except diagnostic.Error as error:
+            raise CompileError(error.diagnostic) from error
 
-            return stitcher.embedding_map, stripped_library, \
-                   lambda addresses: target.symbolize(library, addresses), \
-                   lambda symbols: target.demangle(symbols)
+    def compile_batch(self, invocations, attribute_writeback=True, print_as_rpc=True):
+        """Compile several kernels, optimizing and linking them in parallel.
+
+        The kernels are stitched and lowered to LLVM IR one after another
+        in this process, since that requires access to the host objects
+        they use; LLVM optimization, code generation, linking and stripping
+        are then distributed over a pool of ``compile_workers`` processes
+        (by default, one per CPU), which is shut down before returning.
+        Kernels found in the library cache, and identical kernels within the
+        batch, are only built once.
+
+        :param invocations: an iterable of ``(function, args, kwargs)`` or
+            ``(function, args, kwargs, set_result)`` tuples, as passed
+            to :meth:`compile`.
+        :return: a list with the result of :meth:`compile` for each
+            invocation, in order.
+        """
+        use_cache = _library_cache_enabled()
+        compiled = []
+        pending = OrderedDict()
+        try:
+            for invocation in invocations:
+                function, args, kwargs, *set_result = invocation
+                set_result = set_result[0] if set_result else None
+                embedding_map, module = self._stitch(
+                    function, args, kwargs, set_result,
+                    attribute_writeback, print_as_rpc, null_profiler)
+                target = self.target_cls()
+                llvm_ir = target.emit_llvm_ir(module)
+
+                key = library_cache.digest(target, llvm_ir)
+                entry = None
+                if use_cache and key not in pending:
+                    entry = library_cache.get(key)
+                if entry is None:
+                    pending[key] = llvm_ir
+                compiled.append((embedding_map, target, key, entry))
         except diagnostic.Error as error:
             raise CompileError(error.diagnostic) from error
 
+        pool = None
+        if len(pending) > 1 and self.compile_workers != 1:
+            pool = _compile_pool(self.compile_workers)
+        if pool is not None:
+            with pool:
+                futures = OrderedDict(
+                    (key, pool.submit(_build_library, self.target_cls, llvm_ir))
+                    for key, llvm_ir in pending.items())
+                built = {key: future.result() for key, future in futures.items()}
+        else:
+            built = {key: self.target_cls().build_library(llvm_ir)
+                     for key, llvm_ir in pending.items()}
+        if use_cache:
+            for key, entry in built.items():
+                library_cache.put(key, entry)
+
+        result = []
+        for embedding_map, target, key, entry in compiled:
+            if entry is None:
+                entry = built[key]
+            result.append(self._compiled(embedding_map, target, *entry))
+        return result
+
     def run(self, function, args, kwargs):
         result = None
         @rpc(flags={"async"})
@@ -125,9 +282,12 @@ class Core:
             nonlocal result
             result = new_result
 
-        embedding_map, kernel_library, symbolizer, demangler = \
-            self.compile(function, args, kwargs, set_result)
+        self.run_compiled(*self.compile(function, args, kwargs, set_result))
+        return result
 
+    def run_compiled(self, embedding_map, kernel_library, symbolizer, demangler):
+        """Load and run a kernel returned by :meth:`compile` or
+        :meth:`compile_batch`, serving its RPCs until it terminates."""
         if self.first_run:
             self.comm.check_system_info()
             self.first_run = False
@@ -136,8 +296,6 @@ class Core:
         self.comm.run()
         self.comm.serve(embedding_map, symbolizer, demangler)
 
-        return result
-
     @portable
     def seconds_to_mu(self, seconds):
         """Convert seconds to the corresponding number of machine units
@@ -66,6 +66,8 @@ pub enum Request {
     SystemInfo,
 
     LoadKernel(Vec<u8>),
+    LoadKernelByDigest(Vec<u8>),
+    LoadKernelWithDigest { digest: Vec<u8>, kernel: Vec<u8> },
     RunKernel,
 
     RpcReply { tag: Vec<u8> },
@@ -89,6 +91,7 @@ pub enum Reply<'a> {
 
     LoadCompleted,
     LoadFailed(&'a str),
+    KernelNotResident,
 
     KernelFinished,
     KernelStartupFailed,
@@ -135,6 +138,12 @@ impl Request {
                 function: reader.read_string()?
             },
 
+            9  => Request::LoadKernelByDigest(reader.read_bytes()?),
+            10 => Request::LoadKernelWithDigest {
+                digest: reader.read_bytes()?,
+                kernel: reader.read_bytes()?
+            },
+
             ty  => return Err(Error::UnknownPacket(ty))
         })
     }
@@ -160,6 +169,9 @@ impl<'a> Reply<'a> {
                 writer.write_u8(6)?;
                 writer.write_string(reason)?;
             },
+            Reply::KernelNotResident => {
+                writer.write_u8(16)?;
+            },
 
             Reply::KernelFinished => {
                 writer.write_u8(7)?;
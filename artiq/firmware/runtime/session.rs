@@ -65,7 +65,9 @@ macro_rules! unexpected {
 struct Congress {
     cache: Cache,
     dma_manager: DmaManager,
-    finished_cleanly: Cell<bool>
+    finished_cleanly: Cell<bool>,
+    // Last kernel loaded with LoadKernelWithDigest, as (digest, library)
+    resident_kernel: Option<(Vec<u8>, Vec<u8>)>
 }
 
 impl Congress {
@@ -73,7 +75,8 @@ impl Congress {
         Congress {
             cache: Cache::new(),
             dma_manager: DmaManager::new(),
-            finished_cleanly: Cell::new(true)
+            finished_cleanly: Cell::new(true),
+            resident_kernel: None
         }
     }
 }
@@ -134,6 +137,8 @@ fn host_read<R>(reader: &mut R) -> Result<host::Request, Error<R::ReadError>>
     let request = host::Request::read_from(reader)?;
     match &request {
         &host::Request::LoadKernel(_) => debug!("comm<-host LoadLibrary(...)"),
+        &host::Request::LoadKernelWithDigest { .. } =>
+            debug!("comm<-host LoadLibraryWithDigest(...)"),
         _ => debug!("comm<-host {:?}", request)
     }
     Ok(request)
@@ -236,28 +241,59 @@ fn kern_run(session: &mut Session) -> Result<(), Error<SchedError>> {
     kern_acknowledge()
 }
 
+fn host_load(io: &Io, stream: &mut TcpStream, session: &mut Session, library: &[u8])
+             -> Result<bool, Error<SchedError>> {
+    match unsafe { kern_load(io, session, library) } {
+        Ok(()) => {
+            host_write(stream, host::Reply::LoadCompleted)?;
+            Ok(true)
+        }
+        Err(error) => {
+            let mut description = String::new();
+            write!(&mut description, "{}", error).unwrap();
+            host_write(stream, host::Reply::LoadFailed(&description))?;
+            kern_acknowledge()?;
+            Ok(false)
+        }
+    }
+}
+
 fn process_host_message(io: &Io,
                         stream: &mut TcpStream,
                         session: &mut Session) -> Result<(), Error<SchedError>> {
     match host_read(stream)? {
         host::Request::SystemInfo => {
+            // The features of the runtime follow the gateware identifier.
+            // Hosts only compare the part of the identifier before the
+            // first ';' with their version.
+            let mut ident = String::from(ident::read(&mut [0; 64]));
+            ident.push_str(";resident_kernels");
             host_write(stream, host::Reply::SystemInfo {
-                ident: ident::read(&mut [0; 64]),
+                ident: &ident,
                 finished_cleanly: session.congress.finished_cleanly.get()
             })?;
             session.congress.finished_cleanly.set(true)
         }
 
-        host::Request::LoadKernel(kernel) =>
-            match unsafe { kern_load(io, session, &kernel) } {
-                Ok(()) => host_write(stream, host::Reply::LoadCompleted)?,
-                Err(error) => {
-                    let mut description = String::new();
-                    write!(&mut description, "{}", error).unwrap();
-                    host_write(stream, host::Reply::LoadFailed(&description))?;
-                    kern_acknowledge()?;
+        host::Request::LoadKernel(kernel) => {
+            host_load(io, stream, session, &kernel)?;
+        }
+        host::Request::LoadKernelByDigest(digest) => {
+            let resident_kernel = session.congress.resident_kernel.take();
+            match resident_kernel {
+                Some((ref resident_digest, ref kernel)) if *resident_digest == digest => {
+                    host_load(io, stream, session, kernel)?;
                 }
-            },
+                _ => host_write(stream, host::Reply::KernelNotResident)?
+            }
+            session.congress.resident_kernel = resident_kernel;
+        }
+        host::Request::LoadKernelWithDigest { digest, kernel } => {
+            session.congress.resident_kernel = None;
+            if host_load(io, stream, session, &kernel)? {
+                session.congress.resident_kernel = Some((digest, kernel));
+            }
+        }
         host::Request::RunKernel =>
             match kern_run(session) {
                 Ok(()) => (),
@@ -31,6 +31,10 @@ def get_argparser():
     parser.add_argument("--db-file", default=None,
                         help="database file for local browser settings "
                         "(default: %(default)s)")
+    parser.add_argument("--catalog-file", default=None,
+                        help="database file caching the thumbnails and "
+                        "metadata of the result files "
+                        "(default: in the user cache directory)")
     parser.add_argument("--browse-root", default="",
                         help="root path for directory tree "
                         "(default %(default)s)")
@@ -48,7 +52,7 @@ def get_argparser():
 
 
 class Browser(QtWidgets.QMainWindow):
-    def __init__(self, smgr, datasets_sub, browse_root,
+    def __init__(self, smgr, datasets_sub, browse_root, catalog_file,
                  master_host, master_port):
         QtWidgets.QMainWindow.__init__(self)
         smgr.register(self)
@@ -73,8 +77,9 @@ class Browser(QtWidgets.QMainWindow):
             QtCore.Qt.ScrollBarAsNeeded)
         self.setCentralWidget(self.experiments)
 
-        self.files = files.FilesDock(datasets_sub, browse_root)
+        self.files = files.FilesDock(datasets_sub, browse_root, catalog_file)
         smgr.register(self.files)
+        atexit_register_coroutine(self.files.stop)
 
         self.files.dataset_activated.connect(
             self.experiments.dataset_activated)
@@ -154,7 +159,7 @@ def main():
 
     smgr = state.StateManager(args.db_file)
 
-    browser = Browser(smgr, datasets_sub, args.browse_root,
+    browser = Browser(smgr, datasets_sub, args.browse_root, args.catalog_file,
                       args.server, args.port)
     widget_log_handler.callback = browser.log.append_message
 
@@ -23,6 +23,7 @@ from sipyco.broadcast import Receiver
 from sipyco import common_args, pyon
 
 from artiq.tools import short_format, parse_arguments
+from artiq.master.publisher import subscription_name
 from artiq import __version__ as artiq_version
 
 
@@ -105,6 +106,14 @@ def get_argparser():
         "what", metavar="WHAT",
         choices=["schedule", "log", "ccb", "devices", "datasets"],
         help="select object to show: %(choices)s")
+    parser_show.add_argument(
+        "-d", "--dataset", default=[], action="append", dest="datasets",
+        help="with 'datasets', show only this dataset "
+             "(can be specified multiple times)")
+    parser_show.add_argument(
+        "-p", "--prefix", default=[], action="append", dest="prefixes",
+        help="with 'datasets', show only the datasets whose name starts "
+             "with this prefix (can be specified multiple times)")
 
     subparsers.add_parser(
         "scan-devices", help="trigger a device database (re)scan")
@@ -297,7 +306,12 @@ def main():
         elif args.what == "devices":
             _show_dict(args, "devices", _show_devices)
         elif args.what == "datasets":
-            _show_dict(args, "datasets", _show_datasets)
+            if args.datasets or args.prefixes:
+                notifier_name = subscription_name(
+                    "datasets", args.datasets, args.prefixes)
+            else:
+                notifier_name = "datasets"
+            _show_dict(args, notifier_name, _show_datasets)
         else:
             raise ValueError
     else:
@@ -7,7 +7,6 @@ import os
 import logging
 
 from sipyco.pc_rpc import Server as RPCServer
-from sipyco.sync_struct import Publisher
 from sipyco.logging_tools import Server as LoggingServer
 from sipyco.broadcast import Broadcaster
 from sipyco import common_args
@@ -17,7 +16,9 @@ from artiq import __version__ as artiq_version
 from artiq.master.log import log_args, init_log
 from artiq.master.databases import DeviceDB, DatasetDB
 from artiq.master.scheduler import Scheduler
+from artiq.master.worker import WorkerPool
 from artiq.master.rid_counter import RIDCounter
+from artiq.master.publisher import CoalescingPublisher
 from artiq.master.experiments import (FilesystemBackend, GitBackend,
                                       ExperimentDB)
 
@@ -41,7 +42,9 @@ def get_argparser():
     group.add_argument("--device-db", default="device_db.py",
                        help="device database file (default: '%(default)s')")
     group.add_argument("--dataset-db", default="dataset_db.pyon",
-                       help="dataset file (default: '%(default)s')")
+                       help="dataset file; use a '.h5' extension to log "
+                            "changes as they happen and store the datasets "
+                            "in HDF5 (default: '%(default)s')")
 
     group = parser.add_argument_group("repository")
     group.add_argument(
@@ -50,6 +53,44 @@ def get_argparser():
     group.add_argument(
         "-r", "--repository", default="repository",
         help="path to the repository (default: '%(default)s')")
+    group.add_argument(
+        "--scan-concurrency", default=4, type=int,
+        help="number of experiment files examined in parallel when "
+             "scanning the repository (default: %(default)d)")
+    group.add_argument(
+        "--scan-cache", default=None,
+        help="file where the results of repository scans are kept, so that "
+             "unchanged experiment files are not examined again "
+             "(default: 'repository_scan.pyon' in the folder of the "
+             "dataset file)")
+
+    group = parser.add_argument_group("workers")
+    group.add_argument(
+        "--worker-pool-size", default=1, type=int,
+        help="number of worker processes kept started ahead of time "
+             "for new runs (default: %(default)d)")
+    group.add_argument(
+        "--worker-max-runs", default=1, type=int,
+        help="number of runs after which a worker process is replaced; "
+             "values above 1 reuse worker processes between runs from "
+             "the same revision of a Git repository "
+             "(default: %(default)d)")
+    group.add_argument(
+        "--worker-max-memory", default=None, type=int,
+        help="peak memory usage in MiB after which a worker process is "
+             "not reused (default: no limit)")
+
+    group = parser.add_argument_group("notifications")
+    group.add_argument(
+        "--notify-interval", default=0.1, type=float,
+        help="minimum time in seconds between two notifications of the "
+             "same structure; modifications made in the meantime are "
+             "coalesced (default: %(default)s)")
+    group.add_argument(
+        "--notify-max-queue", default=1000, type=int,
+        help="number of modifications that may be queued for a slow "
+             "subscriber before it is sent the whole structure instead "
+             "(default: %(default)d)")
 
     log_args(parser)
 
@@ -104,10 +145,23 @@ def main():
         repo_backend = GitBackend(args.repository)
     else:
         repo_backend = FilesystemBackend(args.repository)
-    experiment_db = ExperimentDB(repo_backend, worker_handlers)
+    scan_cache = args.scan_cache
+    if scan_cache is None:
+        scan_cache = os.path.join(
+            os.path.dirname(os.path.abspath(args.dataset_db)),
+            "repository_scan.pyon")
+    experiment_db = ExperimentDB(repo_backend, worker_handlers,
+                                 args.scan_concurrency, scan_cache)
     atexit.register(experiment_db.close)
 
-    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db)
+    if args.worker_max_memory is None:
+        worker_max_memory = None
+    else:
+        worker_max_memory = args.worker_max_memory*1024*1024
+    worker_pool = WorkerPool(worker_handlers, args.worker_pool_size,
+                             args.worker_max_runs, worker_max_memory)
+    scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db,
+                          worker_pool)
     scheduler.start()
     atexit_register_coroutine(scheduler.stop)
 
@@ -118,6 +172,9 @@ def main():
         "get_device": device_db.get,
         "get_dataset": dataset_db.get,
         "update_dataset": dataset_db.update,
+        "update_datasets": dataset_db.update_many,
+        "watch_dataset": dataset_db.watch,
+        "unwatch_dataset": dataset_db.unwatch,
         "scheduler_submit": scheduler.submit,
         "scheduler_delete": scheduler.delete,
         "scheduler_request_termination": scheduler.request_termination,
@@ -138,13 +195,13 @@ def main():
         bind, args.port_control))
     atexit_register_coroutine(server_control.stop)
 
-    server_notify = Publisher({
+    server_notify = CoalescingPublisher({
         "schedule": scheduler.notifier,
         "devices": device_db.data,
         "datasets": dataset_db.data,
         "explist": experiment_db.explist,
         "explist_status": experiment_db.status
-    })
+    }, args.notify_interval, args.notify_max_queue)
     loop.run_until_complete(server_notify.start(
         bind, args.port_notify))
     atexit_register_coroutine(server_notify.stop)
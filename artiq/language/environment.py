@@ -377,6 +377,23 @@ class HasEnvironment:
         efficiently as incremental modifications in broadcast mode."""
         self.__dataset_mgr.append_to(key, value)
 
+    def dataset_batch(self):
+        """Returns a context manager that groups the modifications of the
+        broadcast datasets made inside its ``with`` block.
+
+        Instead of being transmitted one by one, the modifications are sent
+        to the master together when the block exits, and the master applies
+        and publishes them at once. Use it to update many datasets, e.g. at
+        each point of a scan::
+
+            with self.dataset_batch():
+                self.mutate_dataset("counts", i, counts)
+                self.append_to_dataset("times", t)
+
+        Values broadcast inside the block are not seen by other experiments
+        and clients until it exits."""
+        return self.__dataset_mgr.batch()
+
     def get_dataset(self, key, default=NoDefault, archive=True):
         """Returns the contents of a dataset.
 
@@ -408,6 +425,36 @@ class HasEnvironment:
         dataset and of the attribute are the same."""
         setattr(self, key, self.get_dataset(key, default, archive))
 
+    def set_result_streaming(self, flush_period=10.0, compression=None,
+                             compression_opts=None, swmr=False):
+        """Writes the archived datasets to the result file during ``run()``.
+
+        The result file is then created when ``run()`` starts, and the
+        datasets modified with :meth:`append_to_dataset` and
+        :meth:`mutate_dataset` are stored in resizable, chunked HDF5 datasets
+        that are updated as they change. The results acquired so far are
+        thereby kept if the run fails, and with ``swmr`` the file can be
+        read by other programs while it is being written.
+
+        This function must be called before ``run()``, and only has an effect
+        on experiments run by the master.
+
+        :param flush_period: time in seconds after which the modifications
+            of the datasets are written to the file.
+        :param compression: HDF5 compression filter (e.g. ``"gzip"`` or
+            ``"lzf"``) applied to the streamed datasets.
+        :param compression_opts: options of the compression filter (e.g.
+            the compression level of ``"gzip"``).
+        :param swmr: write the file in single-writer multiple-reader mode.
+            This requires HDF5 1.10 or later to read the file. The file
+            is switched to that mode at the first flush, after which the
+            datasets that are set for the first time are only written at
+            the end of the run.
+        """
+        self.__dataset_mgr.set_result_streaming(
+            flush_period=flush_period, compression=compression,
+            compression_opts=compression_opts, swmr=swmr)
+
     def set_default_scheduling(self, priority=None, pipeline_name=None, flush=None):
         """Sets the default scheduling options.
 
@@ -1,11 +1,21 @@
 import asyncio
+import copy
+import glob
+import logging
+import os
 import tokenize
 
+import h5py
+import numpy
+
 from sipyco.sync_struct import Notifier, process_mod, update_from_dict
 from sipyco import pyon
 from sipyco.asyncio_tools import TaskObject
 
 
+logger = logging.getLogger(__name__)
+
+
 def device_db_from_file(filename):
     glbs = dict()
     with tokenize.open(filename) as f:
@@ -33,34 +43,321 @@ class DeviceDB:
         return desc
 
 
+class _PYONDatasetStore:
+    # Rewrites the whole file, when the persistent datasets have changed.
+    def __init__(self, filename):
+        self.filename = filename
+        self.dirty = False
+        self.snapshot = None
+
+    def load(self):
+        try:
+            return pyon.load_file(self.filename)
+        except FileNotFoundError:
+            return dict()
+
+    def log(self, mod):
+        self.dirty = True
+
+    def save(self, datasets):
+        pyon.store_file(self.filename, datasets)
+        self.dirty = False
+
+    async def autosave(self, get_datasets):
+        if self.dirty:
+            self.save(get_datasets())
+
+    def close(self, get_datasets):
+        if self.dirty:
+            self.save(get_datasets())
+
+
+def _read_snapshot(filename):
+    datasets = dict()
+    with h5py.File(filename, "r") as f:
+        generation = int(f.attrs["generation"])
+        for dataset in f["datasets"].values():
+            value = dataset[()]
+            if dataset.attrs.get("pyon", False):
+                if isinstance(value, bytes):
+                    value = value.decode()
+                value = pyon.decode(value)
+            datasets[dataset.attrs["key"]] = value
+    return datasets, generation
+
+
+def _write_snapshot(filename, datasets, generation):
+    temp_filename = filename + ".tmp"
+    with h5py.File(temp_filename, "w") as f:
+        f.attrs["generation"] = generation
+        group = f.create_group("datasets")
+        for index, (key, value) in enumerate(datasets.items()):
+            if (isinstance(value, (numpy.ndarray, numpy.generic))
+                    and value.dtype.kind in "biufc"):
+                dataset = group.create_dataset(str(index), data=value)
+            else:
+                dataset = group.create_dataset(str(index), data=pyon.encode(value))
+                dataset.attrs["pyon"] = True
+            dataset.attrs["key"] = key
+    fd = os.open(temp_filename, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(temp_filename, filename)
+
+
+class _HDF5DatasetStore:
+    """Keeps the persistent datasets in an HDF5 snapshot, and appends every
+    modification made since the snapshot was written to a write-ahead log.
+
+    Logs are numbered. A snapshot with generation ``n`` holds the datasets
+    as they were before the modifications in the logs numbered ``n`` or
+    more, which are replayed when loading. Compaction writes a new snapshot
+    in a thread, while the modifications made in the meantime go to a new
+    log. The thread reads the values that the datasets had when compaction
+    started, which are kept in :attr:`snapshot`; they must not be modified
+    in place until it is ``None`` again.
+    """
+    def __init__(self, filename, compact_min_size=4*1024*1024):
+        self.filename = filename
+        self.compact_min_size = compact_min_size
+
+        self.generation = 0
+        self._wal = None
+        self._wal_size = 0
+        self._wal_synced = True
+        self._snapshot_size = 0
+        self.snapshot = None
+
+    def _wal_filename(self, generation):
+        return "{}.{}.wal".format(self.filename, generation)
+
+    def _wal_generations(self):
+        generations = []
+        prefix = self.filename + "."
+        for filename in glob.glob(glob.escape(self.filename) + ".*.wal"):
+            try:
+                generations.append(int(filename[len(prefix):-len(".wal")]))
+            except ValueError:
+                pass
+        return sorted(generations)
+
+    def _replay(self, data, generation):
+        filename = self._wal_filename(generation)
+        with open(filename, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    mod = pyon.decode(line)
+                except Exception:
+                    # The master stopped while it was writing the last
+                    # modification.
+                    logger.warning("ignoring truncated entry in %s", filename)
+                    break
+                process_mod(data, mod)
+
+    def load(self):
+        try:
+            datasets, snapshot_generation = _read_snapshot(self.filename)
+            self._snapshot_size = os.path.getsize(self.filename)
+        except FileNotFoundError:
+            snapshot_generation = 0
+            pyon_filename = os.path.splitext(self.filename)[0] + ".pyon"
+            try:
+                datasets = pyon.load_file(pyon_filename)
+            except FileNotFoundError:
+                datasets = dict()
+            else:
+                logger.info("importing datasets from %s", pyon_filename)
+
+        data = {k: (True, v) for k, v in datasets.items()}
+        generations = self._wal_generations()
+        for generation in generations:
+            if generation >= snapshot_generation:
+                self._replay(data, generation)
+                # Compacted like the modifications made from now on.
+                self._wal_size += os.path.getsize(self._wal_filename(generation))
+            else:
+                os.unlink(self._wal_filename(generation))
+        # Never append to a log that may end with a truncated entry.
+        self.generation = max([snapshot_generation - 1] + generations) + 1
+        return {k: v[1] for k, v in data.items()}
+
+    def log(self, mod):
+        if self._wal is None:
+            self._wal = open(self._wal_filename(self.generation), "a",
+                             encoding="utf-8")
+        line = pyon.encode(mod) + "\n"
+        self._wal.write(line)
+        self._wal.flush()
+        self._wal_size += len(line)
+        self._wal_synced = False
+
+    def _sync_wal(self):
+        if self._wal is not None and not self._wal_synced:
+            os.fsync(self._wal.fileno())
+            self._wal_synced = True
+
+    def _start_compaction(self):
+        self._sync_wal()
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        self._wal_size = 0
+        self.generation += 1
+        return self.generation
+
+    def _finish_compaction(self, generation):
+        self._snapshot_size = os.path.getsize(self.filename)
+        for old_generation in self._wal_generations():
+            if old_generation < generation:
+                os.unlink(self._wal_filename(old_generation))
+
+    def save(self, datasets):
+        generation = self._start_compaction()
+        _write_snapshot(self.filename, datasets, generation)
+        self._finish_compaction(generation)
+
+    async def autosave(self, get_datasets):
+        if self._wal_size <= max(self.compact_min_size, self._snapshot_size):
+            self._sync_wal()
+            return
+        self.snapshot = get_datasets()
+        generation = self._start_compaction()
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, _write_snapshot, self.filename, self.snapshot,
+                generation)
+        finally:
+            self.snapshot = None
+        self._finish_compaction(generation)
+
+    def close(self, get_datasets):
+        self._sync_wal()
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+
+
 class DatasetDB(TaskObject):
+    """The datasets of the master, of which the persistent ones are stored
+    in ``persist_file``.
+
+    If the name of ``persist_file`` ends with ``.h5`` or ``.hdf5``, every
+    modification of the persistent datasets is appended to a write-ahead
+    log as it happens, and the log is regularly compacted into an HDF5
+    snapshot, written in the background. If that file does not exist yet,
+    the datasets are imported from the PYON file with the same base name.
+    Otherwise, the persistent datasets are stored in a PYON file that is
+    rewritten every ``autosave_period`` seconds if they have changed.
+    """
     def __init__(self, persist_file, autosave_period=30):
         self.persist_file = persist_file
         self.autosave_period = autosave_period
 
-        try:
-            file_data = pyon.load_file(self.persist_file)
-        except FileNotFoundError:
-            file_data = dict()
+        if os.path.splitext(persist_file)[1] in (".h5", ".hdf5"):
+            self._store = _HDF5DatasetStore(persist_file)
+        else:
+            self._store = _PYONDatasetStore(persist_file)
+        file_data = self._store.load()
         self.data = Notifier({k: (True, v) for k, v in file_data.items()})
+        self._watchers = dict()
+
+    def _persistent_datasets(self):
+        return {k: v[1] for k, v in self.data.raw_view.items() if v[0]}
 
     def save(self):
-        data = {k: v[1] for k, v in self.data.raw_view.items() if v[0]}
-        pyon.store_file(self.persist_file, data)
+        self._store.save(self._persistent_datasets())
 
     async def _do(self):
         try:
             while True:
                 await asyncio.sleep(self.autosave_period)
-                self.save()
+                await self._store.autosave(self._persistent_datasets)
         finally:
-            self.save()
+            self._store.close(self._persistent_datasets)
+
+    def _is_persistent(self, key):
+        return key in self.data.raw_view and self.data.raw_view[key][0]
+
+    def _log(self, mod, was_persistent):
+        # Only the modifications of persistent datasets are stored.
+        if mod["path"]:
+            if self._is_persistent(mod["path"][0]):
+                self._store.log(mod)
+        elif mod["action"] == "setitem" and not mod["value"][0]:
+            if was_persistent:
+                self._store.log({"action": "delitem", "path": [],
+                                 "key": mod["key"]})
+        elif mod["action"] != "delitem" or was_persistent:
+            self._store.log(mod)
 
     def get(self, key):
         return self.data.raw_view[key][1]
 
+    def _copy_on_write(self, key):
+        # A value being written to a snapshot is replaced by a copy before
+        # it is modified in place, rather than copying all the datasets
+        # when the snapshot is started.
+        snapshot = self._store.snapshot
+        if (snapshot is not None and key in self.data.raw_view
+                and snapshot.get(key) is self.data.raw_view[key][1]):
+            persist, value = self.data.raw_view[key]
+            self.data.raw_view[key] = persist, copy.deepcopy(value)
+
     def update(self, mod):
+        key = mod["path"][0] if mod["path"] else mod["key"]
+        was_persistent = self._is_persistent(key)
+        if mod["path"]:
+            self._copy_on_write(key)
         process_mod(self.data, mod)
+        self._log(mod, was_persistent)
+        for callback in self._watchers.pop(key, ()):
+            callback(key)
+
+    def _check_mods(self, mods):
+        # Applies the modifications to copies of the datasets that they
+        # modify in place, so that they raise here if any of them is invalid.
+        scratch = dict()
+        seen = set()
+        for mod in mods:
+            key = mod["path"][0] if mod["path"] else mod["key"]
+            if key not in seen:
+                seen.add(key)
+                if key in self.data.raw_view:
+                    if mod["path"]:
+                        scratch[key] = copy.deepcopy(self.data.raw_view[key])
+                    else:
+                        scratch[key] = None
+            if not mod["path"] and mod["action"] == "setitem":
+                persist, value = mod["value"]
+            process_mod(scratch, copy.deepcopy(mod))
+
+    def update_many(self, mods):
+        """Applies the modifications ``mods`` in order.
+
+        They are published together, as no notification is sent to the
+        subscribers before all of them are applied. If any of them is
+        invalid, none of them is applied."""
+        self._check_mods(mods)
+        for mod in mods:
+            self.update(mod)
+
+    def watch(self, key, callback):
+        """Call ``callback(key)`` the next time the dataset ``key`` is
+        modified, set or deleted.
+
+        Workers use this to invalidate the values they have cached.
+        """
+        self._watchers.setdefault(key, set()).add(callback)
+
+    def unwatch(self, key, callback):
+        """Cancels a call requested with :meth:`watch`."""
+        callbacks = self._watchers.get(key)
+        if callbacks is not None:
+            callbacks.discard(callback)
+            if not callbacks:
+                del self._watchers[key]
 
     # convenience functions (update() can be used instead)
     def set(self, key, value, persist=None):
@@ -69,8 +366,9 @@ class DatasetDB(TaskObject):
                 persist = self.data.raw_view[key][0]
             else:
                 persist = False
-        self.data[key] = (persist, value)
+        self.update({"action": "setitem", "path": [], "key": key,
+                     "value": (persist, value)})
 
     def delete(self, key):
-        del self.data[key]
+        self.update({"action": "delitem", "path": [], "key": key})
     #
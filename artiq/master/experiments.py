@@ -4,9 +4,12 @@ import tempfile
 import shutil
 import time
 import logging
+import hashlib
 
 from sipyco.sync_struct import Notifier, update_from_dict
+from sipyco import pyon
 
+from artiq import __version__ as artiq_version
 from artiq.master.worker import (Worker, WorkerInternalException,
                                  log_worker_exception)
 from artiq.tools import get_windows_drives, exc_to_warning
@@ -15,19 +18,132 @@ from artiq.tools import get_windows_drives, exc_to_warning
 logger = logging.getLogger(__name__)
 
 
+def _hash_value(value):
+    return hashlib.sha256(pyon.encode(value).encode()).hexdigest()
+
+
 class _RepoScanner:
-    def __init__(self, worker_handlers):
+    """Examines every experiment file in a repository.
+
+    Files are examined by up to ``concurrency`` workers at once, but their
+    results are merged in the order of a serial scan, so that duplicate
+    experiment names are resolved the same way regardless of timing.
+
+    ``cache`` maps file names to the result of examining them in an
+    earlier scan, along with the hashes of their contents, of the
+    repository modules they imported and of the datasets they read. Files
+    for which none of these have changed are not examined again. After the
+    scan, :attr:`cache` holds the results for the current files."""
+    def __init__(self, worker_handlers, concurrency=1, cache=None):
         self.worker_handlers = worker_handlers
-        self.worker = None
+        self.concurrency = concurrency
+        self.cache = dict() if cache is None else cache
+
+    def _walk(self, root, subdir=""):
+        # Returns a tree of (name, filename) tuples for experiment files
+        # and (name, subtree) tuples for directories, in scan order.
+        tree = []
+        for de in os.scandir(os.path.join(root, subdir)):
+            if de.name.startswith("."):
+                continue
+            if de.is_file() and de.name.endswith(".py"):
+                tree.append((de.name, os.path.join(subdir, de.name)))
+            if de.is_dir():
+                tree.append((de.name,
+                             self._walk(root, os.path.join(subdir, de.name))))
+        return tree
+
+    def _files(self, tree):
+        for name, entry in tree:
+            if isinstance(entry, str):
+                yield entry
+            else:
+                yield from self._files(entry)
+
+    def _hash_file(self, root, filename, hashes):
+        if filename not in hashes:
+            try:
+                with open(os.path.join(root, filename), "rb") as f:
+                    hashes[filename] = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                hashes[filename] = None
+        return hashes[filename]
+
+    def _hash_dataset(self, key, hashes):
+        # Returns None for datasets that do not exist, which experiments
+        # may handle by using a default value.
+        if key not in hashes:
+            try:
+                value = self.worker_handlers["get_dataset"](key)
+            except KeyError:
+                hashes[key] = None
+            else:
+                hashes[key] = _hash_value(value)
+        return hashes[key]
+
+    def _is_current(self, root, cached, hashes, dataset_hashes):
+        if "imports" not in cached or "datasets" not in cached:
+            return False
+        for filename, digest in cached["imports"].items():
+            if self._hash_file(root, filename, hashes) != digest:
+                return False
+        for key, digest in cached["datasets"].items():
+            if self._hash_dataset(key, dataset_hashes) != digest:
+                return False
+        return True
+
+    def _repository_imports(self, root, filename, imports):
+        r = set()
+        for path in imports:
+            path = os.path.relpath(os.path.abspath(path), root)
+            if (path != filename and path != os.pardir
+                    and not path.startswith(os.pardir + os.sep)):
+                r.add(path)
+        return r
 
-    async def process_file(self, entry_dict, root, filename):
-        logger.debug("processing file %s %s", root, filename)
+    async def _examine_files(self, root, queue, descriptions, dependencies):
+        # Maps the keys of the datasets read by the file being examined
+        # to the hashes of the values it received.
+        datasets = dict()
+        handlers = dict(self.worker_handlers)
+        if "get_dataset" in handlers:
+            def get_dataset(key):
+                datasets[key] = None
+                value = self.worker_handlers["get_dataset"](key)
+                datasets[key] = _hash_value(value)
+                return value
+            handlers["get_dataset"] = get_dataset
+        worker = Worker(handlers)
         try:
-            description = await self.worker.examine(
-                "scan", os.path.join(root, filename))
-        except:
-            log_worker_exception()
-            raise
+            while not queue.empty():
+                filename = queue.get_nowait()
+                logger.debug("processing file %s %s", root, filename)
+                t1 = time.monotonic()
+                datasets.clear()
+                imports = []
+                try:
+                    try:
+                        descriptions[filename] = await worker.examine(
+                            "scan", os.path.join(root, filename),
+                            imports=imports)
+                        dependencies[filename] = (
+                            self._repository_imports(root, filename, imports),
+                            dict(datasets))
+                    except:
+                        log_worker_exception()
+                        raise
+                except Exception as exc:
+                    logger.warning("Skipping file '%s'", filename,
+                        exc_info=not isinstance(exc, WorkerInternalException))
+                    # restart worker
+                    await worker.close()
+                    worker = Worker(handlers)
+                logger.debug("examining file %s took %.3f seconds",
+                             filename, time.monotonic()-t1)
+        finally:
+            await worker.close()
+
+    def _add_entries(self, entry_dict, filename, description):
         for class_name, class_desc in description.items():
             name = class_desc["name"]
             arginfo = class_desc["arginfo"]
@@ -52,41 +168,106 @@ class _RepoScanner:
             }
             entry_dict[name] = entry
 
-    async def _scan(self, root, subdir=""):
+    def _merge(self, tree, descriptions):
         entry_dict = dict()
-        for de in os.scandir(os.path.join(root, subdir)):
-            if de.name.startswith("."):
-                continue
-            if de.is_file() and de.name.endswith(".py"):
-                filename = os.path.join(subdir, de.name)
-                try:
-                    await self.process_file(entry_dict, root, filename)
-                except Exception as exc:
-                    logger.warning("Skipping file '%s'", filename,
-                        exc_info=not isinstance(exc, WorkerInternalException))
-                    # restart worker
-                    await self.worker.close()
-                    self.worker = Worker(self.worker_handlers)
-            if de.is_dir():
-                subentries = await self._scan(
-                    root, os.path.join(subdir, de.name))
-                entries = {de.name + "/" + k: v for k, v in subentries.items()}
+        for name, entry in tree:
+            if isinstance(entry, str):
+                if entry in descriptions:
+                    self._add_entries(entry_dict, entry, descriptions[entry])
+            else:
+                subentries = self._merge(entry, descriptions)
+                entries = {name + "/" + k: v for k, v in subentries.items()}
                 entry_dict.update(entries)
         return entry_dict
 
     async def scan(self, root):
-        self.worker = Worker(self.worker_handlers)
-        try:
-            r = await self._scan(root)
-        finally:
-            await self.worker.close()
-        return r
+        tree = self._walk(root)
+        queue = asyncio.Queue()
+        descriptions = dict()
+        hashes = dict()
+        dataset_hashes = dict()
+        cache = dict()
+        for filename in self._files(tree):
+            digest = self._hash_file(root, filename, hashes)
+            cached = self.cache.get(filename)
+            if (digest is not None and cached is not None
+                    and cached["hash"] == digest
+                    and self._is_current(root, cached, hashes,
+                                         dataset_hashes)):
+                descriptions[filename] = cached["description"]
+                cache[filename] = cached
+            else:
+                queue.put_nowait(filename)
+        logger.debug("examining %d files, %d unchanged",
+                     queue.qsize(), len(descriptions))
+        dependencies = dict()
+        concurrency = max(1, min(self.concurrency, queue.qsize()))
+        await asyncio.gather(*[self._examine_files(root, queue, descriptions,
+                                                   dependencies)
+                               for _ in range(concurrency)])
+        for filename, (imports, datasets) in dependencies.items():
+            digest = self._hash_file(root, filename, hashes)
+            if digest is None:
+                continue
+            cache[filename] = {
+                "hash": digest,
+                "description": descriptions[filename],
+                "imports": {path: self._hash_file(root, path, hashes)
+                            for path in imports},
+                "datasets": datasets
+            }
+        self.cache = cache
+        return self._merge(tree, descriptions)
+
+
+class _ScanCache:
+    """Persistent cache of :class:`_RepoScanner` results.
+
+    The whole cache is discarded when the ARTIQ version or the device
+    database changes, since both can affect the result of examining a file.
+    Changes to the modules and datasets used by individual files are
+    detected by :class:`_RepoScanner`."""
+    def __init__(self, persist_file=None):
+        self.persist_file = persist_file
+        self.environment = None
+        self.files = dict()
+        if persist_file is not None:
+            try:
+                data = pyon.load_file(persist_file)
+                self.environment = data["environment"]
+                self.files = data["files"]
+            except FileNotFoundError:
+                pass
+            except:
+                logger.warning("failed to load repository scan cache from '%s'",
+                               persist_file, exc_info=True)
+
+    def get(self, environment):
+        if environment != self.environment:
+            return dict()
+        return self.files
+
+    def update(self, environment, files):
+        self.environment = environment
+        self.files = files
+        if self.persist_file is not None:
+            try:
+                pyon.store_file(self.persist_file, {
+                    "environment": environment,
+                    "files": files
+                })
+            except OSError:
+                logger.warning("failed to save repository scan cache to '%s'",
+                               self.persist_file, exc_info=True)
 
 
 class ExperimentDB:
-    def __init__(self, repo_backend, worker_handlers):
+    def __init__(self, repo_backend, worker_handlers, scan_concurrency=1,
+                 scan_cache_file=None):
         self.repo_backend = repo_backend
         self.worker_handlers = worker_handlers
+        self.scan_concurrency = scan_concurrency
+        self.scan_cache = _ScanCache(scan_cache_file)
 
         self.cur_rev = self.repo_backend.get_head_rev()
         self.repo_backend.request_rev(self.cur_rev)
@@ -115,13 +296,27 @@ class ExperimentDB:
             self.cur_rev = new_cur_rev
             self.status["cur_rev"] = new_cur_rev
             t1 = time.monotonic()
-            new_explist = await _RepoScanner(self.worker_handlers).scan(wd)
+            environment = self._scan_environment()
+            scanner = _RepoScanner(self.worker_handlers, self.scan_concurrency,
+                                   self.scan_cache.get(environment))
+            new_explist = await scanner.scan(wd)
+            self.scan_cache.update(environment, scanner.cache)
             logger.info("repository scan took %d seconds", time.monotonic()-t1)
             update_from_dict(self.explist, new_explist)
         finally:
             self._scanning = False
             self.status["scanning"] = False
 
+    def _scan_environment(self):
+        # Identifies everything besides the file contents that the result
+        # of a repository scan depends on.
+        if "get_device_db" in self.worker_handlers:
+            device_db = pyon.encode(self.worker_handlers["get_device_db"]())
+            device_db_hash = hashlib.sha256(device_db.encode()).hexdigest()
+        else:
+            device_db_hash = None
+        return {"artiq_version": artiq_version, "device_db": device_db_hash}
+
     def scan_repository_async(self, new_cur_rev=None):
         asyncio.ensure_future(
             exc_to_warning(self.scan_repository(new_cur_rev)))
@@ -160,6 +355,9 @@ class ExperimentDB:
 
 
 class FilesystemBackend:
+    # The files of a revision may be modified while it is used.
+    immutable_revisions = False
+
     def __init__(self, root):
         self.root = os.path.abspath(root)
 
@@ -188,6 +386,8 @@ class _GitCheckout:
 
 
 class GitBackend:
+    immutable_revisions = True
+
     def __init__(self, root):
         # lazy import - make dependency optional
         import pygit2
@@ -0,0 +1,284 @@
+"""
+Publication of the master's notifiers to dashboards, applets and clients.
+
+:class:`CoalescingPublisher` speaks the same protocol as
+:class:`sipyco.sync_struct.Publisher`, but does not forward every
+modification as soon as it happens. Modifications are accumulated
+for at most ``interval`` seconds, and a ``setitem`` replaces the
+buffered modifications it overwrites, so that a dataset updated at kHz
+rates only produces a few messages per second.
+
+Subscribers of a notifier whose structure is a dictionary may restrict
+their subscription to some of its keys, by connecting with the name
+returned by :func:`subscription_name`. They then only receive these
+keys in the ``init`` message, and only the modifications made to them.
+
+Each subscriber has its own outgoing queue. When a subscriber reads its
+messages slower than they are produced and its queue exceeds
+``max_queue`` modifications, the queue is replaced with a single
+``init`` message carrying the current state of the structure.
+"""
+
+import asyncio
+import logging
+import time
+from functools import partial
+
+from sipyco import pyon
+from sipyco.asyncio_tools import AsyncioServer
+
+
+logger = logging.getLogger(__name__)
+
+
+_protocol_banner = b"ARTIQ sync_struct\n"
+
+
+def _target(mod):
+    # Path of the item that a modification changes, and whether it changes
+    # the contents of that item rather than replacing or deleting it.
+    action = mod["action"]
+    if action in ("setitem", "delitem"):
+        return tuple(mod["path"]) + (mod["key"], ), False
+    elif action in ("append", "insert", "pop"):
+        return tuple(mod["path"]), True
+    else:
+        return (), False
+
+
+def _encode(obj):
+    return (pyon.encode(obj) + "\n").encode()
+
+
+def subscription_name(notifier_name, keys=(), prefixes=()):
+    """Return the name to subscribe with to receive only the given keys of
+    a dictionary published by a :class:`CoalescingPublisher`, and the keys
+    starting with one of the given prefixes. ``None`` entries, such as
+    unset optional datasets of an applet, are ignored."""
+    return notifier_name + "?" + pyon.encode(
+        {"keys": sorted(k for k in keys if k is not None),
+         "prefixes": sorted(p for p in prefixes if p is not None)})
+
+
+class _KeyFilter:
+    def __init__(self, keys, prefixes):
+        self.keys = set(keys)
+        self.prefixes = tuple(prefixes)
+        if not all(isinstance(prefix, str) for prefix in self.prefixes):
+            raise TypeError("key prefixes must be strings")
+
+    def __call__(self, key):
+        if key in self.keys:
+            return True
+        return isinstance(key, str) and key.startswith(self.prefixes)
+
+    def struct(self, struct):
+        return {k: v for k, v in struct.items() if self(k)}
+
+
+class Coalescer:
+    """Buffers the modifications of a notifier, dropping those that are
+    overwritten by a later ``setitem`` before they are sent.
+
+    Modifications are encoded when they are added, since their values
+    may be modified in place by the modifications that follow.
+
+    A ``setitem`` supersedes the previous ``setitem`` of the same item
+    and the modifications made inside that item since then, unless a
+    modification of the item itself or of a container holding it (such
+    as an ``insert`` shifting list indices) happened in between.
+    """
+    def __init__(self):
+        # (target, in_place, line), None for the superseded modifications
+        self.mods = []
+        self._setitems = dict()
+
+    def __len__(self):
+        return len(self.mods)
+
+    def add(self, mod):
+        target, in_place = _target(mod)
+        if mod["action"] == "setitem":
+            index = self._setitems.get(target)
+            if index is not None and self.mods[index] is not None:
+                self._supersede(index, target)
+            self._setitems[target] = len(self.mods)
+        self.mods.append((target, in_place, _encode(mod)))
+
+    def _supersede(self, index, target):
+        depth = len(target)
+        inside = [index]
+        for i in range(index + 1, len(self.mods)):
+            mod = self.mods[i]
+            if mod is None:
+                continue
+            mod_target, in_place, _ = mod
+            if (len(mod_target) > depth or (in_place and len(mod_target) == depth)) \
+                    and mod_target[:depth] == target:
+                inside.append(i)
+            elif target[:len(mod_target)] == mod_target:
+                return
+        for i in inside:
+            self.mods[i] = None
+
+    def take(self):
+        """Return the buffered modifications, in order, and clear the buffer.
+
+        Each modification is returned as a pair of the top-level key it
+        changes (``None`` if it changes the structure itself) and its
+        encoded line.
+        """
+        mods = [(target[0] if target else None, line)
+                for target, _, line in filter(None, self.mods)]
+        self.mods = []
+        self._setitems.clear()
+        return mods
+
+
+class _Subscriber:
+    def __init__(self, max_queue, key_filter):
+        self.max_queue = max_queue
+        self.key_filter = key_filter
+        self.lines = []
+        self.count = 0
+        self.dropped = False
+        self.ready = asyncio.Event()
+
+    def put(self, mods, init_line):
+        if self.key_filter is None:
+            lines = [line for key, line in mods]
+        else:
+            lines = [line for key, line in mods
+                     if key is None or self.key_filter(key)]
+            if not lines:
+                return
+        if self.count + len(lines) > self.max_queue:
+            self.lines = [init_line(self.key_filter)]
+            self.count = 1
+            self.dropped = True
+        else:
+            self.lines += lines
+            self.count += len(lines)
+        self.ready.set()
+
+    async def get(self):
+        await self.ready.wait()
+        self.ready.clear()
+        data = b"".join(self.lines)
+        self.lines = []
+        self.count = 0
+        return data
+
+
+class CoalescingPublisher(AsyncioServer):
+    """
+    :param notifiers: dictionary of the notifiers to publish, by name.
+    :param interval: minimum time in seconds between two messages to the
+        subscribers of a notifier. Modifications made in the meantime are
+        coalesced and sent together. With 0, every modification is
+        sent on the next iteration of the event loop.
+    :param max_queue: number of modifications that may be waiting to be
+        sent to a subscriber before it is resynchronized with an ``init``
+        message instead.
+    """
+    def __init__(self, notifiers, interval=0.1, max_queue=1000):
+        AsyncioServer.__init__(self)
+        self.notifiers = notifiers
+        self.interval = interval
+        self.max_queue = max_queue
+
+        self._coalescers = {name: Coalescer() for name in notifiers}
+        self._recipients = {name: set() for name in notifiers}
+        self._last_flush = {name: 0.0 for name in notifiers}
+        self._flush_handles = dict()
+        for name, notifier in notifiers.items():
+            notifier.publish = partial(self.publish, name)
+
+    def publish(self, name, mod):
+        self._coalescers[name].add(mod)
+        if name not in self._flush_handles:
+            delay = self._last_flush[name] + self.interval - time.monotonic()
+            self._flush_handles[name] = asyncio.get_event_loop().call_later(
+                max(delay, 0), self.flush, name)
+
+    def _init_line(self, name, key_filter=None):
+        struct = self.notifiers[name].raw_view
+        if key_filter is not None:
+            struct = key_filter.struct(struct)
+        return _encode({"action": "init", "struct": struct})
+
+    def flush(self, name):
+        """Send the buffered modifications of the notifier ``name``."""
+        handle = self._flush_handles.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+        self._last_flush[name] = time.monotonic()
+        mods = self._coalescers[name].take()
+        recipients = self._recipients[name]
+        if not mods or not recipients:
+            return
+
+        init_line = None
+        def get_init_line(key_filter):
+            nonlocal init_line
+            if key_filter is not None:
+                return self._init_line(name, key_filter)
+            if init_line is None:
+                init_line = self._init_line(name)
+            return init_line
+        for recipient in recipients:
+            recipient.put(mods, get_init_line)
+
+    async def _handle_connection_cr(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if line != _protocol_banner:
+                return
+
+            line = await reader.readline()
+            if not line:
+                return
+            name = line.decode()[:-1]
+            key_filter = None
+            if "?" in name:
+                name, filter_desc = name.split("?", 1)
+                try:
+                    desc = pyon.decode(filter_desc)
+                    key_filter = _KeyFilter(desc["keys"], desc["prefixes"])
+                except Exception:
+                    # pyon.decode raises whatever evaluating the
+                    # description raises
+                    logger.warning("invalid subscription filter for '%s': %s",
+                                   name, filter_desc)
+                    return
+            if name not in self.notifiers:
+                return
+            if (key_filter is not None
+                    and not isinstance(self.notifiers[name].raw_view, dict)):
+                return
+
+            # The notifier already holds the buffered modifications, so
+            # they must not be sent to the new subscriber after its
+            # initial state.
+            self.flush(name)
+            writer.write(self._init_line(name, key_filter))
+
+            subscriber = _Subscriber(self.max_queue, key_filter)
+            self._recipients[name].add(subscriber)
+            try:
+                while True:
+                    data = await subscriber.get()
+                    if subscriber.dropped:
+                        logger.debug("subscriber of '%s' is too slow, "
+                                     "resynchronizing it", name)
+                        subscriber.dropped = False
+                    writer.write(data)
+                    # raise exception on connection error
+                    await writer.drain()
+            finally:
+                self._recipients[name].remove(subscriber)
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+            # subscribers disconnecting are a normal occurrence
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,258 @@
+"""
+Incremental writing of the HDF5 result file of a run.
+
+By default, a worker writes the results of a run in one go, after
+``analyze()`` or when ``run()`` fails. When an experiment enables
+streaming with :meth:`artiq.language.environment.HasEnvironment.set_result_streaming`,
+the result file is instead created when ``run()`` starts, and the archived
+datasets that the experiment grows with ``append_to_dataset`` or modifies
+with ``mutate_dataset`` are written to it as they change, in resizable
+chunked HDF5 datasets. The data acquired so far therefore survives a crash
+of the worker, and in SWMR mode the file can be read while it is written.
+"""
+
+import logging
+import threading
+import time
+
+import numpy
+import h5py
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_dataset(group, k, v):
+    # Add context to exception message when the user writes a dataset that is
+    # not representable in HDF5.
+    try:
+        group[k] = v
+    except TypeError as e:
+        raise TypeError("Error writing dataset '{}' of type '{}': {}".format(
+            k, type(v), e))
+
+
+class _Pending:
+    def __init__(self):
+        # indices mutated since the last flush; None if the whole dataset
+        # must be rewritten
+        self.indices = []
+        self.appended = False
+
+
+class ResultStream:
+    """Writes the archived datasets of a run to ``filename`` as they change.
+
+    The lists and arrays already set when the stream is created are
+    created in the file immediately, as resizable datasets. The others
+    are created when they are first grown or modified, up to the first
+    flush in SWMR mode, after which no object can be created in the file:
+    the datasets that would need to be created or recreated are then
+    written when the stream is closed.
+
+    :param datasets: the dictionary of archived datasets of the run
+        (:attr:`artiq.master.worker_db.DatasetManager.local`).
+    :param metadata: dictionary of the attributes of the run (RID, start
+        time, etc.) written at the root of the file when it is created.
+    :param flush_period: time in seconds after which the modifications of
+        the datasets are written to the file, even if the datasets are not
+        modified anymore.
+    :param compression: HDF5 compression filter of the streamed datasets,
+        e.g. ``"gzip"`` or ``"lzf"``, as accepted by :mod:`h5py`.
+    :param compression_opts: options of the compression filter.
+    :param swmr: switch the file to single-writer multiple-reader mode at
+        the first flush, so that other processes can read it while it is
+        written.
+    """
+    def __init__(self, filename, datasets, metadata, flush_period=10.0,
+                 compression=None, compression_opts=None, swmr=False):
+        self.filename = filename
+        self.datasets = datasets
+        self.flush_period = flush_period
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.swmr = swmr
+
+        self._pending = dict()
+        self._streamed = set()
+        # datasets written when the stream is closed
+        self._deferred = set()
+        self._swmr_started = False
+        self._last_flush = time.monotonic()
+        # held while the file or the pending modifications are used, as
+        # they are also flushed periodically from another thread
+        self._lock = threading.Lock()
+
+        if swmr:
+            self.file = h5py.File(filename, "w", libver="latest")
+        else:
+            self.file = h5py.File(filename, "w")
+        group = self.file.create_group("datasets")
+        for k, v in metadata.items():
+            self.file[k] = v
+        for key, value in datasets.items():
+            data = numpy.asarray(value)
+            # The type of the elements of empty lists is not known yet.
+            if data.ndim > 0 and data.shape[0] and not data.dtype.hasobject:
+                self._create(group, key, value)
+
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_period > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_period):
+            try:
+                self.flush()
+            except:
+                logger.warning("failed to flush the result file",
+                               exc_info=True)
+
+    def _pending_for(self, key):
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _Pending()
+        return pending
+
+    def appended(self, key):
+        """Record that a value was appended to the dataset ``key``."""
+        with self._lock:
+            self._pending_for(key).appended = True
+        self._flush_if_due()
+
+    def mutated(self, key, index):
+        """Record that the dataset ``key`` was modified at ``index``."""
+        with self._lock:
+            pending = self._pending_for(key)
+            if pending.indices is not None:
+                pending.indices.append(index)
+        self._flush_if_due()
+
+    def replaced(self, key):
+        """Record that the dataset ``key`` was set or deleted."""
+        with self._lock:
+            if key in self._streamed or key in self._pending:
+                self._pending_for(key).indices = None
+            else:
+                return
+        self._flush_if_due()
+
+    def _flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.flush_period:
+            self.flush()
+
+    def _create(self, group, key, value):
+        try:
+            data = numpy.asarray(value)
+            if data.ndim == 0 or data.dtype.hasobject:
+                # not extensible; rewritten whenever it changes
+                write_dataset(group, key, value)
+            else:
+                group.create_dataset(key, data=data, chunks=True,
+                                     maxshape=(None, ) + data.shape[1:],
+                                     compression=self.compression,
+                                     compression_opts=self.compression_opts)
+        except (TypeError, ValueError):
+            # Reported when the results are written at the end of the
+            # run, as without streaming.
+            logger.warning("cannot stream dataset '%s', writing it "
+                           "at the end of the run", key, exc_info=True)
+            if key in group:
+                del group[key]
+            self._deferred.add(key)
+        else:
+            self._streamed.add(key)
+
+    def _update(self, dataset, value, pending):
+        # Write the modifications into the existing dataset. Returns False
+        # if it has to be created again instead.
+        data = numpy.asarray(value)
+        if (data.dtype != dataset.dtype or data.ndim != dataset.ndim
+                or data.shape[1:] != dataset.shape[1:]):
+            return False
+        if data.ndim == 0:
+            dataset[()] = data
+            return True
+        if dataset.chunks is None:
+            return False
+        start = dataset.shape[0]
+        if data.shape[0] != start:
+            dataset.resize(data.shape[0], axis=0)
+        if pending.indices is None or (pending.indices and data.shape[0] != start):
+            dataset[...] = data
+        elif pending.indices:
+            try:
+                for index in pending.indices:
+                    dataset[index] = data[index]
+            except (TypeError, ValueError):
+                # index not supported by h5py, e.g. negative steps
+                dataset[...] = data
+        elif data.shape[0] > start:
+            dataset[start:] = data[start:]
+        elif data.shape[0] < start:
+            dataset[...] = data
+        return True
+
+    def flush(self):
+        """Write the pending modifications of the datasets to the file."""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            pending, self._pending = self._pending, dict()
+
+            group = self.file["datasets"]
+            for key, key_pending in pending.items():
+                if key in self._deferred:
+                    continue
+                if key not in self.datasets:
+                    if key in self._streamed:
+                        if self._swmr_started:
+                            self._deferred.add(key)
+                        else:
+                            del group[key]
+                            self._streamed.discard(key)
+                    continue
+                value = self.datasets[key]
+                if (key in self._streamed
+                        and self._update(group[key], value, key_pending)):
+                    continue
+                if self._swmr_started:
+                    logger.debug("dataset '%s' cannot be created in SWMR "
+                                 "mode, writing it at the end of the run",
+                                 key)
+                    self._deferred.add(key)
+                else:
+                    if key in group:
+                        del group[key]
+                        self._streamed.discard(key)
+                    self._create(group, key, value)
+
+            if self.swmr and not self._swmr_started:
+                self.file.swmr_mode = True
+                self._swmr_started = True
+            self.file.flush()
+
+    def close(self, archive):
+        """Write the remaining datasets and the ``archive`` group, and close
+        the file."""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        if self._swmr_started:
+            # Objects cannot be created in SWMR mode.
+            self.file.close()
+            self.file = h5py.File(self.filename, "a", libver="latest")
+        group = self.file["datasets"]
+        for key in self._deferred:
+            if key in group:
+                del group[key]
+        for k, v in self.datasets.items():
+            if k not in self._streamed or k in self._deferred:
+                write_dataset(group, k, v)
+        archive_group = self.file.create_group("archive")
+        for k, v in archive.items():
+            write_dataset(archive_group, k, v)
+        self.file.close()
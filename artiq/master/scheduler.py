@@ -1,4 +1,5 @@
 import asyncio
+import heapq
 import logging
 from enum import Enum
 from time import time
@@ -6,7 +7,7 @@ from time import time
 from sipyco.sync_struct import Notifier
 from sipyco.asyncio_tools import TaskObject, Condition
 
-from artiq.master.worker import Worker, log_worker_exception
+from artiq.master.worker import Worker, WorkerPool, log_worker_exception
 from artiq.tools import asyncio_wait_or_cancel
 
 
@@ -48,7 +49,7 @@ def _mk_worker_method(name):
 class Run:
     def __init__(self, rid, pipeline_name,
                  wd, expid, priority, due_date, flush,
-                 pool, **kwargs):
+                 pool, reuse_worker=False, **kwargs):
         # called through pool
         self.rid = rid
         self.pipeline_name = pipeline_name
@@ -57,8 +58,12 @@ class Run:
         self.priority = priority
         self.due_date = due_date
         self.flush = flush
+        self.reuse_worker = reuse_worker
 
-        self.worker = Worker(pool.worker_handlers)
+        # Replaced by a started worker from the pool when the run is
+        # built, so that the pool does not wait for the run to be due.
+        self.worker = Worker(pool.worker_pool.handlers)
+        self._worker_pool = pool.worker_pool
         self.termination_requested = False
 
         self._status = RunStatus.pending
@@ -75,6 +80,7 @@ class Run:
         self._notifier = pool.notifier
         self._notifier[self.rid] = notification
         self._state_changed = pool.state_changed
+        self._status_changed = pool.status_changed
 
     @property
     def status(self):
@@ -82,6 +88,7 @@ class Run:
 
     @status.setter
     def status(self, value):
+        self._status_changed(self, self._status, value)
         self._status = value
         if not self.worker.closed.is_set():
             self._notifier[self.rid]["status"] = self._status.name
@@ -96,12 +103,15 @@ class Run:
 
     async def close(self):
         # called through pool
-        await self.worker.close()
+        await self._worker_pool.release(self.worker)
         del self._notifier[self.rid]
 
     _build = _mk_worker_method("build")
 
     async def build(self):
+        if not self.worker.closed.is_set():
+            self.worker = self._worker_pool.get(
+                self.wd if self.reuse_worker else None)
         await self._build(self.rid, self.pipeline_name,
                           self.wd, self.expid,
                           self.priority)
@@ -112,13 +122,64 @@ class Run:
     analyze = _mk_worker_method("analyze")
 
 
+class _RunQueue:
+    """Heap of runs ordered by ``key``, smallest first.
+
+    Runs are removed lazily: their heap entries are discarded when they
+    reach the top, or when stale entries outnumber the live ones.
+    """
+    def __init__(self, key):
+        self._key = key
+        self._heap = []
+        self._entries = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, run):
+        entry = (self._key(run), run.rid, run)
+        self._entries[run.rid] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, run):
+        if self._entries.pop(run.rid, None) is None:
+            return
+        if len(self._heap) > 2*len(self._entries) + 16:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def peek(self):
+        """Return the first run, or ``None`` if the queue is empty."""
+        heap = self._heap
+        while heap and self._entries.get(heap[0][1]) is not heap[0]:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][2]
+        else:
+            return None
+
+
+def _priority_order(run):
+    return tuple(-x for x in run.priority_key())
+
+
 class RunPool:
-    def __init__(self, ridc, worker_handlers, notifier, experiment_db):
+    def __init__(self, ridc, worker_pool, notifier, experiment_db):
         self.runs = dict()
         self.state_changed = Condition()
 
+        # Runs waiting in the stages, by status. Pending runs are in the
+        # pending queue once their due date has elapsed, and in the due
+        # date queue until then.
+        self._queues = {
+            RunStatus.pending: _RunQueue(_priority_order),
+            RunStatus.prepare_done: _RunQueue(_priority_order),
+            RunStatus.run_done: _RunQueue(_priority_order),
+        }
+        self._due = _RunQueue(lambda run: run.due_date)
+
         self.ridc = ridc
-        self.worker_handlers = worker_handlers
+        self.worker_pool = worker_pool
         self.notifier = notifier
         self.experiment_db = experiment_db
 
@@ -129,21 +190,65 @@ class RunPool:
         if "repo_rev" in expid:
             if expid["repo_rev"] is None:
                 expid["repo_rev"] = self.experiment_db.cur_rev
-            wd, repo_msg = self.experiment_db.repo_backend.request_rev(
-                expid["repo_rev"])
+            repo_backend = self.experiment_db.repo_backend
+            wd, repo_msg = repo_backend.request_rev(expid["repo_rev"])
+            # The modules that experiments import stay loaded in reused
+            # workers, so they are only reused when these cannot change.
+            reuse_worker = repo_backend.immutable_revisions
         else:
             wd, repo_msg = None, None
+            reuse_worker = False
         run = Run(rid, pipeline_name, wd, expid, priority, due_date, flush,
-                  self, repo_msg=repo_msg)
+                  self, reuse_worker, repo_msg=repo_msg)
         self.runs[rid] = run
+        self._enqueue(run, run.status)
         self.state_changed.notify()
         return rid
 
+    def _enqueue(self, run, status):
+        if status == RunStatus.pending and run.due_date is not None:
+            self._due.push(run)
+        elif status in self._queues:
+            self._queues[status].push(run)
+
+    def _dequeue(self, run, status):
+        if status == RunStatus.pending:
+            self._due.remove(run)
+        if status in self._queues:
+            self._queues[status].remove(run)
+
+    def status_changed(self, run, old_status, new_status):
+        # called by Run before its status changes
+        if run.rid in self.runs:
+            self._dequeue(run, old_status)
+            self._enqueue(run, new_status)
+
+    def next_run(self, status):
+        """Return the run with the given status that has the highest
+        priority, or ``None``.
+
+        For pending runs, only those whose due date has elapsed at the last
+        call of :meth:`next_due_run` are considered."""
+        return self._queues[status].peek()
+
+    def next_due_run(self, now):
+        """Make the pending runs due before ``now`` eligible for
+        :meth:`next_run`, and return the pending run that becomes due next,
+        or ``None``."""
+        pending = self._queues[RunStatus.pending]
+        while True:
+            run = self._due.peek()
+            if run is None or run.due_date >= now:
+                return run
+            self._due.remove(run)
+            pending.push(run)
+
     async def delete(self, rid):
         # called through deleter
         if rid not in self.runs:
             return
         run = self.runs[rid]
+        self._dequeue(run, run.status)
         await run.close()
         if "repo_rev" in run.expid:
             self.experiment_db.repo_backend.release_rev(run.expid["repo_rev"])
@@ -164,29 +269,22 @@ class PrepareStage(TaskObject):
         of them are going to become next-in-line before further pool state
         changes (which will also cause a re-evaluation).
         """
-        pending_runs = list(
-            filter(lambda r: r.status == RunStatus.pending,
-                   self.pool.runs.values()))
-
         now = time()
-        def is_runnable(r):
-            return (r.due_date or 0) < now
+        next_due = self.pool.next_due_run(now)
 
-        prepared_max = max((r.priority_key() for r in self.pool.runs.values()
-                            if r.status == RunStatus.prepare_done),
-                           default=None)
+        prepared = self.pool.next_run(RunStatus.prepare_done)
         def takes_precedence(r):
-            return prepared_max is None or r.priority_key() > prepared_max
+            return prepared is None or r.priority_key() > prepared.priority_key()
 
-        candidate = max(filter(is_runnable, pending_runs),
-                        key=lambda r: r.priority_key(),
-                        default=None)
+        candidate = self.pool.next_run(RunStatus.pending)
         if candidate is not None and takes_precedence(candidate):
             return candidate
 
-        return min((r.due_date - now for r in pending_runs
-                    if (not is_runnable(r) and takes_precedence(r))),
-                   default=None)
+        # Wake up when the next run becomes due, even if it does not take
+        # precedence: a later one may, and finding it would require a scan.
+        if next_due is None:
+            return None
+        return float(next_due.due_date - now)
 
     async def _do(self):
         while True:
@@ -231,14 +329,7 @@ class RunStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                               self.pool.runs.values())
-        try:
-            r = max(prepared_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # prepared_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.next_run(RunStatus.prepare_done)
 
     async def _do(self):
         stack = []
@@ -285,14 +376,7 @@ class AnalyzeStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        run_runs = filter(lambda r: r.status == RunStatus.run_done,
-                          self.pool.runs.values())
-        try:
-            r = max(run_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # run_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.next_run(RunStatus.run_done)
 
     async def _do(self):
         while True:
@@ -311,8 +395,8 @@ class AnalyzeStage(TaskObject):
 
 
 class Pipeline:
-    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db):
-        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db)
+    def __init__(self, ridc, deleter, worker_pool, notifier, experiment_db):
+        self.pool = RunPool(ridc, worker_pool, notifier, experiment_db)
         self._prepare = PrepareStage(self.pool, deleter.delete)
         self._run = RunStage(self.pool, deleter.delete)
         self._analyze = AnalyzeStage(self.pool, deleter.delete)
@@ -383,11 +467,17 @@ class Deleter(TaskObject):
 
 
 class Scheduler:
-    def __init__(self, ridc, worker_handlers, experiment_db):
+    """
+    :param worker_pool: :class:`artiq.master.worker.WorkerPool` shared by all
+        pipelines. By default, a new worker is started for every run.
+    """
+    def __init__(self, ridc, worker_handlers, experiment_db, worker_pool=None):
         self.notifier = Notifier(dict())
 
         self._pipelines = dict()
-        self._worker_handlers = worker_handlers
+        if worker_pool is None:
+            worker_pool = WorkerPool(worker_handlers)
+        self._worker_pool = worker_pool
         self._experiment_db = experiment_db
         self._terminated = False
 
@@ -396,6 +486,7 @@ class Scheduler:
 
     def start(self):
         self._deleter.start()
+        self._worker_pool.start()
 
     async def stop(self):
         # NB: restart of a stopped scheduler is not supported
@@ -405,6 +496,7 @@ class Scheduler:
                 self._deleter.delete(rid)
         await self._deleter.join()
         await self._deleter.stop()
+        await self._worker_pool.close()
         if self._pipelines:
             logger.warning("some pipelines were not garbage-collected")
 
@@ -422,7 +514,7 @@ class Scheduler:
         except KeyError:
             logger.debug("creating pipeline '%s'", pipeline_name)
             pipeline = Pipeline(self._ridc, self._deleter,
-                                self._worker_handlers, self.notifier,
+                                self._worker_pool, self.notifier,
                                 self._experiment_db)
             self._pipelines[pipeline_name] = pipeline
             pipeline.start()
@@ -470,12 +562,8 @@ class Scheduler:
                 if run.termination_requested:
                     return True
 
-                prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                                       pipeline.pool.runs.values())
-                try:
-                    r = max(prepared_runs, key=lambda r: r.priority_key())
-                except ValueError:
-                    # prepared_runs is an empty sequence
+                r = pipeline.pool.next_run(RunStatus.prepare_done)
+                if r is None:
                     return False
                 return r.priority_key() > run.priority_key()
         raise KeyError("RID not found")
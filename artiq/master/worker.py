@@ -5,11 +5,12 @@ import logging
 import subprocess
 import time
 
-from sipyco import pipe_ipc, pyon
+from sipyco import pipe_ipc
 from sipyco.logging_tools import LogParser
 from sipyco.packed_exceptions import current_exc_packed
 
 from artiq.tools import asyncio_wait_or_cancel
+from artiq.master import worker_ipc
 
 
 logger = logging.getLogger(__name__)
@@ -48,11 +49,25 @@ class Worker:
 
         self.rid = None
         self.filename = None
+        # repository checkout of the runs for which the worker may be
+        # reused, set by WorkerPool
+        self.wd = None
         self.ipc = None
         self.watchdogs = dict()  # wid -> expiration (using time.monotonic)
 
+        # Number of runs completed by the worker process, whether it has
+        # completed its current run, and its peak memory usage as last
+        # reported.
+        self.runs = 0
+        self.idle = True
+        self.memory = None
+        # datasets of which the worker process may hold a cached value
+        self.watched_datasets = set()
+
         self.io_lock = asyncio.Lock()
         self.closed = asyncio.Event()
+        # whether a frame from the worker process has been partially read
+        self.partial_frame = False
 
     def create_watchdog(self, t):
         n_user_watchdogs = len(self.watchdogs)
@@ -73,6 +88,29 @@ class Worker:
         else:
             return None
 
+    def _get_dataset(self, key):
+        data = self.handlers["get_dataset"](key)
+        if key not in self.watched_datasets:
+            self.watched_datasets.add(key)
+            self.handlers["watch_dataset"](key, self._dataset_changed)
+        return data
+
+    def _unwatch_datasets(self):
+        watched, self.watched_datasets = self.watched_datasets, set()
+        for key in watched:
+            self.handlers["unwatch_dataset"](key, self._dataset_changed)
+
+    def _dataset_changed(self, key):
+        self.watched_datasets.discard(key)
+        if (self.ipc is None or self.closed.is_set()
+                or self.ipc.process.returncode is not None):
+            return
+        # Sent without taking io_lock, which is held while waiting for
+        # requests: the frame is queued whole, and the worker process
+        # reads it before its next reply or before using its cache.
+        self.ipc.write(worker_ipc.encode(
+            {"action": "invalidate_datasets", "keys": [key]}))
+
     def _get_log_source(self):
         return "worker({},{})".format(self.rid, self.filename)
 
@@ -107,6 +145,7 @@ class Worker:
         This method should always be called by the user to clean up, even if
         build() or examine() raises an exception."""
         self.closed.set()
+        self._unwatch_datasets()
         await self.io_lock.acquire()
         try:
             if self.ipc is None:
@@ -157,8 +196,7 @@ class Worker:
 
     async def _send(self, obj, cancellable=True):
         assert self.io_lock.locked()
-        line = pyon.encode(obj)
-        self.ipc.write((line + "\n").encode())
+        self.ipc.write(worker_ipc.encode(obj))
         ifs = [self.ipc.drain()]
         if cancellable:
             ifs.append(self.closed.wait())
@@ -176,11 +214,48 @@ class Worker:
                 "Data transmission to worker cancelled (RID {})".format(
                     self.rid))
 
+    async def _read_exactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = await self.ipc.read(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+            self.partial_frame = True
+        return data
+
+    async def _read_frame(self):
+        header = await self._read_exactly(worker_ipc.frame_header.size)
+        if header is None:
+            return None
+        (length, ) = worker_ipc.frame_header.unpack(header)
+        frame = await self._read_exactly(length)
+        self.partial_frame = False
+        return frame
+
+    def _abandon(self):
+        # The rest of a frame of which the reading was interrupted would be
+        # taken for the next frame, so the process cannot be used anymore.
+        logger.warning("interrupted while receiving data from worker, "
+                       "ending it (RID %s)", self.rid)
+        self.closed.set()
+        try:
+            self.ipc.process.kill()
+        except ProcessLookupError:
+            pass
+
     async def _recv(self, timeout):
         assert self.io_lock.locked()
-        fs = await asyncio_wait_or_cancel(
-            [self.ipc.readline(), self.closed.wait()],
-            timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        try:
+            fs = await asyncio_wait_or_cancel(
+                [self._read_frame(), self.closed.wait()],
+                timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            if self.partial_frame:
+                self._abandon()
+            raise
+        if fs[0].cancelled() and self.partial_frame:
+            self._abandon()
         if all(f.cancelled() for f in fs):
             raise WorkerTimeout(
                 "Timeout receiving data from worker (RID {})".format(self.rid))
@@ -188,15 +263,15 @@ class Worker:
             raise WorkerError(
                 "Receiving data from worker cancelled (RID {})".format(
                     self.rid))
-        line = fs[0].result()
-        if not line:
+        frame = fs[0].result()
+        if frame is None:
             raise WorkerError(
                 "Worker ended while attempting to receive data (RID {})".
                 format(self.rid))
         try:
-            obj = pyon.decode(line.decode())
+            obj = worker_ipc.decode(frame)
         except:
-            raise WorkerError("Worker sent invalid PYON data (RID {})".format(
+            raise WorkerError("Worker sent invalid data (RID {})".format(
                 self.rid))
         return obj
 
@@ -212,6 +287,8 @@ class Worker:
                 raise WorkerWatchdogTimeout
             action = obj["action"]
             if action == "completed":
+                if "memory" in obj:
+                    self.memory = obj["memory"]
                 return True
             elif action == "pause":
                 return False
@@ -223,6 +300,11 @@ class Worker:
                 func = self.delete_watchdog
             elif action == "register_experiment":
                 func = self.register_experiment
+            elif action == "register_imports":
+                func = self.register_imports
+            elif (action == "get_dataset" and "watch_dataset" in self.handlers
+                    and "unwatch_dataset" in self.handlers):
+                func = self._get_dataset
             else:
                 func = self.handlers[action]
             try:
@@ -268,7 +350,9 @@ class Worker:
              "pipeline_name": pipeline_name,
              "wd": wd,
              "expid": expid,
-             "priority": priority},
+             "priority": priority,
+             "cache_datasets": ("watch_dataset" in self.handlers
+                                and "unwatch_dataset" in self.handlers)},
             timeout)
 
     async def prepare(self):
@@ -292,8 +376,14 @@ class Worker:
 
     async def analyze(self):
         await self._worker_action({"action": "analyze"})
+        self.runs += 1
+        self.idle = True
+
+    async def examine(self, rid, file, timeout=20.0, imports=None):
+        """Returns the descriptions of the experiments in ``file``.
 
-    async def examine(self, rid, file, timeout=20.0):
+        If ``imports`` is a list, the files of the modules that were
+        imported while examining ``file`` are appended to it."""
         self.rid = rid
         self.filename = os.path.basename(file)
 
@@ -302,8 +392,131 @@ class Worker:
 
         def register(class_name, name, arginfo, scheduler_defaults):
             r[class_name] = {"name": name, "arginfo": arginfo, "scheduler_defaults": scheduler_defaults}
+        def register_imports(filenames):
+            if imports is not None:
+                imports.extend(filenames)
         self.register_experiment = register
+        self.register_imports = register_imports
         await self._worker_action({"action": "examine", "file": file},
                                   timeout)
         del self.register_experiment
+        del self.register_imports
         return r
+
+
+class WorkerPool:
+    """Keeps worker processes started ahead of time, so that new runs do not
+    wait for the worker to start and import its dependencies.
+
+    :param size: number of started workers to keep available.
+    :param max_runs: number of runs after which a worker is retired. Workers
+        are only reused after runs that completed normally, and only for
+        later runs in the same checkout of an immutable repository revision
+        (see :meth:`get`), as the modules that the experiments import are
+        kept loaded.
+
+    The pool is shared by all pipelines: pipelines are created when a run
+    is submitted to them and removed once they are empty, so workers kept
+    for a pipeline would often be discarded before they could be used.
+    :param max_memory: peak memory usage in bytes after which a worker is
+        retired, or ``None`` for no limit.
+    """
+    def __init__(self, handlers=dict(), size=0, max_runs=1, max_memory=None):
+        self.handlers = handlers
+        self.size = size
+        self.max_runs = max_runs
+        self.max_memory = max_memory
+
+        self._idle = []
+        self._starting = 0
+        self._closed = False
+
+    def start(self):
+        self._refill()
+
+    def _refill(self):
+        while (not self._closed
+                and len(self._idle) + self._starting < self.size):
+            self._starting += 1
+            asyncio.ensure_future(self._start_worker())
+
+    async def _start_worker(self):
+        worker = Worker(self.handlers)
+        try:
+            await worker._create_process(logging.WARNING)
+        except:
+            logger.warning("failed to start worker for the pool",
+                           exc_info=True)
+            await worker.close()
+            return
+        finally:
+            self._starting -= 1
+        if self._closed:
+            await worker.close()
+        else:
+            self._idle.append(worker)
+
+    def _alive(self, worker):
+        return (not worker.closed.is_set()
+                and worker.ipc.process.returncode is None)
+
+    def get(self, wd=None):
+        """Returns a worker for a new run, taking a started one if available.
+
+        ``wd`` is the repository checkout of the run if its files cannot
+        change, in which case the worker may be reused for later runs in the
+        same checkout, and ``None`` otherwise."""
+        worker = None
+        idle, self._idle = self._idle, []
+        for candidate in idle:
+            if not self._alive(candidate):
+                asyncio.ensure_future(candidate.close())
+            elif candidate.runs and candidate.wd != wd:
+                # a later revision replaces the one it ran
+                asyncio.ensure_future(candidate.close())
+            else:
+                self._idle.append(candidate)
+        # Prefer the workers that have already run experiments of this
+        # revision.
+        for candidate in sorted(self._idle, key=lambda w: -w.runs):
+            worker = candidate
+            self._idle.remove(worker)
+            break
+        if worker is None:
+            worker = Worker(self.handlers)
+        worker.wd = wd
+        # Only becomes idle again once the run has been analyzed.
+        worker.idle = False
+        self._refill()
+        return worker
+
+    async def release(self, worker):
+        """Takes back a worker after its run, and either keeps it for a later
+        run or closes it."""
+        if (not self._closed
+                and worker.idle and worker.ipc is not None
+                and worker.wd is not None
+                and self._alive(worker)
+                and worker.runs < self.max_runs
+                and (self.max_memory is None or worker.memory is None
+                     or worker.memory < self.max_memory)
+                and self.size > 0):
+            if len(self._idle) >= self.size:
+                # It takes the place of a worker that has not run yet.
+                fresh = [w for w in self._idle if not w.runs]
+                if not fresh:
+                    await worker.close()
+                    return
+                self._idle.remove(fresh[0])
+                await fresh[0].close()
+            logger.debug("keeping worker after %d run(s) (RID %s)",
+                         worker.runs, worker.rid)
+            self._idle.append(worker)
+        else:
+            await worker.close()
+
+    async def close(self):
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            await worker.close()
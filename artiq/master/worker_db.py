@@ -5,12 +5,16 @@ standalone command line tools).
 """
 
 from operator import setitem
+from contextlib import contextmanager
+import copy
 import importlib
 import logging
 
 from sipyco.sync_struct import Notifier
 from sipyco.pc_rpc import AutoTarget, Client, BestEffortClient
 
+from artiq.master.results import ResultStream, write_dataset
+
 
 logger = logging.getLogger(__name__)
 
@@ -111,9 +115,41 @@ class DatasetManager:
         self._broadcaster = Notifier(dict())
         self.local = dict()
         self.archive = dict()
+        self.result_stream_options = None
+        self.result_stream = None
 
         self.ddb = ddb
-        self._broadcaster.publish = ddb.update
+        self._broadcaster.publish = self._publish
+        self._batch = None
+        # keys of the broadcast datasets modified in the current batch
+        self._batch_keys = set()
+
+    def _publish(self, mod):
+        if self._batch is None:
+            self.ddb.update(mod)
+        else:
+            # The values in the modification may be modified in place
+            # before the batch is sent.
+            self._batch.append(copy.deepcopy(mod))
+            self._batch_keys.add(mod["path"][0] if mod["path"] else mod["key"])
+
+    @contextmanager
+    def batch(self):
+        """Collects the modifications of the broadcast datasets made in the
+        ``with`` block, and sends them to the master in a single update when
+        the block exits, even if an exception is raised. Batches may be
+        nested, in which case the outermost batch sends the modifications."""
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        finally:
+            mods, self._batch = self._batch, None
+            self._batch_keys = set()
+            if mods:
+                self.ddb.update_many(mods)
 
     def set(self, key, value, broadcast=False, persist=False, archive=True):
         if key in self.archive:
@@ -134,6 +170,9 @@ class DatasetManager:
         elif key in self.local:
             del self.local[key]
 
+        if self.result_stream is not None:
+            self.result_stream.replaced(key)
+
     def _get_mutation_target(self, key):
         target = self.local.get(key, None)
         if key in self._broadcaster.raw_view:
@@ -152,15 +191,25 @@ class DatasetManager:
             else:
                 index = slice(*index)
         setitem(target, index, value)
+        if self.result_stream is not None and key in self.local:
+            self.result_stream.mutated(key, index)
 
     def append_to(self, key, value):
         self._get_mutation_target(key).append(value)
+        if self.result_stream is not None and key in self.local:
+            self.result_stream.appended(key)
 
     def get(self, key, archive=False):
         if key in self.local:
             return self.local[key]
-        
-        data = self.ddb.get(key)
+
+        if key in self._batch_keys:
+            # The master has not received the modifications of the batch.
+            if key not in self._broadcaster.raw_view:
+                raise KeyError(key)
+            data = self._broadcaster.raw_view[key][1]
+        else:
+            data = self.ddb.get(key)
         if archive:
             if key in self.archive:
                 logger.warning("Dataset '%s' is already in archive, "
@@ -171,18 +220,25 @@ class DatasetManager:
     def write_hdf5(self, f):
         datasets_group = f.create_group("datasets")
         for k, v in self.local.items():
-            _write(datasets_group, k, v)
+            write_dataset(datasets_group, k, v)
 
         archive_group = f.create_group("archive")
         for k, v in self.archive.items():
-            _write(archive_group, k, v)
-
-
-def _write(group, k, v):
-    # Add context to exception message when the user writes a dataset that is
-    # not representable in HDF5.
-    try:
-        group[k] = v
-    except TypeError as e:
-        raise TypeError("Error writing dataset '{}' of type '{}': {}".format(
-            k, type(v), e))
+            write_dataset(archive_group, k, v)
+
+    def set_result_streaming(self, **options):
+        self.result_stream_options = options
+
+    def start_result_stream(self, filename, metadata):
+        """Create the result file and start writing the archived datasets to
+        it as they change, if the experiment requested it. Returns ``True``
+        in that case."""
+        if self.result_stream_options is None:
+            return False
+        self.result_stream = ResultStream(filename, self.local, metadata,
+                                          **self.result_stream_options)
+        return True
+
+    def close_result_stream(self):
+        self.result_stream.close(self.archive)
+        self.result_stream = None
@@ -9,9 +9,12 @@ process via IPC.
 import sys
 import time
 import os
+import io
+import copy
 import logging
 import traceback
 from collections import OrderedDict
+from contextlib import contextmanager
 
 import h5py
 
@@ -21,6 +24,7 @@ from sipyco.logging_tools import multiline_log_config
 
 import artiq
 from artiq.tools import file_import
+from artiq.master import worker_ipc
 from artiq.master.worker_db import DeviceManager, DatasetManager, DummyDevice
 from artiq.language.environment import (is_experiment, TraceArgumentManager,
                                         ProcessArgumentManager)
@@ -31,17 +35,87 @@ from artiq.coredevice.core import CompileError, host_only, _render_diagnostic
 from artiq import __version__ as artiq_version
 
 
+logger = logging.getLogger(__name__)
+
+
 ipc = None
 
 
+def read_exactly(length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = ipc.read(length - len(data))
+        if not chunk:
+            raise IOError("Connection to the master closed")
+        data += chunk
+    return data
+
+
+def _read_object():
+    (length, ) = worker_ipc.frame_header.unpack(
+        read_exactly(worker_ipc.frame_header.size))
+    return worker_ipc.decode(read_exactly(length))
+
+
+def _handle_invalidation(obj):
+    if obj.get("action") == "invalidate_datasets":
+        ParentDatasetDB.invalidate(obj["keys"])
+        return True
+    return False
+
+
 def get_object():
-    line = ipc.readline().decode()
-    return pyon.decode(line)
+    # The master may send invalidations of cached datasets at any time,
+    # ahead of the reply or the command we are waiting for.
+    while True:
+        obj = _read_object()
+        if not _handle_invalidation(obj):
+            return obj
+
+
+def _input_pending():
+    # Whether the master has sent data that we have not read yet, or None
+    # if this cannot be known without blocking. Only unbuffered pipes can
+    # be polled, as data already in a buffer would go unnoticed.
+    f = getattr(ipc, "rf", None) or getattr(ipc, "f", None)
+    if not isinstance(f, io.RawIOBase):
+        return None
+    try:
+        if os.name == "nt":
+            import ctypes
+            import msvcrt
+            available = ctypes.c_ulong()
+            if not ctypes.windll.kernel32.PeekNamedPipe(
+                    msvcrt.get_osfhandle(f.fileno()), None, 0, None,
+                    ctypes.byref(available), None):
+                return None
+            return available.value > 0
+        else:
+            import select
+            readable, _, _ = select.select([f], [], [], 0)
+            return bool(readable)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def process_pending_messages():
+    """Applies the dataset invalidations that the master has sent. Returns
+    False if pending messages cannot be detected."""
+    while True:
+        pending = _input_pending()
+        if not pending:
+            return pending is not None
+        obj = _read_object()
+        if _handle_invalidation(obj):
+            continue
+        if obj.get("action") == "terminate":
+            sys.exit()
+        raise ValueError("Unexpected message from the master: {}"
+                         .format(obj.get("action")))
 
 
 def put_object(obj):
-    ds = pyon.encode(obj)
-    ipc.write((ds + "\n").encode())
+    ipc.write(worker_ipc.encode(obj))
 
 
 def make_parent_action(action):
@@ -67,8 +141,67 @@ class ParentDeviceDB:
 
 
 class ParentDatasetDB:
-    get = make_parent_action("get_dataset")
-    update = make_parent_action("update_dataset")
+    """Fetches the datasets of the master, and caches their values.
+
+    The master tells the worker when a dataset it has fetched changes,
+    and these invalidations are processed before every cached value is
+    used, so that the cache never returns values older than the master's.
+    The cache is only used when the master supports invalidations and
+    the pipe from the master can be polled.
+    """
+    _get = make_parent_action("get_dataset")
+    _update = make_parent_action("update_dataset")
+    _update_many = make_parent_action("update_datasets")
+
+    cache_enabled = False
+    cache = dict()
+    # numbers of values fetched from the master, and read from the cache
+    fetches = 0
+    hits = 0
+
+    @classmethod
+    def set_cache_enabled(cls, enabled):
+        cls.cache_enabled = enabled
+        cls.cache.clear()
+
+    @classmethod
+    def reset_stats(cls):
+        cls.fetches = 0
+        cls.hits = 0
+
+    @classmethod
+    def invalidate(cls, keys):
+        for key in keys:
+            cls.cache.pop(key, None)
+
+    @classmethod
+    def get(cls, key):
+        if cls.cache_enabled:
+            if not process_pending_messages():
+                cls.set_cache_enabled(False)
+            elif key in cls.cache:
+                cls.hits += 1
+                # experiments may modify the values they get in place
+                return copy.deepcopy(cls.cache[key])
+        cls.fetches += 1
+        value = cls._get(key)
+        if cls.cache_enabled:
+            cls.cache[key] = copy.deepcopy(value)
+        return value
+
+    @staticmethod
+    def _key(mod):
+        return mod["path"][0] if mod["path"] else mod["key"]
+
+    @classmethod
+    def update(cls, mod):
+        cls.invalidate([cls._key(mod)])
+        cls._update(mod)
+
+    @classmethod
+    def update_many(cls, mods):
+        cls.invalidate([cls._key(mod) for mod in mods])
+        cls._update_many(mods)
 
 
 class Watchdog:
@@ -141,6 +274,7 @@ def get_exp(file, class_name):
 
 
 register_experiment = make_parent_action("register_experiment")
+register_imports = make_parent_action("register_imports")
 
 
 class ExamineDeviceMgr:
@@ -156,6 +290,11 @@ class ExamineDatasetMgr:
     def get(key, archive=False):
         return ParentDatasetDB.get(key)
 
+    @staticmethod
+    @contextmanager
+    def batch():
+        yield
+
     @staticmethod
     def update(self, mod):
         pass
@@ -182,6 +321,9 @@ def examine(device_mgr, dataset_mgr, file):
                     (k, (proc.describe(), group, tooltip))
                     for k, (proc, group, tooltip) in argument_mgr.requested_args.items())
                 register_experiment(class_name, name, arginfo, scheduler_defaults)
+        imports = (getattr(sys.modules[key], "__file__", None)
+                   for key in set(sys.modules.keys()) - previous_keys)
+        register_imports(sorted(f for f in imports if f is not None))
     finally:
         new_keys = set(sys.modules.keys())
         for key in new_keys - previous_keys:
@@ -238,6 +380,19 @@ def put_exception_report():
     put_object({"action": "exception"})
 
 
+def get_memory_usage():
+    """Returns the peak memory usage of the process in bytes, if known."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return usage
+    else:
+        return usage*1024
+
+
 def main():
     global ipc
 
@@ -252,15 +407,26 @@ def main():
     exp_inst = None
     repository_path = None
 
+    def results_filename():
+        return "{:09}-{}.h5".format(rid, exp.__name__)
+
+    def results_metadata():
+        return {
+            "artiq_version": artiq_version,
+            "rid": rid,
+            "start_time": start_time,
+            "run_time": run_time,
+            "expid": pyon.encode(expid)
+        }
+
     def write_results():
-        filename = "{:09}-{}.h5".format(rid, exp.__name__)
-        with h5py.File(filename, "w") as f:
+        if dataset_mgr.result_stream is not None:
+            dataset_mgr.close_result_stream()
+            return
+        with h5py.File(results_filename(), "w") as f:
             dataset_mgr.write_hdf5(f)
-            f["artiq_version"] = artiq_version
-            f["rid"] = rid
-            f["start_time"] = start_time
-            f["run_time"] = run_time
-            f["expid"] = pyon.encode(expid)
+            for k, v in results_metadata().items():
+                f[k] = v
 
     device_mgr = DeviceManager(ParentDeviceDB,
                                virtual_devices={"scheduler": Scheduler(),
@@ -269,14 +435,29 @@ def main():
 
     import_cache.install_hook()
 
+    # A worker may be reused for several runs from the same repository
+    # revision, each of which starts from this directory. The modules
+    # imported by the previous runs are kept, as they are the same.
+    initial_cwd = os.getcwd()
+
     try:
         while True:
             obj = get_object()
             action = obj["action"]
             if action == "build":
+                if exp is not None:
+                    device_mgr.close_devices()
+                    dataset_mgr = DatasetManager(ParentDatasetDB)
+                    os.chdir(initial_cwd)
                 start_time = time.time()
                 rid = obj["rid"]
+                # The cached values remain valid from one run to the next.
+                cache_datasets = obj.get("cache_datasets", False)
+                if cache_datasets != ParentDatasetDB.cache_enabled:
+                    ParentDatasetDB.set_cache_enabled(cache_datasets)
+                ParentDatasetDB.reset_stats()
                 expid = obj["expid"]
+                logging.getLogger().setLevel(expid["log_level"])
                 if obj["wd"] is not None:
                     # Using repository
                     experiment_file = os.path.join(obj["wd"], expid["file"])
@@ -303,6 +484,8 @@ def main():
             elif action == "run":
                 run_time = time.time()
                 try:
+                    dataset_mgr.start_result_stream(results_filename(),
+                                                    results_metadata())
                     exp_inst.run()
                 except:
                     # Only write results in run() on failure; on success wait
@@ -313,9 +496,13 @@ def main():
             elif action == "analyze":
                 try:
                     exp_inst.analyze()
-                    put_completed()
+                    put_object({"action": "completed",
+                                "memory": get_memory_usage()})
                 finally:
                     write_results()
+                    logger.info("%d dataset(s) fetched from the master, "
+                                "%d read from the cache",
+                                ParentDatasetDB.fetches, ParentDatasetDB.hits)
             elif action == "examine":
                 examine(ExamineDeviceMgr, ExamineDatasetMgr, obj["file"])
                 put_completed()
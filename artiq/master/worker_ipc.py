@@ -0,0 +1,119 @@
+"""Message framing between the master and its worker processes.
+
+Messages are the same objects as those PYON can serialize. Each message is
+sent as a frame made of its total length, the lengths of the PYON text and
+of the out-of-band buffers, the PYON text, and the buffers. NumPy arrays of
+numeric types are not encoded as PYON text: their data is transferred as
+raw buffers, and they are represented in the PYON text by a small marker
+holding their type and shape.
+"""
+
+import struct
+
+import numpy
+
+from sipyco import pyon
+
+
+__all__ = ["encode", "decode", "frame_header"]
+
+
+frame_header = struct.Struct(">Q")
+_counts = struct.Struct(">QL")
+_buffer_length = struct.Struct(">Q")
+
+_array_marker = "__worker_ipc_array__"
+_containers = (dict, list, tuple, numpy.ndarray)
+
+
+def _extract_arrays(obj, buffers):
+    # Returns obj, or a copy of it where arrays are replaced with markers.
+    if isinstance(obj, numpy.ndarray):
+        if obj.dtype.kind not in "biufc":
+            return obj
+        buffers.append(numpy.ascontiguousarray(obj).reshape(-1).view(numpy.uint8))
+        return {_array_marker: (len(buffers) - 1, obj.dtype.str, obj.shape)}
+    elif isinstance(obj, dict):
+        new_obj = None
+        for k, v in obj.items():
+            if isinstance(v, _containers):
+                new_v = _extract_arrays(v, buffers)
+                if new_v is not v:
+                    if new_obj is None:
+                        new_obj = obj.copy()
+                    new_obj[k] = new_v
+        return obj if new_obj is None else new_obj
+    elif isinstance(obj, (list, tuple)):
+        new_obj = None
+        for i, v in enumerate(obj):
+            if isinstance(v, _containers):
+                new_v = _extract_arrays(v, buffers)
+                if new_v is not v:
+                    if new_obj is None:
+                        new_obj = list(obj)
+                    new_obj[i] = new_v
+        if new_obj is None:
+            return obj
+        return new_obj if isinstance(obj, list) else tuple(new_obj)
+    else:
+        return obj
+
+
+def _restore_arrays(obj, buffers):
+    # Replaces markers with arrays, in place where possible.
+    if isinstance(obj, dict):
+        if len(obj) == 1 and _array_marker in obj:
+            index, dtype, shape = obj[_array_marker]
+            return numpy.frombuffer(buffers[index], dtype).reshape(shape)
+        for k, v in obj.items():
+            if isinstance(v, (dict, list, tuple)):
+                obj[k] = _restore_arrays(v, buffers)
+        return obj
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            if isinstance(v, (dict, list, tuple)):
+                obj[i] = _restore_arrays(v, buffers)
+        return obj
+    elif isinstance(obj, tuple):
+        return tuple(_restore_arrays(v, buffers)
+                     if isinstance(v, (dict, list, tuple)) else v
+                     for v in obj)
+    else:
+        return obj
+
+
+def encode(obj):
+    """Returns the frame carrying ``obj``, including its header."""
+    buffers = []
+    text = pyon.encode(_extract_arrays(obj, buffers)).encode()
+    parts = [_counts.pack(len(text), len(buffers))]
+    parts += [_buffer_length.pack(len(buffer)) for buffer in buffers]
+    parts.append(text)
+    parts += buffers
+    length = sum(len(part) for part in parts)
+    return b"".join([frame_header.pack(length)] + parts)
+
+
+def decode(data):
+    """Returns the object carried by the frame contents ``data``, without
+    the header.
+
+    If ``data`` is a :class:`bytearray`, decoded arrays share its memory
+    and are writable."""
+    view = memoryview(data)
+    text_length, buffer_count = _counts.unpack_from(view)
+    offset = _counts.size
+    lengths = []
+    for _ in range(buffer_count):
+        lengths.append(_buffer_length.unpack_from(view, offset)[0])
+        offset += _buffer_length.size
+    obj = pyon.decode(str(view[offset:offset + text_length], "utf-8"))
+    offset += text_length
+    if not buffer_count:
+        return obj
+
+    buffers = []
+    for length in lengths:
+        buffers.append(view[offset:offset + length])
+        offset += length
+    return _restore_arrays(obj, buffers)
@@ -0,0 +1,98 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from artiq.compiler import elf
+from artiq.compiler.dwarf import DebugInfo, UnsupportedDebugInfo
+from artiq.compiler.targets import Target
+
+
+_HEADER = """\
+static inline int twice(int x) { volatile int k = x; return k * 2; }
+"""
+
+_SOURCE = """\
+#include "include/twice.h"
+static inline int helper(int x) { if (x > 3) return twice(x) * 7; return x + 1; }
+int __attribute__((noinline)) compute(int x) { return helper(x) + helper(x * 3); }
+int entry(int y) { return compute(y) + 2; }
+"""
+
+
+class _HostTarget(Target):
+    tool_addr2line = "llvm-addr2line"
+
+
+@unittest.skipUnless(shutil.which("gcc") and shutil.which("llvm-addr2line"),
+                     "gcc or llvm-addr2line is not available")
+class DebugInfoTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "include"))
+            with open(os.path.join(directory, "include", "twice.h"), "w") as f:
+                f.write(_HEADER)
+            with open(os.path.join(directory, "kernel.c"), "w") as f:
+                f.write(_SOURCE)
+            subprocess.check_call(["gcc", "-g", "-gdwarf-4", "-O2", "-shared", "-fPIC",
+                                   "kernel.c", "-o", "kernel.so"], cwd=directory)
+            with open(os.path.join(directory, "kernel.so"), "rb") as f:
+                cls.library = f.read()
+
+        # Every address in the functions of the kernel, rather than in the
+        # C runtime that gcc links in.
+        library = elf.ElfFile(cls.library)
+        cls.addresses = []
+        for symbol in library.symbols(library.section(".symtab")):
+            if symbol.name in ("compute", "entry"):
+                cls.addresses += range(symbol.value, symbol.value + symbol.size)
+
+    def addr2line(self, addresses):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(self.library)
+            f.flush()
+            output = subprocess.check_output(
+                ["llvm-addr2line", "--addresses", "--functions", "--inlines",
+                 "--exe=" + f.name] + [hex(address) for address in addresses],
+                universal_newlines=True)
+        frames = {}
+        lines = output.rstrip().split("\n")
+        index = 0
+        while index < len(lines):
+            if lines[index].startswith("0x"):
+                address = int(lines[index], 16)
+                frames[address] = []
+                index += 1
+            function, location = lines[index:index + 2]
+            index += 2
+            filename, line = location.split(" ")[0].rsplit(":", 1)
+            if filename != "??" and line not in ("0", "?"):
+                frames[address].append((function, filename, int(line)))
+        return frames
+
+    def test_symbolize(self):
+        debug_info = DebugInfo(self.library)
+        expected = self.addr2line(self.addresses)
+        inlined = 0
+        for address in self.addresses:
+            frames = [frame for frame in debug_info.symbolize(address)
+                      if frame[1] is not None and frame[2] != 0]
+            self.assertEqual(frames, expected[address], hex(address))
+            if len(frames) == 3:
+                inlined += 1
+                self.assertEqual([frame[0] for frame in frames],
+                                 ["twice", "helper", "compute"])
+                self.assertTrue(frames[0][1].endswith("/include/twice.h"))
+        self.assertGreater(inlined, 0)
+
+    def test_target_symbolize(self):
+        target = _HostTarget()
+        return_addresses = [address + 1 for address in self.addresses]
+        self.assertEqual(target.symbolize(self.library, return_addresses),
+                         target._symbolize_with_tool(self.library, return_addresses))
+
+    def test_no_debug_info(self):
+        with self.assertRaises(UnsupportedDebugInfo):
+            DebugInfo(elf.strip_debug(self.library))
@@ -0,0 +1,87 @@
+import struct
+import unittest
+
+from artiq.compiler.elf import strip_debug
+
+
+def _build_elf(sections):
+    # A big-endian ELF32 shared object with one PT_LOAD segment covering
+    # the allocated sections; ``sections`` is a list of
+    # (name, type, flags, contents, link) tuples.
+    ehdr = struct.Struct(">16sHHIIIIIHHHHHH")
+    phdr = struct.Struct(">IIIIIIII")
+    shdr = struct.Struct(">IIIIIIIIII")
+
+    shstrtab = b"\x00"
+    names = []
+    for name, *_ in sections + [(".shstrtab",)]:
+        names.append(len(shstrtab))
+        shstrtab += name.encode() + b"\x00"
+    sections = sections + [(".shstrtab", 3, 0, shstrtab, 0)]
+
+    data = bytearray(ehdr.size + phdr.size)
+    headers = [bytes(shdr.size)]
+    load_end = 0
+    for name_offset, (name, type, flags, contents, link) in zip(names, sections):
+        offset = len(data)
+        data += contents
+        if flags & 0x2:
+            load_end = len(data)
+        headers.append(shdr.pack(name_offset, type, flags, offset if flags & 0x2 else 0,
+                                 offset, len(contents), link, 0, 1, 0))
+    data += bytes(-len(data) % 4)
+    shoff = len(data)
+    for header in headers:
+        data += header
+    ehdr.pack_into(data, 0, b"\x7fELF\x01\x02\x01" + bytes(9), 3, 92, 1, 0,
+                   ehdr.size, shoff, 0, ehdr.size, phdr.size, 1, shdr.size,
+                   len(headers), len(headers) - 1)
+    phdr.pack_into(data, ehdr.size, 1, 0, 0, 0, load_end, load_end, 5, 4)
+    return bytes(data)
+
+
+def _section_names(library):
+    shoff, = struct.unpack_from(">I", library, 32)
+    shnum, shstrndx = struct.unpack_from(">HH", library, 48)
+    headers = [struct.unpack_from(">IIIIIIIIII", library, shoff + 40 * index)
+               for index in range(shnum)]
+    strtab_offset = headers[shstrndx][4]
+    names = []
+    for header in headers[1:]:
+        start = strtab_offset + header[0]
+        names.append(library[start:library.index(b"\x00", start)].decode())
+    return names, headers
+
+
+class StripDebugTest(unittest.TestCase):
+    def test_strip(self):
+        symbol = struct.pack(">IIIBBH", 0, 0, 0, 0, 0, 0) + \
+                 struct.pack(">IIIBBH", 1, 0x40, 4, 0x12, 0, 1) + \
+                 struct.pack(">IIIBBH", 0, 0, 0, 0x03, 0, 4)
+        library = _build_elf([
+            (".text", 1, 0x6, b"\x15\x00\x00\x00" * 4, 0),
+            (".debug_info", 1, 0, b"\xaa" * 64, 0),
+            (".debug_line", 1, 0, b"\xbb" * 32, 0),
+            (".comment", 1, 0, b"lld\x00", 0),
+            (".symtab", 2, 0, symbol, 6),
+            (".strtab", 3, 0, b"\x00f\x00", 0),
+        ])
+        stripped = strip_debug(library)
+        self.assertLess(len(stripped), len(library))
+
+        names, headers = _section_names(stripped)
+        self.assertEqual(names, [".text", ".comment", ".symtab", ".strtab", ".shstrtab"])
+        # Apart from the ELF header, the loaded image is unchanged.
+        text_offset = headers[1][4]
+        self.assertEqual(stripped[52:text_offset + 16], library[52:text_offset + 16])
+        # The symbol table links to the string table at its new index,
+        # and its symbols refer to the sections at their new indices.
+        symtab = headers[3]
+        self.assertEqual(symtab[6], 4)
+        self.assertEqual(stripped[symtab[4]:symtab[4] + symtab[5]],
+                         symbol[:-2] + struct.pack(">H", 2))
+        self.assertEqual(strip_debug(stripped), stripped)
+
+    def test_not_elf(self):
+        with self.assertRaises(ValueError):
+            strip_debug(b"\x00" * 64)
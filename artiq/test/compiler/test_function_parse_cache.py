@@ -0,0 +1,113 @@
+import importlib.util
+import inspect
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# artiq.compiler.embedding can only be imported after the transforms,
+# which import it in turn.
+from artiq.compiler import transforms
+from artiq.compiler import embedding
+from artiq.compiler.embedding import Stitcher, FunctionParseCache
+
+
+_SOURCE = """\
+def increment(x):
+    return x + {}
+"""
+
+
+def _return_value(function_node):
+    return function_node.body[0].value.right.n
+
+
+class FunctionParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = FunctionParseCache(max_entries=2)
+        patcher = mock.patch.object(embedding, "function_parse_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "kernels.py")
+        self.write_module(1)
+        spec = importlib.util.spec_from_file_location("kernels", self.filename)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self.function = module.increment
+
+        self.stitcher = Stitcher(core=None, dmgr=None)
+
+    def write_module(self, increment):
+        with open(self.filename, "w") as f:
+            f.write(_SOURCE.format(increment))
+
+    def parse(self, source_code=None):
+        code = self.function.__code__
+        if source_code is None:
+            return self.stitcher._parse_embedded_function(
+                self.function, None, code.co_filename, code.co_firstlineno)
+        else:
+            return self.stitcher._parse_embedded_function(
+                self.function, source_code, "<string>", 1)
+
+    def test_file_function(self):
+        with mock.patch.object(embedding.inspect, "getsource",
+                               wraps=inspect.getsource) as getsource:
+            first = self.parse()
+            second = self.parse()
+        self.assertEqual(getsource.call_count, 1)
+        self.assertEqual(first.name, "increment")
+        self.assertEqual(_return_value(second), 1)
+        self.assertEqual(list(self.cache.entries),
+                         [(self.function.__code__, self.filename,
+                           os.stat(self.filename).st_mtime)])
+
+    def test_clone(self):
+        first = self.parse()
+        first.name = "mutated"
+        first.body[0].value.right.n = 10
+        first.body.append(first.body[0])
+
+        second = self.parse()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.name, "increment")
+        self.assertEqual(len(second.body), 1)
+        self.assertEqual(_return_value(second), 1)
+        # Source locations are shared, since they are never mutated.
+        self.assertIs(second.loc, first.loc)
+
+    def test_modified_file(self):
+        self.parse()
+        stat = os.stat(self.filename)
+        self.write_module(2)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime + 10))
+
+        with mock.patch.object(embedding.inspect, "getsource",
+                               wraps=inspect.getsource) as getsource:
+            modified = self.parse()
+        self.assertEqual(getsource.call_count, 1)
+        self.assertEqual(_return_value(modified), 2)
+
+    def test_source_code(self):
+        with mock.patch.object(embedding.source_parser, "Parser",
+                               wraps=embedding.source_parser.Parser) as parser:
+            first = self.parse(_SOURCE.format(3))
+            second = self.parse(_SOURCE.format(3))
+            self.assertEqual(parser.call_count, 1)
+            other = self.parse(_SOURCE.format(4))
+            self.assertEqual(parser.call_count, 2)
+        self.assertIsNot(first, second)
+        self.assertEqual(_return_value(second), 3)
+        self.assertEqual(_return_value(other), 4)
+        self.assertEqual(list(self.cache.entries), [_SOURCE.format(3), _SOURCE.format(4)])
+
+    def test_eviction(self):
+        for increment in (1, 2, 3):
+            self.parse(_SOURCE.format(increment))
+        self.parse(_SOURCE.format(2))
+        self.assertEqual(list(self.cache.entries), [_SOURCE.format(3), _SOURCE.format(2)])
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(_SOURCE.format(2)))
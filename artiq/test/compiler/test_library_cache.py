@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from artiq.compiler.library_cache import LibraryCache
+
+
+class MockTarget:
+    triple = "mock"
+    data_layout = ""
+    features = []
+
+    def __init__(self):
+        self.links = 0
+
+    def emit_llvm_ir(self, module):
+        return module
+
+    def compile_llvm_ir(self, llvm_ir):
+        return llvm_ir
+
+    def assemble(self, llmodule):
+        return llmodule.encode()
+
+    def link(self, objects):
+        self.links += 1
+        return b"".join(objects)
+
+    def strip(self, library):
+        return library[:1]
+
+
+class TestLibraryCache(unittest.TestCase):
+    def test_memory(self):
+        target = MockTarget()
+        cache = LibraryCache()
+        self.assertEqual(cache.compile_and_link(target, "abc"), (b"abc", b"a"))
+        self.assertEqual(cache.compile_and_link(target, "abc"), (b"abc", b"a"))
+        self.assertEqual(cache.compile_and_link(target, "xyz"), (b"xyz", b"x"))
+        self.assertEqual(target.links, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_lru(self):
+        target = MockTarget()
+        cache = LibraryCache(max_entries=2)
+        for module in "a", "b", "a", "c", "a", "b":
+            cache.compile_and_link(target, module)
+        self.assertEqual(target.links, 4)
+        self.assertEqual(list(cache.entries.values()),
+                         [(b"a", b"a"), (b"b", b"b")])
+
+    def test_disk(self):
+        with tempfile.TemporaryDirectory() as directory:
+            target = MockTarget()
+            cache = LibraryCache(directory, max_disk_entries=2)
+            for module in "a", "b", "c":
+                cache.compile_and_link(target, module)
+            self.assertEqual(len(os.listdir(directory)), 4)
+
+            cache = LibraryCache(directory)
+            self.assertEqual(cache.compile_and_link(target, "c"), (b"c", b"c"))
+            self.assertEqual(target.links, 3)
@@ -0,0 +1,370 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from artiq.compiler import elf
+from artiq.compiler.linker import link, UnsupportedInput
+from artiq.compiler.targets import Target, OR1KTarget
+
+
+R_OR1K_32, R_OR1K_HI_16_IN_INSN, R_OR1K_INSN_REL_26, R_OR1K_32_PCREL = 1, 5, 6, 9
+R_OR1K_GOTPC_HI16, R_OR1K_GOTPC_LO16, R_OR1K_GOT16, R_OR1K_PLT26 = 12, 13, 14, 15
+R_OR1K_GOTOFF_HI16, R_OR1K_GOTOFF_LO16 = 16, 17
+R_OR1K_GLOB_DAT, R_OR1K_JMP_SLOT, R_OR1K_RELATIVE = 19, 20, 21
+
+UND, ABS, COM = 0, 0xfff1, 0xfff2
+
+BASE = 0x40000000
+
+
+def _words(*words):
+    return b"".join(struct.pack(">I", word) for word in words)
+
+
+def _build_object(sections, symbols, relocations, machine=92):
+    # A big-endian ELF32 relocatable object. ``sections`` is a list of
+    # (name, type, flags, contents or size, alignment) tuples, ``symbols``
+    # of (name, value, size, bind, type, visibility, section name or index)
+    # tuples, and ``relocations`` maps section names to lists of
+    # (offset, symbol or section name, type, addend) tuples.
+    ehdr = struct.Struct(">16sHHIIIIIHHHHHH")
+    shdr = struct.Struct(">IIIIIIIIII")
+    section_index = {section[0]: 1 + index for index, section in enumerate(sections)}
+
+    entries = [(0, 0, 0, 0, 0, 0)]
+    strtab = b"\x00"
+    symbol_index = {}
+    for name, index in section_index.items():
+        symbol_index[name] = len(entries)
+        entries.append((0, 0, 0, 0x03, 0, index))
+    first_global = None
+    for name, value, size, bind, type, visibility, section in \
+            sorted(symbols, key=lambda symbol: symbol[3] != 0):
+        if bind != 0 and first_global is None:
+            first_global = len(entries)
+        symbol_index[name] = len(entries)
+        shndx = section if isinstance(section, int) else section_index[section]
+        entries.append((len(strtab), value, size, (bind << 4) | type, visibility, shndx))
+        strtab += name.encode() + b"\x00"
+    symtab = b"".join(struct.pack(">IIIBBH", *entry) for entry in entries)
+
+    symtab_index = 1 + len(sections) + len(relocations)
+    all_sections = [(name, type, flags, contents, align, 0, 0, 0)
+                    for name, type, flags, contents, align in sections]
+    for name, entries in relocations.items():
+        rela = b"".join(struct.pack(">IIi", offset, (symbol_index[symbol] << 8) | type, addend)
+                        for offset, symbol, type, addend in entries)
+        all_sections.append((".rela" + name, 4, 0, rela, 4, symtab_index,
+                             section_index[name], 12))
+    all_sections += [(".symtab", 2, 0, symtab, 4, symtab_index + 1, first_global, 16),
+                     (".strtab", 3, 0, strtab, 1, 0, 0, 0)]
+
+    shstrtab = b"\x00"
+    for section in all_sections + [(".shstrtab",)]:
+        shstrtab += section[0].encode() + b"\x00"
+    all_sections.append((".shstrtab", 3, 0, shstrtab, 1, 0, 0, 0))
+
+    data = bytearray(ehdr.size)
+    headers = [bytes(shdr.size)]
+    name_offset = 1
+    for name, type, flags, contents, align, link_, info, entsize in all_sections:
+        data += bytes(-len(data) % 4)
+        offset = len(data)
+        if type == 8:
+            size = contents
+        else:
+            size = len(contents)
+            data += contents
+        headers.append(shdr.pack(name_offset, type, flags, 0, offset, size,
+                                 link_, info, align, entsize))
+        name_offset += len(name) + 1
+    data += bytes(-len(data) % 4)
+    shoff = len(data)
+    for header in headers:
+        data += header
+    ehdr.pack_into(data, 0, b"\x7fELF\x01\x02\x01" + bytes(9), 1, machine, 1, 0, 0,
+                   shoff, 0, ehdr.size, 0, 0, shdr.size, len(headers), len(headers) - 1)
+    return bytes(data)
+
+
+def _elf_hash(name):
+    value = 0
+    for char in name:
+        value = ((value << 4) + char) & 0xffffffff
+        high = value & 0xf0000000
+        if high:
+            value ^= high >> 24
+        value &= ~high
+    return value
+
+
+class _Library:
+    # Loads a library at BASE the way the core device loader does,
+    # see artiq/firmware/libdyld/lib.rs.
+    def __init__(self, library, resolve):
+        ident, type, machine, _, _, phoff, _, _, _, _, phnum, _, _, _ = \
+            struct.unpack_from(">16sHHIIIIIHHHHHH", library)
+        assert ident == b"\x7fELF\x01\x02\x01" + bytes(9)
+        assert type == 3 and machine == 92
+
+        self.image = image = bytearray(0x10000)
+        self.program_headers = []
+        for index in range(phnum):
+            header = struct.unpack_from(">IIIIIIII", library, phoff + 32 * index)
+            p_type, p_offset, p_vaddr, _, p_filesz = header[:5]
+            self.program_headers.append(header)
+            if p_type == 1:
+                image[p_vaddr:p_vaddr + p_filesz] = library[p_offset:p_offset + p_filesz]
+            elif p_type == 2:
+                dynamic = p_vaddr
+
+        self.tags = tags = {}
+        while True:
+            tag, value = struct.unpack_from(">Ii", image, dynamic)
+            dynamic += 8
+            if tag == 0:
+                break
+            assert tag != 17  # DT_REL
+            tags[tag] = value
+        assert tags[11] == 16
+
+        nbucket, nchain = struct.unpack_from(">II", image, tags[4])
+        self.buckets = struct.unpack_from(">{}I".format(nbucket), image, tags[4] + 8)
+        self.chains = struct.unpack_from(">{}I".format(nchain), image,
+                                         tags[4] + 8 + 4 * nbucket)
+        self.symbols = [struct.unpack_from(">IIIBBH", image, tags[6] + 16 * index)
+                        for index in range(nchain)]
+        self.relocations = [struct.unpack_from(">IIi", image, tags.get(7, 0) + 12 * index)
+                            for index in range(tags.get(8, 0) // 12)]
+        self.plt_relocations = [struct.unpack_from(">IIi", image, tags.get(23, 0) + 12 * index)
+                                for index in range(tags.get(2, 0) // 12)]
+        for offset, info, addend in self.relocations + self.plt_relocations:
+            kind = info & 0xff
+            if kind == R_OR1K_RELATIVE:
+                value = BASE + addend
+            elif kind in (R_OR1K_32, R_OR1K_GLOB_DAT, R_OR1K_JMP_SLOT):
+                name = self.name(self.symbols[info >> 8][0])
+                value = self.lookup(name)
+                if value is None:
+                    value = resolve[name]
+            else:
+                raise AssertionError("unsupported relocation type {}".format(kind))
+            struct.pack_into(">I", image, offset, value)
+
+    def name(self, offset):
+        strtab = self.tags[5]
+        return bytes(self.image[strtab + offset:self.image.index(b"\x00", strtab + offset)])
+
+    def lookup(self, name):
+        index = self.buckets[_elf_hash(name) % len(self.buckets)]
+        while index != 0:
+            st_name, st_value, _, st_info, _, st_shndx = self.symbols[index]
+            if self.name(st_name) == name:
+                if not st_info >> 4 & 1 or st_shndx == UND:
+                    return None
+                if st_shndx == ABS:
+                    return st_value
+                return BASE + st_value
+            index = self.chains[index]
+
+    def word(self, address):
+        return struct.unpack_from(">I", self.image, address)[0]
+
+
+def _kernel_object(extra_text_relocations=[], machine=92):
+    text = _words(
+        0x1a000000,  # l.movhi r16, gotpchi(_GLOBAL_OFFSET_TABLE_-4)
+        0xaa100000,  # l.ori   r16, r16, gotpclo(_GLOBAL_OFFSET_TABLE_)
+        0x04000000,  # l.jal   plt(rtio_output)
+        0x04000000,  # l.jal   plt(helper)
+        0x84700000,  # l.lwz   r3, got(now)(r16)
+        0x84800000,  # l.lwz   r4, got(typeinfo)(r16)
+        0x18a00000,  # l.movhi r5, gotoffhi(local_data)
+        0xa8a50000,  # l.ori   r5, r5, gotofflo(local_data)
+        0x44004800,  # helper: l.jr r9
+        0x15000000,  # l.nop
+        0x04000000,  # hidden_function: l.jal plt(rtio_output)
+        0x15000000)  # l.nop
+    cie = _words(16, 0) + b"\x01zR\x00\x01\x7c\x09\x01\x1b\x0c\x01\x00"
+    def fde(offset, length):
+        return _words(16, offset + 4, 0, length) + b"\x00" * 4
+    eh_frame = cie + fde(20, 8) + fde(40, 0x20)
+    return _build_object(
+        [(".text", 1, 0x6, text, 4),
+         (".rodata.str1.1", 1, 0x32, b"abc\x00", 1),
+         (".rodata.cst4", 1, 0x12, _words(0xdeadbeef), 4),
+         (".data", 1, 0x3, _words(0, 0, 0, 0x12345678), 4),
+         (".bss", 8, 0x3, 16, 4),
+         (".eh_frame", 1, 0x2, eh_frame, 4),
+         (".debug_info", 1, 0, bytes(8), 1),
+         (".comment", 1, 0x30, b"clang\x00", 1),
+         (".note.GNU-stack", 1, 0, b"", 1)],
+        [("helper", 0x20, 8, 0, 2, 0, ".text"),
+         ("local_data", 4, 4, 0, 1, 0, ".bss"),
+         ("__modinit__", 0, 0x20, 1, 2, 0, ".text"),
+         ("hidden_function", 0x28, 8, 1, 2, 2, ".text"),
+         ("typeinfo", 0, 16, 1, 1, 0, ".data"),
+         ("common_buffer", 8, 8, 1, 1, 0, COM),
+         ("rtio_output", 0, 0, 1, 2, 0, UND),
+         ("rtio_log", 0, 0, 1, 2, 0, UND),
+         ("now", 0, 0, 1, 1, 0, UND),
+         ("_GLOBAL_OFFSET_TABLE_", 0, 0, 1, 0, 0, UND)],
+        {".text": [(0x00, "_GLOBAL_OFFSET_TABLE_", R_OR1K_GOTPC_HI16, -4),
+                   (0x04, "_GLOBAL_OFFSET_TABLE_", R_OR1K_GOTPC_LO16, 0),
+                   (0x08, "rtio_output", R_OR1K_PLT26, 0),
+                   (0x0c, "helper", R_OR1K_PLT26, 0),
+                   (0x10, "now", R_OR1K_GOT16, 0),
+                   (0x14, "typeinfo", R_OR1K_GOT16, 0),
+                   (0x18, "local_data", R_OR1K_GOTOFF_HI16, 0),
+                   (0x1c, "local_data", R_OR1K_GOTOFF_LO16, 0),
+                   (0x28, "rtio_output", R_OR1K_INSN_REL_26, 0)] +
+                  extra_text_relocations,
+         ".data": [(0x0, ".rodata.str1.1", R_OR1K_32, 1),
+                   (0x4, "__modinit__", R_OR1K_32, 0),
+                   (0x8, "rtio_log", R_OR1K_32, 0)],
+         ".eh_frame": [(28, ".text", R_OR1K_32_PCREL, 0x20),
+                       (48, ".text", R_OR1K_32_PCREL, 0)],
+         ".debug_info": [(0, "rtio_output", R_OR1K_32, 0),
+                         (4, ".text", R_OR1K_32, 0x20)]},
+        machine=machine)
+
+
+class LinkerTest(unittest.TestCase):
+    def setUp(self):
+        self.library = link([_kernel_object()])
+        self.elf = elf.ElfFile(self.library)
+        self.loaded = _Library(self.library, {b"rtio_output": 0x1000, b"rtio_log": 0x3000,
+                                              b"now": 0x2000})
+
+    def address(self, name):
+        return self.elf.sections[self.elf.section(name)].addr
+
+    def branch_target(self, address):
+        displacement = self.loaded.word(address) & 0x03ffffff
+        if displacement & 0x02000000:
+            displacement -= 0x04000000
+        return address + 4 * displacement
+
+    def test_symbols(self):
+        text, data, bss = self.address(".text"), self.address(".data"), self.address(".bss")
+        self.assertEqual(self.loaded.lookup(b"__modinit__"), BASE + text)
+        self.assertEqual(self.loaded.lookup(b"typeinfo"), BASE + data)
+        self.assertEqual(self.loaded.lookup(b"__bss_start"), BASE + bss)
+        common_buffer = self.loaded.lookup(b"common_buffer")
+        self.assertEqual(common_buffer % 8, 0)
+        self.assertGreaterEqual(self.loaded.lookup(b"_end"), common_buffer + 8)
+        self.assertEqual(self.loaded.lookup(b"_end"),
+                         BASE + self.loaded.program_headers[0][5])
+        for name in (b"helper", b"local_data", b"hidden_function", b"rtio_output"):
+            self.assertIsNone(self.loaded.lookup(name))
+
+    def test_calls(self):
+        text, plt, got = self.address(".text"), self.address(".plt"), self.address(".got")
+        self.assertEqual(self.branch_target(text + 0x0c), text + 0x20)
+        entry = self.branch_target(text + 0x08)
+        self.assertEqual(self.branch_target(text + 0x28), entry)
+        self.assertGreater(entry, plt)
+        # l.lwz r12, slot(r16), where r16 holds the address of the GOT
+        load = self.loaded.word(entry)
+        self.assertEqual(load & 0xffff0000, 0x85900000)
+        self.assertEqual(self.loaded.word(got + (load & 0xffff)), 0x1000)
+        # Calls to undefined functions can be rebound by the kernel support code.
+        self.assertEqual([(self.loaded.name(self.loaded.symbols[info >> 8][0]), info & 0xff)
+                          for _, info, _ in self.loaded.plt_relocations],
+                         [(b"rtio_output", R_OR1K_JMP_SLOT)])
+
+    def test_global_offset_table(self):
+        text, data, got = self.address(".text"), self.address(".data"), self.address(".got")
+        self.assertEqual(self.loaded.word(got), self.address(".dynamic"))
+        self.assertEqual(self.loaded.word(text + 0x00) & 0xffff,
+                         ((got - 4 - text) >> 16) & 0xffff)
+        self.assertEqual(self.loaded.word(text + 0x04) & 0xffff, (got - text - 4) & 0xffff)
+        self.assertEqual(self.loaded.word(got + (self.loaded.word(text + 0x10) & 0xffff)),
+                         0x2000)
+        self.assertEqual(self.loaded.word(got + (self.loaded.word(text + 0x14) & 0xffff)),
+                         BASE + data)
+        gotoff = ((self.loaded.word(text + 0x18) & 0xffff) << 16) | \
+                 (self.loaded.word(text + 0x1c) & 0xffff)
+        self.assertEqual(gotoff, (self.address(".bss") + 4 - got) & 0xffffffff)
+
+    def test_data(self):
+        data, rodata = self.address(".data"), self.address(".rodata")
+        self.assertEqual(self.loaded.image[rodata:rodata + 8],
+                         b"abc\x00" + _words(0xdeadbeef))
+        self.assertEqual([self.loaded.word(data + offset) for offset in range(0, 16, 4)],
+                         [BASE + rodata + 1, BASE + self.address(".text"), 0x3000, 0x12345678])
+        self.assertEqual(self.elf.contents(self.elf.section(".debug_info")),
+                         _words(0, self.address(".text") + 0x20))
+        self.assertIsNone(self.elf.section(".comment"))
+
+    def test_eh_frame_hdr(self):
+        headers = [header for header in self.loaded.program_headers
+                   if header[0] == 0x6474e550]
+        self.assertEqual(len(headers), 1)
+        hdr = headers[0][2]
+        self.assertEqual(hdr, self.address(".eh_frame_hdr"))
+        version, eh_frame_ptr_enc, fde_count_enc, table_enc, eh_frame_ptr, fde_count = \
+            struct.unpack_from(">BBBBiI", self.loaded.image, hdr)
+        self.assertEqual((version, eh_frame_ptr_enc, fde_count_enc, table_enc),
+                         (1, 0x1b, 0x03, 0x3b))
+        eh_frame = self.address(".eh_frame")
+        self.assertEqual(hdr + 4 + eh_frame_ptr, eh_frame)
+        table = [struct.unpack_from(">ii", self.loaded.image, hdr + 12 + 8 * index)
+                 for index in range(fde_count)]
+        text = self.address(".text")
+        self.assertEqual([(hdr + pc, hdr + fde) for pc, fde in table],
+                         [(text, eh_frame + 40), (text + 0x20, eh_frame + 20)])
+        self.assertEqual(self.loaded.image[eh_frame + 60:eh_frame + 64], bytes(4))
+
+    def test_strip(self):
+        stripped = elf.strip_debug(self.library)
+        self.assertLess(len(stripped), len(self.library))
+        loaded = _Library(stripped, {b"rtio_output": 0x1000, b"rtio_log": 0x3000,
+                                     b"now": 0x2000})
+        # Apart from the ELF header, the loaded image is unchanged.
+        self.assertEqual(loaded.image[52:], self.loaded.image[52:])
+
+    @unittest.skipUnless(shutil.which("llvm-readelf"), "llvm-readelf is not available")
+    def test_readelf(self):
+        process = subprocess.run(["llvm-readelf", "--all", "--dyn-syms", "-"],
+                                 input=self.library, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        self.assertEqual(process.returncode, 0)
+        self.assertNotIn(b"warning", process.stdout)
+
+    def test_unsupported(self):
+        with self.assertRaises(UnsupportedInput):
+            link([_kernel_object(), _kernel_object()])
+        with self.assertRaises(UnsupportedInput):
+            link([_kernel_object(machine=40)])
+        # Absolute addresses in code would need text relocations.
+        with self.assertRaises(UnsupportedInput):
+            link([_kernel_object([(0x2c, "typeinfo", R_OR1K_HI_16_IN_INSN, 0)])])
+        with self.assertRaises(UnsupportedInput):
+            link([b"\x00" * 64])
+
+
+class _HostTarget(Target):
+    tool_ld = "ld"
+
+
+class TargetLinkTest(unittest.TestCase):
+    def test_in_process(self):
+        # or1k-linux-ld is not needed to link a kernel.
+        kernel = _kernel_object()
+        self.assertEqual(OR1KTarget().link([kernel]), link([kernel]))
+
+    @unittest.skipUnless(shutil.which("gcc") and shutil.which("ld"),
+                         "gcc or ld is not available")
+    def test_external_linker(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "kernel.c"), "w") as f:
+                f.write("int __modinit__(void) { return 0; }\n")
+            subprocess.check_call(["gcc", "-c", "-fPIC", "kernel.c"], cwd=directory)
+            with open(os.path.join(directory, "kernel.o"), "rb") as f:
+                host_object = f.read()
+        library = elf.ElfFile(_HostTarget().link([host_object]))
+        self.assertEqual(library.type, elf.ET_DYN)
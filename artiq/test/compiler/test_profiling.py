@@ -0,0 +1,34 @@
+import unittest
+
+from artiq.compiler.profiling import Profiler, null_profiler
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_measure(self):
+        profiler = Profiler()
+        with profiler.measure("first"):
+            pass
+        with profiler.measure("second", lambda: 42, "nodes"):
+            pass
+        with self.assertRaises(ValueError):
+            with profiler.measure("failed"):
+                raise ValueError
+
+        self.assertEqual([p.name for p in profiler.passes], ["first", "second"])
+        self.assertEqual(profiler.passes[0].ir_size, None)
+        self.assertEqual(profiler.passes[1].ir_size, 42)
+        self.assertEqual(profiler.passes[1].ir_unit, "nodes")
+        self.assertIsNone(profiler.passes[1].peak_memory)
+        self.assertGreaterEqual(profiler.total_time(), 0)
+        self.assertIn("42 nodes", profiler.format())
+
+    def test_trace_memory(self):
+        profiler = Profiler(trace_memory=True)
+        with profiler.measure("allocate"):
+            data = bytearray(1 << 20)
+            del data
+        self.assertGreaterEqual(profiler.passes[0].peak_memory, 1 << 20)
+
+    def test_null_profiler(self):
+        with null_profiler.measure("nothing", lambda: self.fail()):
+            pass
@@ -0,0 +1,42 @@
+import socket
+import struct
+import unittest
+
+from artiq.coredevice.comm_buffer import BufferedSocket
+
+
+class BufferedSocketCase(unittest.TestCase):
+    def setUp(self):
+        a, b = socket.socketpair()
+        self.writer = BufferedSocket(a, buffer_size=16)
+        self.reader = BufferedSocket(b, buffer_size=16)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+
+    def test_values(self):
+        fmt = struct.Struct(">l")
+        for i in range(10):
+            self.writer.pack(fmt, i)
+        self.writer.flush()
+        self.assertEqual([self.reader.unpack(fmt)[0] for i in range(10)],
+                         list(range(10)))
+
+    def test_large(self):
+        self.writer.write(b"ab")
+        self.writer.write(bytes(range(40)))
+        self.writer.write(b"cd")
+        self.writer.flush()
+        self.assertEqual(self.reader.read(1), b"a")
+        self.assertEqual(bytes(self.reader.read_view(41)), b"b" + bytes(range(40)))
+        self.assertEqual(self.reader.read(2), b"cd")
+
+    def test_unflushed(self):
+        self.writer.write(b"a")
+        self.writer.socket.setblocking(False)
+        self.reader.socket.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            self.reader.read(1)
+        self.writer.flush()
+        self.assertEqual(self.reader.read(1), b"a")
@@ -0,0 +1,222 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import numpy
+
+from artiq.coredevice.comm_kernel import CommKernel, RPCReturnValueError
+from artiq.coredevice.comm_buffer import BufferedSocket
+
+
+def _encode_elements(tag, fmt, values):
+    return b"".join(tag + struct.pack(fmt, v) for v in values)
+
+
+class RPCValueCase(unittest.TestCase):
+    def setUp(self):
+        self.comm = CommKernel("localhost")
+        self.comm.socket, self.device = socket.socketpair()
+        self.comm._stream = BufferedSocket(self.comm.socket)
+
+    def tearDown(self):
+        self.comm.close()
+        self.device.close()
+
+    def receive(self, data):
+        writer = threading.Thread(target=self.device.sendall, args=(data,))
+        writer.start()
+        try:
+            return self.comm._receive_rpc_value(None)
+        finally:
+            writer.join()
+
+    def send(self, tags, value, length):
+        result = []
+        reader = threading.Thread(target=lambda:
+            result.append(self._recv_exactly(length)))
+        reader.start()
+        try:
+            self.comm._send_rpc_value(bytearray(tags), value, value, None)
+            self.comm._flush()
+        finally:
+            reader.join()
+        return result[0]
+
+    def assertSent(self, tags, value, expected):
+        self.assertEqual(self.send(tags, value, len(expected)), expected)
+
+    def assertNotSent(self, tags, value):
+        with self.assertRaises(RPCReturnValueError):
+            self.comm._send_rpc_value(bytearray(tags), value, value, None)
+        self.comm._stream._write_buffer.clear()
+
+    def _recv_exactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            data += self.device.recv(length - len(data))
+        return bytes(data)
+
+    def test_receive_list(self):
+        values = self.receive(b"l" + struct.pack(">l", 3) +
+                              _encode_elements(b"i", ">l", [1, -2, 3]))
+        self.assertEqual(values, [1, -2, 3])
+        self.assertIsInstance(values[0], numpy.int32)
+
+        values = self.receive(b"l" + struct.pack(">l", 2) +
+                              _encode_elements(b"f", ">d", [1.5, -2.0]))
+        self.assertEqual(values, [1.5, -2.0])
+        self.assertIs(type(values[0]), float)
+
+        values = self.receive(b"l" + struct.pack(">l", 2) +
+                              _encode_elements(b"b", "B", [1, 0]))
+        self.assertEqual(values, [True, False])
+
+        values = self.receive(b"l" + struct.pack(">l", 0))
+        self.assertEqual(values, [])
+
+    def test_receive_nested_list(self):
+        values = self.receive(b"l" + struct.pack(">l", 2) +
+                              b"l" + struct.pack(">l", 1) + b"I" + struct.pack(">q", 2**40) +
+                              b"l" + struct.pack(">l", 0))
+        self.assertEqual(values, [[2**40], []])
+
+    def test_receive_array(self):
+        values = self.receive(b"a\x02" + struct.pack(">ll", 2, 3) +
+                              _encode_elements(b"i", ">l", range(6)))
+        self.assertEqual(values.dtype, numpy.int32)
+        numpy.testing.assert_equal(values, numpy.arange(6).reshape((2, 3)))
+
+    def test_send_list(self):
+        self.assertSent(b"li", [1, -2], struct.pack(">lll", 2, 1, -2))
+        self.assertSent(b"lf", [0.5], struct.pack(">ld", 1, 0.5))
+        self.assertSent(b"lb", [True, False], struct.pack(">lBB", 2, 1, 0))
+        self.assertSent(b"lli", [[1], []], struct.pack(">llll", 2, 1, 1, 0))
+        self.assertNotSent(b"lf", [0.5, 1])
+        self.assertNotSent(b"li", [2**31])
+
+    def test_send_array(self):
+        self.assertSent(b"a\x02I", numpy.arange(4).reshape((2, 2)),
+                        struct.pack(">llqqqq", 2, 2, 0, 1, 2, 3))
+        self.assertSent(b"a\x01f", numpy.array([0.25]),
+                        struct.pack(">ld", 1, 0.25))
+        self.assertNotSent(b"a\x01i", numpy.array([1], dtype=numpy.int64))
+
+    def test_send_tuple(self):
+        self.assertSent(b"t\x02if", (1, 0.5), struct.pack(">ld", 1, 0.5))
+        self.assertSent(b"t\x02sb", ("ab", True), struct.pack(">l", 2) + b"ab\x01")
+        self.assertSent(b"t\x02lit\x01I", ([1], (2,)), struct.pack(">llq", 1, 1, 2))
+        self.assertNotSent(b"t\x02if", (1, 2))
+        self.assertNotSent(b"t\x02if", (1,))
+
+    def test_send_range(self):
+        self.assertSent(b"t\x02rii", (range(1, 5, 2), 3),
+                        struct.pack(">llll", 1, 5, 2, 3))
+
+    def test_send_bulk_checks(self):
+        # Elements rejected individually are rejected in lists and arrays.
+        self.assertNotSent(b"li", [1, numpy.int64(2)])
+        self.assertNotSent(b"li", [1, 2**31 - 1])
+        self.assertNotSent(b"lb", [True, numpy.bool_(False)])
+        self.assertNotSent(b"lf", [1.0, 2])
+        self.assertNotSent(b"a\x01i", numpy.array([1, 2], dtype=numpy.int64))
+        self.assertNotSent(b"a\x01i",
+                           numpy.array([-2**31, 0], dtype=numpy.int32))
+        self.assertNotSent(b"a\x01b", numpy.array([True, False]))
+        self.assertSent(b"lb", [True, False],
+                        struct.pack(">lBB", 2, 1, 0))
+        self.assertSent(b"lI", [1, numpy.int64(2)],
+                        struct.pack(">lqq", 2, 1, 2))
+
+
+class SystemInfoCase(unittest.TestCase):
+    def setUp(self):
+        self.comm = CommKernel("localhost")
+        self.comm.socket, self.device = socket.socketpair()
+        self.comm._stream = BufferedSocket(self.comm.socket)
+
+    def tearDown(self):
+        self.comm.close()
+        self.device.close()
+
+    def check(self, ident):
+        ident = ident.encode()
+        self.device.sendall(b"\x5a\x5a\x5a\x5a\x02AROR" +
+                            struct.pack(">l", len(ident)) + ident + b"\x01")
+        self.comm.check_system_info()
+        return self.comm.resident_kernels
+
+    def test_resident_kernels(self):
+        self.assertTrue(self.check("6.0;kasli;resident_kernels"))
+        # runtimes that do not support LoadKernelByDigest
+        self.assertFalse(self.check("6.0;kasli"))
+        self.assertFalse(self.check("6.0"))
+
+
+class _EmbeddingMap:
+    def __init__(self, services):
+        self.services = services
+        self.encoders = {}
+
+    def retrieve_object(self, obj_key):
+        return self.services[obj_key]
+
+    def has_rpc_encoder(self, service_id, tags):
+        return (service_id, tags) in self.encoders
+
+    def store_rpc_encoder(self, service_id, tags, encoder):
+        self.encoders[(service_id, tags)] = encoder
+
+    def retrieve_rpc_encoder(self, service_id, tags):
+        return self.encoders[(service_id, tags)]
+
+
+def _rpc_request(is_async, service_id, *args):
+    return (struct.pack(">lB?l", 0x5a5a5a5a, 10, is_async, service_id) +
+            b"".join(b"i" + struct.pack(">l", arg) for arg in args) +
+            b"\x00" + struct.pack(">l", 1) + b"n")
+
+
+_kernel_finished = struct.pack(">lB", 0x5a5a5a5a, 7)
+
+
+class AsyncRPCCase(unittest.TestCase):
+    def setUp(self):
+        self.comm = CommKernel("localhost", async_rpc_queue_size=2)
+        self.comm.socket, self.device = socket.socketpair()
+        self.comm._stream = BufferedSocket(self.comm.socket)
+
+    def tearDown(self):
+        self.comm.close()
+        self.device.close()
+
+    def serve(self, data, services):
+        self.device.sendall(data)
+        self.comm.serve(_EmbeddingMap(services), None, None)
+
+    def test_order(self):
+        calls = []
+        def slow(x):
+            time.sleep(0.01)
+            calls.append(x)
+        def sync():
+            calls.append("sync")
+        self.serve(b"".join(_rpc_request(True, 1, i) for i in range(5)) +
+                   _rpc_request(False, 2) + _rpc_request(True, 1, 5) +
+                   _kernel_finished,
+                   {1: slow, 2: sync})
+        self.assertEqual(calls, [0, 1, 2, 3, 4, "sync", 5])
+        # Reply to the synchronous RPC.
+        self.assertEqual(self.device.recv(64), struct.pack(">lBl", 0x5a5a5a5a, 7, 1) + b"n")
+
+    def test_error(self):
+        calls = []
+        def fail(x):
+            calls.append(x)
+            raise ValueError(x)
+        with self.assertRaises(ValueError):
+            self.serve(b"".join(_rpc_request(True, 1, i) for i in range(3)) +
+                       _kernel_finished,
+                       {1: fail})
+        self.assertEqual(calls, [0])
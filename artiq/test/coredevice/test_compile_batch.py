@@ -0,0 +1,206 @@
+import os
+import unittest
+from unittest import mock
+
+from pythonparser import diagnostic, source
+
+from artiq.compiler.library_cache import LibraryCache
+from artiq.coredevice import core as core_module
+from artiq.coredevice.core import Core, CompileError
+
+
+# LLVM IR of the libraries linked in this process, in order.
+_links = []
+
+
+class _MockTarget:
+    # Builds libraries that spell out the LLVM IR they were built from.
+    # It is a module-level class so that compiler pool processes can
+    # unpickle it.
+    triple = "mock"
+    data_layout = ""
+    features = []
+
+    def __init__(self, profiler=None):
+        pass
+
+    def emit_llvm_ir(self, module):
+        return module
+
+    def compile_llvm_ir(self, llvm_ir):
+        return llvm_ir
+
+    def assemble(self, llmodule):
+        return llmodule.encode()
+
+    def link(self, objects):
+        _links.append(b"".join(objects).decode())
+        return b"library:" + b"".join(objects)
+
+    def strip(self, library):
+        return library.replace(b"library:", b"stripped:")
+
+    def compile_and_link(self, modules):
+        return self.link([self.assemble(self.compile_llvm_ir(self.emit_llvm_ir(module)))
+                          for module in modules])
+
+    def build_library(self, llvm_ir):
+        library = self.link([self.assemble(self.compile_llvm_ir(llvm_ir))])
+        return library, self.strip(library)
+
+    def symbolize(self, library, addresses):
+        return [(library, address) for address in addresses]
+
+    def demangle(self, names):
+        return [name.upper() for name in names]
+
+
+class _MockComm:
+    def __init__(self):
+        self.calls = []
+
+    def check_system_info(self):
+        self.calls.append(("check_system_info",))
+
+    def load(self, kernel_library):
+        self.calls.append(("load", kernel_library))
+
+    def run(self):
+        self.calls.append(("run",))
+
+    def serve(self, embedding_map, symbolizer, demangler):
+        self.calls.append(("serve", embedding_map))
+
+    def close(self):
+        pass
+
+
+def _compile_error():
+    buffer = source.Buffer("broken\n", "<test>")
+    return diagnostic.Error(diagnostic.Diagnostic(
+        "fatal", "cannot compile", {}, source.Range(buffer, 0, 6)))
+
+
+class _Core(Core):
+    # Stitching is replaced by a module whose LLVM IR is the name and
+    # arguments of the kernel, and the kernel named "broken" does not compile.
+    def __init__(self, compile_workers=None):
+        Core.__init__(self, {}, None, 1e-9, compile_workers=compile_workers)
+        self.target_cls = _MockTarget
+        self.comm = _MockComm()
+
+    def _stitch(self, function, args, kwargs, set_result, attribute_writeback,
+                print_as_rpc, profiler):
+        if function == "broken":
+            raise _compile_error()
+        return {"function": function, "set_result": set_result}, \
+               "{}{}".format(function, args)
+
+
+class CompileBatchTest(unittest.TestCase):
+    def setUp(self):
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        for variable in ("ARTIQ_NO_KERNEL_CACHE", "ARTIQ_DUMP_ELF",
+                         "ARTIQ_PROFILE_COMPILER"):
+            os.environ.pop(variable, None)
+
+        self.library_cache = LibraryCache()
+        for patcher in (mock.patch.object(core_module, "library_cache", self.library_cache),
+                        mock.patch.object(core_module, "_compile_pool",
+                                          wraps=core_module._compile_pool)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        del _links[:]
+
+    def assertCompiledEqual(self, first, second):
+        (first_map, first_library, first_symbolizer, first_demangler) = first
+        (second_map, second_library, second_symbolizer, second_demangler) = second
+        self.assertEqual(first_map, second_map)
+        self.assertEqual(first_library, second_library)
+        self.assertEqual(first_symbolizer([4, 8]), second_symbolizer([4, 8]))
+        self.assertEqual(first_demangler(["f"]), second_demangler(["f"]))
+
+    def test_same_as_compile(self):
+        invocations = [("a", (1,), {}), ("b", (), {}), ("c", (2, 3), {}, "set_result")]
+        batch = _Core(compile_workers=1).compile_batch(invocations)
+        # Build every kernel again rather than taking it from the cache.
+        os.environ["ARTIQ_NO_KERNEL_CACHE"] = "1"
+        single = [_Core().compile(*invocation) for invocation in invocations]
+        self.assertEqual(len(batch), 3)
+        for compiled, expected in zip(batch, single):
+            self.assertCompiledEqual(compiled, expected)
+        self.assertEqual(batch[0][1], b"stripped:a(1,)")
+        self.assertEqual(batch[2][0], {"function": "c", "set_result": "set_result"})
+        # The symbolizer reads the library with its debug information.
+        self.assertEqual(batch[1][2]([4]), [(b"library:b()", 4)])
+
+    def test_pool(self):
+        invocations = [("a", (), {}), ("b", (), {}), ("c", (), {})]
+        batch = _Core(compile_workers=2).compile_batch(invocations)
+        self.assertEqual(core_module._compile_pool.call_count, 1)
+        # The libraries were built in the pool processes.
+        self.assertEqual(_links, [])
+        sequential = _Core(compile_workers=1).compile_batch(invocations)
+        for compiled, expected in zip(batch, sequential):
+            self.assertCompiledEqual(compiled, expected)
+
+    def test_sequential(self):
+        batch = _Core(compile_workers=1).compile_batch(
+            [("a", (), {}), ("b", (), {})])
+        core_module._compile_pool.assert_not_called()
+        self.assertEqual(_links, ["a()", "b()"])
+        self.assertEqual([compiled[1] for compiled in batch],
+                         [b"stripped:a()", b"stripped:b()"])
+
+    def test_identical_built_once(self):
+        for use_cache in (True, False):
+            if not use_cache:
+                os.environ["ARTIQ_NO_KERNEL_CACHE"] = "1"
+            del _links[:]
+            batch = _Core(compile_workers=1).compile_batch(
+                [("a", (), {}), ("b", (), {}), ("a", (), {})])
+            self.assertEqual(_links, ["a()", "b()"])
+            self.assertEqual(batch[0][1], batch[2][1])
+            # Each invocation keeps its own embedding map.
+            self.assertIsNot(batch[0][0], batch[2][0])
+
+    def test_cache_hits(self):
+        _Core().compile("a", (), {})
+        _Core().compile("b", (), {})
+        del _links[:]
+        batch = _Core(compile_workers=2).compile_batch(
+            [("a", (), {}), ("b", (), {}), ("a", (), {})])
+        self.assertEqual(_links, [])
+        core_module._compile_pool.assert_not_called()
+        self.assertEqual([compiled[1] for compiled in batch],
+                         [b"stripped:a()", b"stripped:b()", b"stripped:a()"])
+
+        # A single kernel to build does not start a pool either, and is
+        # then found in the cache.
+        _Core(compile_workers=2).compile_batch([("a", (), {}), ("c", (), {})])
+        core_module._compile_pool.assert_not_called()
+        self.assertEqual(_links, ["c()"])
+        self.assertIsNotNone(self.library_cache.get(
+            self.library_cache.digest(_MockTarget(), "c()")))
+
+    def test_compile_error(self):
+        with self.assertRaises(CompileError) as context:
+            _Core(compile_workers=1).compile_batch(
+                [("a", (), {}), ("broken", (), {}), ("b", (), {})])
+        self.assertEqual(context.exception.diagnostic.reason, "cannot compile")
+        # Nothing is built when any of the kernels fails to compile.
+        self.assertEqual(_links, [])
+        core_module._compile_pool.assert_not_called()
+
+    def test_run_compiled(self):
+        core = _Core(compile_workers=1)
+        batch = core.compile_batch([("a", (), {}), ("b", (), {})])
+        for compiled in batch:
+            core.run_compiled(*compiled)
+        self.assertEqual(core.comm.calls, [
+            ("check_system_info",),
+            ("load", b"stripped:a()"), ("run",), ("serve", batch[0][0]),
+            ("load", b"stripped:b()"), ("run",), ("serve", batch[1][0]),
+        ])
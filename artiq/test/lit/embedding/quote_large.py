@@ -0,0 +1,27 @@
+# RUN: env ARTIQ_DUMP_UNOPT_LLVM=%t %python -m artiq.compiler.testbench.embedding +compile %s
+# RUN: OutputCheck %s --file-to-check=%t_unopt.ll
+
+from artiq.language.core import *
+from artiq.language.types import *
+import numpy as np
+
+int_list = list(range(10000))
+float_list = [0.5*i for i in range(10000)]
+bool_list = [True, False]*5000
+float_mat = np.linspace(0, 1, 20000).reshape((100, 200))
+bool_vec = np.array([True, False])
+
+# Lists and arrays of numbers are embedded as raw bytes.
+# CHECK-L: {[0 x i32], [40000 x i8]}
+# CHECK-L: {[0 x double], [80000 x i8]}
+# CHECK-L: {[0 x double], [160000 x i8]}
+
+@kernel
+def entrypoint():
+    assert len(int_list) == 10000
+    assert int_list[9999] == 9999
+    assert float_list[1] == 0.5
+    assert not bool_list[1]
+    assert float_mat.shape == (100, 200)
+    assert float_mat[99][199] == 1.0
+    assert bool_vec[0]
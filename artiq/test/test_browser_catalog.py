@@ -0,0 +1,102 @@
+"""Tests for the catalog of result files of the browser."""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import h5py
+import numpy
+
+from sipyco import pyon
+
+from artiq.browser.catalog import Catalog
+
+
+_swmr_writer = """
+import sys
+import h5py
+from sipyco import pyon
+
+with h5py.File(sys.argv[1], "w", libver="latest") as f:
+    f["rid"] = 1
+    f["expid"] = pyon.encode({"file": "test.py"})
+    f.create_dataset("datasets/x", (0,), maxshape=(None,))
+    f.swmr_mode = True
+    print("ready", flush=True)
+    sys.stdin.read()
+"""
+
+
+class CatalogCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.catalog = Catalog(os.path.join(self.tmpdir.name, "catalog.db"))
+        self.filename = os.path.join(self.tmpdir.name, "000000001-Test.h5")
+
+    def tearDown(self):
+        self.catalog.close()
+        self.tmpdir.cleanup()
+
+    def _write(self, rid, thumbnail=None):
+        with h5py.File(self.filename, "w") as f:
+            f["artiq_version"] = "6.0"
+            f["rid"] = rid
+            f["start_time"] = 1600000000
+            f["expid"] = pyon.encode({"file": "test.py",
+                                      "class_name": "Test",
+                                      "repo_rev": "N/A"})
+            datasets = f.create_group("datasets")
+            if thumbnail is not None:
+                datasets["thumbnail"] = numpy.void(thumbnail)
+
+    def test_lookup(self):
+        self._write(1, b"\x89PNG")
+        metadata, thumbnail = self.catalog.lookup(self.filename)
+        self.assertEqual(metadata["rid"], 1)
+        self.assertEqual(metadata["artiq_version"], "6.0")
+        self.assertEqual(metadata["start_time"], 1600000000)
+        self.assertEqual(metadata["expid"]["class_name"], "Test")
+        self.assertEqual(thumbnail, b"\x89PNG")
+
+        # Entries are kept across instances, and are used while the file
+        # is unchanged.
+        self.catalog.close()
+        st = os.stat(self.filename)
+        with open(self.filename, "wb") as f:
+            f.write(b"\x00" * st.st_size)
+        self._set_mtime(st.st_mtime)
+        self.assertEqual(self.catalog.lookup(self.filename)[0]["rid"], 1)
+
+        self._write(2)
+        self._set_mtime(st.st_mtime + 1)
+        metadata, thumbnail = self.catalog.lookup(self.filename)
+        self.assertEqual(metadata["rid"], 2)
+        self.assertIsNone(thumbnail)
+
+    def _set_mtime(self, mtime):
+        os.utime(self.filename, (mtime, mtime))
+
+    def test_unreadable(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"not HDF5")
+        with self.assertRaises(OSError):
+            self.catalog.lookup(self.filename)
+
+    def test_swmr(self):
+        # Files that a run is still writing can be read.
+        writer = subprocess.Popen(
+            [sys.executable, "-c", _swmr_writer, self.filename],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEqual(writer.stdout.readline(), b"ready\n")
+            self.assertEqual(self.catalog.lookup(self.filename)[0]["rid"], 1)
+        finally:
+            writer.communicate()
+
+    def test_corrupted_catalog(self):
+        self._write(1)
+        with open(self.catalog.filename, "wb") as f:
+            f.write(b"\xff" * 4096)
+        self.assertEqual(self.catalog.lookup(self.filename)[0]["rid"], 1)
@@ -0,0 +1,193 @@
+"""Tests for the persistence of the datasets of the master."""
+
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from sipyco import pyon
+
+from artiq.master import databases
+from artiq.master.databases import DatasetDB
+
+
+class DatasetDBCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "dataset_db.h5")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _files(self):
+        return sorted(os.listdir(self.tmpdir.name))
+
+    def test_log_and_snapshot(self):
+        ddb = DatasetDB(self.filename)
+        ddb.set("array", numpy.arange(4), persist=True)
+        ddb.set("list", [1, 2], persist=True)
+        ddb.set("volatile", 1)
+        ddb.update({"action": "append", "path": ["list", 1], "x": 3})
+        ddb.update({"action": "setitem", "path": ["array", 1],
+                    "key": 0, "value": 5})
+        self.assertEqual(self._files(), ["dataset_db.h5.0.wal"])
+
+        ddb = DatasetDB(self.filename)
+        self.assertEqual(ddb.get("list"), [1, 2, 3])
+        self.assertEqual(list(ddb.get("array")), [5, 1, 2, 3])
+        self.assertNotIn("volatile", ddb.data.raw_view)
+
+        ddb.save()
+        ddb.set("list", "replaced")
+        ddb.delete("array")
+        self.assertEqual(self._files(), ["dataset_db.h5", "dataset_db.h5.2.wal"])
+
+        ddb = DatasetDB(self.filename)
+        self.assertEqual(ddb.get("list"), "replaced")
+        self.assertNotIn("array", ddb.data.raw_view)
+        ddb.set("list", "volatile now", persist=False)
+        self.assertNotIn("list", DatasetDB(self.filename).data.raw_view)
+
+    def test_truncated_log(self):
+        ddb = DatasetDB(self.filename)
+        ddb.set("a", 1, persist=True)
+        ddb.set("b", 2, persist=True)
+        ddb._store.close(None)
+        wal_filename = self.filename + ".0.wal"
+        with open(wal_filename, "r+") as f:
+            f.truncate(os.path.getsize(wal_filename) - 5)
+
+        ddb = DatasetDB(self.filename)
+        self.assertEqual(ddb.get("a"), 1)
+        self.assertNotIn("b", ddb.data.raw_view)
+        ddb.set("c", 3, persist=True)
+        self.assertEqual(DatasetDB(self.filename).get("c"), 3)
+
+    def test_compaction(self):
+        ddb = DatasetDB(self.filename)
+        ddb._store.compact_min_size = 0
+        ddb.set("a", numpy.zeros(10), persist=True)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(
+                ddb._store.autosave(ddb._persistent_datasets))
+        finally:
+            loop.close()
+        ddb.update({"action": "setitem", "path": ["a", 1],
+                    "key": 2, "value": 1.0})
+        self.assertEqual(self._files(), ["dataset_db.h5", "dataset_db.h5.1.wal"])
+        self.assertEqual(DatasetDB(self.filename).get("a")[2], 1.0)
+
+    def test_compaction_concurrent(self):
+        ddb = DatasetDB(self.filename)
+        ddb._store.compact_min_size = 0
+        a = [1]
+        ddb.set("a", a, persist=True)
+        ddb.set("b", [1], persist=True)
+        started = threading.Event()
+        modified = threading.Event()
+
+        def write_snapshot(*args):
+            started.set()
+            modified.wait()
+            write_snapshot.__wrapped__(*args)
+        write_snapshot.__wrapped__ = databases._write_snapshot
+
+        async def compact():
+            task = asyncio.ensure_future(
+                ddb._store.autosave(ddb._persistent_datasets))
+            while not started.is_set():
+                await asyncio.sleep(0.01)
+            # Datasets modified in place while the snapshot is written are
+            # copied first, and only once.
+            ddb.update({"action": "append", "path": ["a", 1], "x": 2})
+            b = ddb.get("b")
+            ddb.update({"action": "append", "path": ["b", 1], "x": 2})
+            self.assertIsNot(ddb.get("b"), b)
+            b = ddb.get("b")
+            ddb.update({"action": "append", "path": ["b", 1], "x": 3})
+            self.assertIs(ddb.get("b"), b)
+            modified.set()
+            await task
+
+        loop = asyncio.new_event_loop()
+        databases._write_snapshot = write_snapshot
+        try:
+            loop.run_until_complete(compact())
+        finally:
+            databases._write_snapshot = write_snapshot.__wrapped__
+            loop.close()
+        self.assertIsNone(ddb._store.snapshot)
+        self.assertEqual(a, [1])
+        self.assertEqual(ddb.get("a"), [1, 2])
+        self.assertEqual(databases._read_snapshot(self.filename)[0],
+                         {"a": [1], "b": [1]})
+        ddb = DatasetDB(self.filename)
+        self.assertEqual(ddb.get("a"), [1, 2])
+        self.assertEqual(ddb.get("b"), [1, 2, 3])
+
+    def test_import_pyon(self):
+        pyon.store_file(os.path.join(self.tmpdir.name, "dataset_db.pyon"),
+                        {"a": 1})
+        self.assertEqual(DatasetDB(self.filename).get("a"), 1)
+
+    def test_pyon(self):
+        filename = os.path.join(self.tmpdir.name, "dataset_db.pyon")
+        ddb = DatasetDB(filename)
+        ddb.set("a", 1, persist=True)
+        ddb.save()
+        self.assertEqual(pyon.load_file(filename), {"a": 1})
+
+    def test_watch(self):
+        ddb = DatasetDB(self.filename)
+        ddb.set("a", [1], persist=True)
+        changed = []
+        ddb.watch("a", changed.append)
+        ddb.set("b", 1)
+        self.assertEqual(changed, [])
+        ddb.update({"action": "append", "path": ["a", 1], "x": 2})
+        self.assertEqual(changed, ["a"])
+        # watchers are called only once
+        ddb.delete("a")
+        self.assertEqual(changed, ["a"])
+
+        ddb.watch("b", changed.append)
+        ddb.unwatch("b", changed.append)
+        ddb.set("b", 2)
+        self.assertEqual(changed, ["a"])
+        self.assertEqual(ddb._watchers, dict())
+
+    def test_update_many(self):
+        ddb = DatasetDB(self.filename)
+        ddb.set("a", [1], persist=True)
+        ddb.update_many([
+            {"action": "append", "path": ["a", 1], "x": 2},
+            {"action": "setitem", "path": [], "key": "b", "value": (True, 3)}
+        ])
+        ddb = DatasetDB(self.filename)
+        self.assertEqual(ddb.get("a"), [1, 2])
+        self.assertEqual(ddb.get("b"), 3)
+
+    def test_update_many_invalid(self):
+        ddb = DatasetDB(self.filename)
+        ddb.set("a", [1], persist=True)
+        published = []
+        ddb.data.publish = published.append
+        for mods in [
+                [{"action": "append", "path": ["a", 1], "x": 2},
+                 {"action": "append", "path": ["c", 1], "x": 3}],
+                [{"action": "delitem", "path": [], "key": "a"},
+                 {"action": "append", "path": ["a", 1], "x": 3}],
+                [{"action": "setitem", "path": [], "key": "b", "value": 3}]]:
+            with self.assertRaises((KeyError, TypeError)):
+                ddb.update_many(mods)
+        # None of the modifications of a batch are applied, logged or
+        # published if one of them fails.
+        self.assertEqual(published, [])
+        self.assertEqual(ddb.get("a"), [1])
+        self.assertNotIn("b", ddb.data.raw_view)
+        ddb = DatasetDB(self.filename)
+        self.assertEqual(ddb.get("a"), [1])
@@ -12,6 +12,7 @@ from artiq.master.worker_db import DatasetManager
 class MockDatasetDB:
     def __init__(self):
         self.data = dict()
+        self.batches = []
 
     def get(self, key):
         return self.data[key][1]
@@ -22,6 +23,11 @@ class MockDatasetDB:
         # applied twice.
         process_mod(self.data, copy.deepcopy(mod))
 
+    def update_many(self, mods):
+        self.batches.append(len(mods))
+        for mod in mods:
+            self.update(mod)
+
     def delete(self, key):
         del self.data[key]
 
@@ -103,3 +109,39 @@ class ExperimentDatasetCase(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.exp.append(KEY, 0)
 
+
+    def test_batch(self):
+        self.exp.set(KEY, [], broadcast=True)
+        with self.exp.dataset_batch():
+            self.exp.set("bar", 0, broadcast=True)
+            with self.exp.dataset_batch():
+                self.exp.append(KEY, 0)
+            self.exp.append(KEY, 1)
+            self.assertEqual(self.dataset_db.data[KEY][1], [])
+            self.assertNotIn("bar", self.dataset_db.data)
+        self.assertEqual(self.dataset_db.batches, [3])
+        self.assertEqual(self.dataset_db.data[KEY][1], [0, 1])
+        self.assertEqual(self.dataset_db.get("bar"), 0)
+
+        with self.assertRaises(ZeroDivisionError):
+            with self.exp.dataset_batch():
+                self.exp.append(KEY, 2)
+                1/0
+        self.assertEqual(self.dataset_db.data[KEY][1], [0, 1, 2])
+
+    def test_batch_get(self):
+        # Broadcast datasets are read back with the modifications made in
+        # the batch, before the master receives them.
+        self.exp.set(KEY, 1, broadcast=True, archive=False)
+        self.exp.set("bar", 1, broadcast=True, archive=False)
+        with self.exp.dataset_batch():
+            self.exp.set(KEY, 2, broadcast=True, archive=False)
+            self.exp.set("new", 3, broadcast=True, archive=False)
+            self.exp.set("bar", 4, archive=False)
+            self.assertEqual(self.exp.get(KEY), 2)
+            self.assertEqual(self.exp.get("new"), 3)
+            with self.assertRaises(KeyError):
+                self.exp.get("bar")
+            self.assertEqual(self.dataset_db.get(KEY), 1)
+        self.assertEqual(self.exp.get(KEY), 2)
+        self.assertEqual(self.exp.get("new"), 3)
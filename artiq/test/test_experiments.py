@@ -0,0 +1,120 @@
+import unittest
+import asyncio
+import os
+import tempfile
+
+from artiq.master.experiments import _RepoScanner
+
+
+_experiment = """
+from artiq.experiment import *
+
+class {class_name}(EnvExperiment):
+    \"\"\"{name}\"\"\"
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+"""
+
+
+_dependent = """
+from artiq.experiment import *
+import helper
+
+class E(EnvExperiment):
+    def build(self):
+        self.setattr_argument("x", NumberValue(
+            helper.default + self.get_dataset("offset")))
+
+    def run(self):
+        pass
+"""
+
+
+class RepoScannerCase(unittest.TestCase):
+    def setUp(self):
+        if os.name == "nt":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.repository = tempfile.TemporaryDirectory()
+        root = self.repository.name
+        os.mkdir(os.path.join(root, "sub"))
+        for filename, class_name, name in [
+                ("a.py", "A", "Same"),
+                ("b.py", "B", "Same"),
+                ("c.py", "C", "Same"),
+                ("d.py", "D", "Other"),
+                ("sub/a.py", "A", "Same"),
+                ("sub/b.py", "B", "Same")]:
+            with open(os.path.join(root, filename), "w") as f:
+                f.write(_experiment.format(class_name=class_name, name=name))
+        with open(os.path.join(root, "broken.py"), "w") as f:
+            f.write("raise ValueError\n")
+
+    def scan(self, concurrency, cache=None):
+        scanner = _RepoScanner(dict(), concurrency, cache)
+        explist = self.loop.run_until_complete(
+            scanner.scan(self.repository.name))
+        return explist, scanner.cache
+
+    def test_concurrency(self):
+        serial, _ = self.scan(1)
+        self.assertEqual(len(serial), 6)
+        self.assertEqual({entry["file"] for entry in serial.values()},
+                         {"a.py", "b.py", "c.py", "d.py",
+                          os.path.join("sub", "a.py"),
+                          os.path.join("sub", "b.py")})
+        self.assertEqual(self.scan(4)[0], serial)
+
+    def test_cache(self):
+        explist, cache = self.scan(4)
+        self.assertNotIn("broken.py", cache)
+
+        # Unchanged files are not examined again.
+        cache["d.py"]["description"]["D"]["name"] = "Cached"
+        with open(os.path.join(self.repository.name, "c.py"), "w") as f:
+            f.write(_experiment.format(class_name="C", name="Changed"))
+        explist, cache = self.scan(4, cache)
+        self.assertIn("Cached", explist)
+        self.assertIn("Changed", explist)
+        self.assertNotIn("Other", explist)
+
+    def test_cache_dependencies(self):
+        root = self.repository.name
+        with open(os.path.join(root, "helper.py"), "w") as f:
+            f.write("default = 1\n")
+        with open(os.path.join(root, "e.py"), "w") as f:
+            f.write(_dependent)
+        datasets = {"offset": 0}
+        scanner = _RepoScanner({"get_dataset": datasets.__getitem__}, 4)
+
+        def default():
+            explist = self.loop.run_until_complete(scanner.scan(root))
+            return explist["E"]["arginfo"]["x"][0]["default"]
+
+        self.assertEqual(default(), 1)
+        self.assertEqual(scanner.cache["e.py"]["datasets"].keys(),
+                         {"offset"})
+        self.assertEqual(scanner.cache["e.py"]["imports"].keys(),
+                         {"helper.py"})
+
+        # Files are examined again when a module that they import from
+        # the repository, or a dataset that they read, changes.
+        with open(os.path.join(root, "helper.py"), "w") as f:
+            f.write("default = 2\n")
+        self.assertEqual(default(), 2)
+        datasets["offset"] = 10
+        self.assertEqual(default(), 12)
+
+        scanner.cache["e.py"]["description"]["E"]["name"] = "Cached"
+        explist = self.loop.run_until_complete(scanner.scan(root))
+        self.assertIn("Cached", explist)
+
+    def tearDown(self):
+        self.repository.cleanup()
+        self.loop.close()
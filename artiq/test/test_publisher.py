@@ -0,0 +1,145 @@
+import asyncio
+import copy
+import os
+import unittest
+
+from sipyco.sync_struct import Notifier, process_mod
+from sipyco import pyon
+
+from artiq.master.publisher import (Coalescer, CoalescingPublisher,
+                                    subscription_name)
+
+
+def _setitem(path, key, value):
+    return {"action": "setitem", "path": path, "key": key, "value": value}
+
+
+class CoalescerCase(unittest.TestCase):
+    def _check(self, initial, mods):
+        # Like a notifier, modify the structure before publishing.
+        expected = copy.deepcopy(initial)
+        coalescer = Coalescer()
+        for mod in mods:
+            process_mod(expected, mod)
+            coalescer.add(mod)
+        coalesced = [pyon.decode(line.decode())
+                     for _, line in coalescer.take()]
+        self.assertEqual(len(coalescer), 0)
+        result = copy.deepcopy(initial)
+        for mod in coalesced:
+            process_mod(result, mod)
+        self.assertEqual(result, expected)
+        return coalesced
+
+    def test_same_key(self):
+        mods = [_setitem([], "a", i) for i in range(100)]
+        mods.insert(50, _setitem([], "b", 1))
+        self.assertEqual(self._check({}, mods),
+                         [_setitem([], "b", 1), _setitem([], "a", 99)])
+
+    def test_inside(self):
+        mods = [
+            _setitem([], "a", [0, 0]),
+            _setitem(["a"], 0, 1),
+            {"action": "append", "path": ["a"], "x": 2},
+            _setitem([], "b", 3),
+            _setitem([], "a", [4]),
+        ]
+        self.assertEqual(self._check({}, mods), mods[3:])
+
+    def test_barriers(self):
+        mods = [
+            _setitem(["a"], 0, 1),
+            {"action": "insert", "path": ["a"], "i": 0, "x": 2},
+            _setitem(["a"], 0, 3),
+            _setitem([], "b", 4),
+            {"action": "delitem", "path": [], "key": "b"},
+            _setitem([], "b", 5),
+        ]
+        self.assertEqual(self._check({"a": [0]}, mods), mods)
+
+    def test_keys(self):
+        coalescer = Coalescer()
+        coalescer.add(_setitem([], "a", 1))
+        coalescer.add({"action": "append", "path": ["b", 0], "x": 2})
+        self.assertEqual([key for key, _ in coalescer.take()], ["a", "b"])
+
+    def test_subscription_name(self):
+        name = subscription_name("datasets", ["b", "a"], ["c."])
+        notifier_name, filter_desc = name.split("?", 1)
+        self.assertEqual(notifier_name, "datasets")
+        self.assertEqual(pyon.decode(filter_desc),
+                         {"keys": ["a", "b"], "prefixes": ["c."]})
+        # unset optional datasets of applets
+        name = subscription_name("datasets", {"y", None})
+        self.assertEqual(pyon.decode(name.split("?", 1)[1]),
+                         {"keys": ["y"], "prefixes": []})
+
+
+class PublisherCase(unittest.TestCase):
+    def setUp(self):
+        if os.name == "nt":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.datasets = Notifier({"a": 1, "b": 2, "c.x": 3, "d": 4})
+        self.publisher = CoalescingPublisher(
+            {"datasets": self.datasets, "schedule": Notifier([])}, interval=0)
+        self.loop.run_until_complete(self.publisher.start("127.0.0.1", 0))
+        self.port = self.publisher.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.publisher.stop())
+        self.loop.close()
+
+    async def _subscribe(self, name):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(b"ARTIQ sync_struct\n" + name.encode() + b"\n")
+        return reader, writer
+
+    async def _read_mod(self, reader):
+        line = await asyncio.wait_for(reader.readline(), 5)
+        return pyon.decode(line.decode())
+
+    def test_filtered(self):
+        async def test():
+            reader, writer = await self._subscribe(
+                subscription_name("datasets", ["a"], ["c."]))
+            self.assertEqual(await self._read_mod(reader),
+                             {"action": "init", "struct": {"a": 1, "c.x": 3}})
+
+            self.datasets["b"] = 5
+            self.datasets["a"] = 6
+            self.datasets["c.y"] = 7
+            del self.datasets["d"]
+            self.assertEqual(await self._read_mod(reader), _setitem([], "a", 6))
+            self.assertEqual(await self._read_mod(reader), _setitem([], "c.y", 7))
+
+            # Nothing else was sent in between.
+            self.datasets["d"] = 8
+            self.datasets["c.x"] = 9
+            self.assertEqual(await self._read_mod(reader), _setitem([], "c.x", 9))
+            writer.close()
+        self.loop.run_until_complete(test())
+
+    def test_invalid_filter(self):
+        async def test():
+            for name in ["datasets?{", "datasets?[]", "datasets?{'keys': []}",
+                         "datasets?{'keys': [[1]], 'prefixes': []}",
+                         "datasets?{'keys': [], 'prefixes': [1]}",
+                         subscription_name("schedule", ["a"]),
+                         subscription_name("unknown", ["a"])]:
+                reader, writer = await self._subscribe(name)
+                self.assertEqual(await asyncio.wait_for(reader.read(), 5), b"",
+                                 name)
+                writer.close()
+
+            # The publisher still serves the other subscribers.
+            reader, writer = await self._subscribe("datasets")
+            self.assertEqual(await self._read_mod(reader),
+                             {"action": "init", "struct": self.datasets.raw_view})
+            writer.close()
+        with self.assertLogs("artiq.master.publisher", "WARNING"):
+            self.loop.run_until_complete(test())
@@ -0,0 +1,108 @@
+"""Tests for the streaming of the results of a run to its HDF5 file."""
+
+import os
+import tempfile
+import time
+import unittest
+
+import h5py
+import numpy
+
+from artiq.experiment import EnvExperiment
+from artiq.master.worker_db import DatasetManager
+from artiq.test.test_datasets import MockDatasetDB
+
+
+class StreamingExperiment(EnvExperiment):
+    def build(self, **kwargs):
+        self.set_result_streaming(**kwargs)
+
+
+class ResultStreamCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name, "results.h5")
+        self.dataset_mgr = DatasetManager(MockDatasetDB())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _start(self, flush_period=0, **kwargs):
+        exp = StreamingExperiment((None, self.dataset_mgr, None, None),
+                                  flush_period=flush_period, **kwargs)
+        self.assertTrue(self.dataset_mgr.start_result_stream(
+            self.filename, {"rid": 42}))
+        return exp
+
+    def _read(self, key):
+        with h5py.File(self.filename, "r", libver="latest", swmr=True) as f:
+            return f["datasets"][key][()]
+
+    def test_append_and_mutate(self):
+        exp = self._start(compression="gzip")
+        exp.set_dataset("points", [])
+        exp.set_dataset("histogram", numpy.zeros(4, dtype=numpy.int64))
+        exp.set_dataset("scalar", 1.5)
+        for i in range(10):
+            exp.append_to_dataset("points", i)
+        exp.mutate_dataset("histogram", 2, 7)
+        exp.mutate_dataset("histogram", (0, 2), [1, 1])
+
+        with h5py.File(self.filename, "r") as f:
+            points = f["datasets"]["points"]
+            self.assertEqual(points.maxshape, (None, ))
+            self.assertEqual(points.compression, "gzip")
+            self.assertEqual(list(points[()]), list(range(10)))
+            self.assertEqual(list(f["datasets"]["histogram"][()]), [1, 1, 7, 0])
+            self.assertNotIn("scalar", f["datasets"])
+            self.assertEqual(f["rid"][()], 42)
+
+        exp.set_dataset("points", [[1.0, 2.0]])
+        exp.append_to_dataset("points", [3.0, 4.0])
+        self.dataset_mgr.close_result_stream()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(f["datasets"]["points"].shape, (2, 2))
+            self.assertEqual(f["datasets"]["scalar"][()], 1.5)
+            self.assertIn("archive", f)
+
+    def test_swmr(self):
+        exp = self._start(swmr=True)
+        exp.set_dataset("points", [])
+        exp.append_to_dataset("points", 1.0)
+        exp.append_to_dataset("points", 2.0)
+        self.assertEqual(list(self._read("points")), [1.0, 2.0])
+        exp.append_to_dataset("points", 3.0)
+        self.assertEqual(list(self._read("points")), [1.0, 2.0, 3.0])
+        self.dataset_mgr.close_result_stream()
+
+    def test_swmr_created_up_front(self):
+        self.dataset_mgr.set("histogram", numpy.zeros(3))
+        self.dataset_mgr.set("points", [])
+        exp = self._start(swmr=True)
+        exp.mutate_dataset("histogram", 1, 2.0)
+        with h5py.File(self.filename, "r", libver="latest", swmr=True) as f:
+            self.assertEqual(list(f["datasets"]["histogram"][()]), [0, 2, 0])
+            exp.append_to_dataset("points", 1)
+            # created after the file was switched to SWMR mode
+            self.assertNotIn("points", f["datasets"])
+            exp.mutate_dataset("histogram", 2, 3.0)
+            f["datasets"]["histogram"].refresh()
+            self.assertEqual(list(f["datasets"]["histogram"][()]), [0, 2, 3])
+        self.dataset_mgr.close_result_stream()
+        with h5py.File(self.filename, "r") as f:
+            self.assertEqual(list(f["datasets"]["points"][()]), [1])
+
+    def test_periodic_flush(self):
+        exp = self._start(flush_period=0.05)
+        exp.set_dataset("points", [])
+        exp.append_to_dataset("points", 1.0)
+        exp.append_to_dataset("points", 2.0)
+        # flushed without further modifications of the datasets
+        time.sleep(0.3)
+        self.assertEqual(list(self._read("points")), [1.0, 2.0])
+        self.dataset_mgr.close_result_stream()
+
+    def test_disabled(self):
+        self.assertFalse(self.dataset_mgr.start_result_stream(
+            self.filename, {}))
+        self.assertFalse(os.path.exists(self.filename))
@@ -3,9 +3,11 @@ import logging
 import asyncio
 import sys
 import os
+import tempfile
 from time import sleep
 
 from artiq.experiment import *
+from artiq.master.databases import DatasetDB
 from artiq.master.worker import *
 
 
@@ -53,6 +55,21 @@ class WatchdogTimeoutInBuild(EnvExperiment):
         pass
 
 
+class DatasetCache(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        value = self.get_dataset("cached", archive=False)
+        value.append(0)
+        if self.get_dataset("cached", archive=False) != [1]:
+            raise ValueError("cached value was modified")
+        # The master changes "cached" when it receives this update.
+        self.set_dataset("trigger", 1, broadcast=True)
+        if self.get_dataset("cached", archive=False) != [2]:
+            raise ValueError("cached value was not invalidated")
+
+
 async def _call_worker(worker, expid):
     try:
         await worker.build(0, "main", None, expid, 0)
@@ -63,7 +80,7 @@ async def _call_worker(worker, expid):
         await worker.close()
 
 
-def _run_experiment(class_name):
+def _run_experiment(class_name, handlers=dict()):
     expid = {
         "log_level": logging.WARNING,
         "file": sys.modules[__name__].__file__,
@@ -71,7 +88,7 @@ def _run_experiment(class_name):
         "arguments": dict()
     }
     loop = asyncio.get_event_loop()
-    worker = Worker({})
+    worker = Worker(handlers)
     loop.run_until_complete(_call_worker(worker, expid))
 
 
@@ -105,5 +122,128 @@ class WorkerCase(unittest.TestCase):
         with self.assertRaises(WorkerWatchdogTimeout):
             _run_experiment("WatchdogTimeoutInBuild")
 
+    def test_dataset_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dataset_db = DatasetDB(os.path.join(tmpdir, "dataset_db.pyon"))
+            dataset_db.set("cached", [1])
+
+            def update_dataset(mod):
+                dataset_db.update(mod)
+                if mod["key"] == "trigger":
+                    dataset_db.set("cached", [2])
+
+            _run_experiment("DatasetCache", {
+                "get_dataset": dataset_db.get,
+                "update_dataset": update_dataset,
+                "watch_dataset": dataset_db.watch,
+                "unwatch_dataset": dataset_db.unwatch
+            })
+            # The closed worker no longer watches the datasets it read.
+            self.assertEqual(dataset_db._watchers, dict())
+
+    def test_reuse(self):
+        expid = {
+            "log_level": logging.WARNING,
+            "file": sys.modules[__name__].__file__,
+            "class_name": "SimpleExperiment",
+            "arguments": dict()
+        }
+
+        async def run_twice(worker):
+            try:
+                for rid in range(2):
+                    await worker.build(rid, "main", None, expid, 0)
+                    await worker.prepare()
+                    await worker.run()
+                    await worker.analyze()
+            finally:
+                await worker.close()
+
+        worker = Worker({})
+        self.loop.run_until_complete(run_twice(worker))
+        self.assertEqual(worker.runs, 2)
+
+    def test_pool(self):
+        async def wait_started(pool):
+            while not pool._idle:
+                await asyncio.sleep(0.1)
+
+        pool = WorkerPool({}, size=1, max_runs=2)
+        pool.start()
+        self.loop.run_until_complete(wait_started(pool))
+        worker = pool.get()
+        # The worker process has been started ahead of time.
+        self.assertIsNotNone(worker.ipc)
+        self.assertFalse(worker.idle)
+        self.loop.run_until_complete(wait_started(pool))
+
+        # The worker has not completed a run, so it is not kept.
+        self.loop.run_until_complete(pool.release(worker))
+        self.assertTrue(worker.closed.is_set())
+        idle = list(pool._idle)
+        self.loop.run_until_complete(pool.close())
+        self.assertTrue(all(w.closed.is_set() for w in idle))
+
+    def test_pool_reuse(self):
+        wd, file = os.path.split(sys.modules[__name__].__file__)
+        expid = {
+            "log_level": logging.WARNING,
+            "file": file,
+            "class_name": "SimpleExperiment",
+            "arguments": dict()
+        }
+
+        async def run(worker, wd):
+            await worker.build(0, "main", wd, expid, 0)
+            await worker.prepare()
+            await worker.run()
+            await worker.analyze()
+            await pool.release(worker)
+
+        pool = WorkerPool({}, size=1, max_runs=3)
+        worker = pool.get(wd)
+        self.loop.run_until_complete(run(worker, wd))
+        # kept for the runs of the same repository revision only
+        self.assertIs(pool.get(wd), worker)
+        self.loop.run_until_complete(run(worker, wd))
+        self.assertIsNot(pool.get(wd + "_other"), worker)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.assertTrue(worker.closed.is_set())
+
+        # not kept for the runs in a checkout that may change
+        worker = pool.get()
+        self.loop.run_until_complete(run(worker, wd))
+        self.assertTrue(worker.closed.is_set())
+        self.loop.run_until_complete(pool.close())
+
+    def test_interrupted_frame(self):
+        class Process:
+            returncode = None
+            killed = False
+
+            def kill(self):
+                self.killed = True
+
+        class IPC:
+            process = Process()
+
+            async def read(self, n):
+                if n > 1:
+                    return b"\x00"
+                await asyncio.sleep(100)
+
+        worker = Worker({})
+        worker.ipc = IPC()
+
+        async def recv():
+            async with worker.io_lock:
+                await worker._recv(0.1)
+        with self.assertLogs():
+            with self.assertRaises(WorkerTimeout):
+                self.loop.run_until_complete(recv())
+        # The rest of the frame may still arrive, so the worker is ended.
+        self.assertTrue(worker.closed.is_set())
+        self.assertTrue(worker.ipc.process.killed)
+
     def tearDown(self):
         self.loop.close()
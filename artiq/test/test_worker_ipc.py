@@ -0,0 +1,42 @@
+import unittest
+from collections import OrderedDict
+
+import numpy
+
+from artiq.master import worker_ipc
+
+
+def _round_trip(obj):
+    frame = worker_ipc.encode(obj)
+    (length, ) = worker_ipc.frame_header.unpack_from(frame)
+    header_size = worker_ipc.frame_header.size
+    assert length == len(frame) - header_size
+    return worker_ipc.decode(bytearray(frame[header_size:]))
+
+
+class WorkerIPCCase(unittest.TestCase):
+    def test_plain(self):
+        obj = {"action": "completed", "args": (1, "a", [2.0, None]),
+               "kwargs": OrderedDict(b=numpy.int32(3))}
+        self.assertEqual(_round_trip(obj), obj)
+
+    def test_arrays(self):
+        array = numpy.arange(6, dtype=numpy.float64).reshape((2, 3))
+        obj = {"action": "update_dataset",
+               "args": ({"action": "setitem", "path": [], "key": "x",
+                         "value": (True, array)}, ),
+               "other": [numpy.zeros(0, dtype=numpy.int32),
+                         numpy.array([True, False]),
+                         numpy.array([1+2j]),
+                         array[:, 1]]}
+        result = _round_trip(obj)
+        # The original object is not modified.
+        self.assertIs(obj["args"][0]["value"][1], array)
+
+        received = result["args"][0]["value"][1]
+        numpy.testing.assert_array_equal(received, array)
+        self.assertEqual(received.dtype, array.dtype)
+        received[0, 0] = 1  # writable
+        for sent, received in zip(obj["other"], result["other"]):
+            numpy.testing.assert_array_equal(received, sent)
+            self.assertEqual(received.dtype, sent.dtype)